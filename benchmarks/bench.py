@@ -0,0 +1,275 @@
+"""
+    Benchmarks for cpytraceafl's hot paths, not requiring AFL itself. Run with e.g.
+
+        python benchmarks/bench.py [--json RESULTS] [--baseline OLD_RESULTS] [BENCHMARK...]
+
+    where BENCHMARK is any of "hooks", "rewrite", "forkserver" or "examples", defaulting to
+    all of them. Results are printed and optionally written to RESULTS as json, which can be
+    passed back as OLD_RESULTS to a later run to show the relative change of each figure.
+
+    "forkserver" and "examples" drive targets using `cpytraceafl.driver`, the latter running
+    each script in examples/ and reporting execs per second. Scripts whose target packages aren't
+    installed are skipped.
+"""
+import argparse
+import ctypes
+import dis
+import glob
+import importlib
+import inspect
+import json
+import mmap
+import os
+import random
+import sys
+import time
+import timeit
+
+from cpytraceafl import DEFAULT_MAP_SIZE_BITS, rewriter, tracehook
+from cpytraceafl.driver import Driver, TargetStartError
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples")
+
+# stdlib modules whose code is used as rewriting fodder
+REWRITE_CORPUS_MODULES = (
+    "argparse",
+    "difflib",
+    "email.message",
+    "json.decoder",
+    "pickletools",
+    "tarfile",
+)
+
+forkserver_target_source = """
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+from cpytraceafl import fuzz_from_here
+
+fuzz_from_here()
+"""
+
+persistent_target_source = """
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+from cpytraceafl import fuzz_loop
+
+for data in fuzz_loop(1000):
+    pass
+"""
+
+
+def _ns_per_call(stmt, namespace, repeat=5):
+    timer = timeit.Timer(stmt, globals=namespace)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) * 1e9 / number
+
+
+def _get_frame():
+    return sys._getframe()
+
+
+def _get_uninstrumented_frame():
+    return sys._getframe()
+
+
+def _leaf():
+    return None
+
+
+def _uninstrumented_leaf():
+    return None
+
+
+def _leaf_call_ns(leaf, number=100000, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            leaf()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e9 / number
+
+
+def _native_hook_ns(leaf):
+    # the added cost of each call to leaf with the native hook installed, including the
+    # "line" and "return" events it causes
+    untraced_ns = _leaf_call_ns(leaf)
+    tracehook.set_native_trace_hook()
+    try:
+        traced_ns = _leaf_call_ns(leaf)
+    finally:
+        sys.settrace(None)
+    return traced_ns - untraced_ns
+
+
+def bench_hooks(args):
+    results = {}
+    with mmap.mmap(-1, 1<<DEFAULT_MAP_SIZE_BITS, flags=mmap.MAP_PRIVATE) as mem:
+        first_byte = ctypes.c_byte.from_buffer(mem)
+        try:
+            tracehook.set_map_start(ctypes.addressof(first_byte))
+            tracehook.set_map_size_bits(DEFAULT_MAP_SIZE_BITS)
+            tracehook.set_ngram_size(0)
+            tracehook.set_instrumented(_get_uninstrumented_frame.__code__, False)
+            tracehook.set_instrumented(_uninstrumented_leaf.__code__, False)
+            # so that only the calls being timed are of interest
+            tracehook.set_instrumented(_leaf_call_ns.__code__, False)
+
+            namespace = {
+                "line_trace_hook": tracehook.line_trace_hook,
+                "global_trace_hook": tracehook.global_trace_hook,
+                "frame": _get_frame(),
+                "uninstrumented_frame": _get_uninstrumented_frame(),
+            }
+            # these include the cost of making a python-level call to a C function
+            results["line_trace_hook_ns"] = _ns_per_call(
+                "line_trace_hook(frame, 'line', None)",
+                namespace,
+            )
+            results["global_trace_hook_ns"] = _ns_per_call(
+                "global_trace_hook(frame, 'call', None)",
+                namespace,
+            )
+            results["global_trace_hook_uninstrumented_ns"] = _ns_per_call(
+                "global_trace_hook(uninstrumented_frame, 'call', None)",
+                namespace,
+            )
+            del namespace
+
+            # no python-level calls involved at all, so measured as an increase in the cost
+            # of calling a function
+            results["native_trace_hook_ns"] = _native_hook_ns(_leaf)
+            results["native_trace_hook_uninstrumented_ns"] = _native_hook_ns(
+                _uninstrumented_leaf
+            )
+        finally:
+            tracehook.set_map_start(0)
+            del first_byte
+    return results
+
+
+def bench_rewrite(args):
+    codes = []
+    for module_name in REWRITE_CORPUS_MODULES:
+        module = importlib.import_module(module_name)
+        codes.append(compile(inspect.getsource(module), module.__file__, "exec"))
+
+    def code_size(code):
+        return len(code.co_code) + sum(
+            code_size(const) for const in code.co_consts if isinstance(const, type(code))
+        )
+    total_kb = sum(code_size(code) for code in codes) / 1024
+
+    results = {}
+    for name, kwargs in (
+        ("rewrite_us_per_kb", {}),
+        ("rewrite_block_ids_us_per_kb", {"block_ids": True}),
+    ):
+        def rewrite_all():
+            for code in codes:
+                rewriter.rewrite(sys.version_info[:2], dis, random.Random, code, **kwargs)
+
+        timer = timeit.Timer(rewrite_all)
+        number, _ = timer.autorange()
+        results[name] = min(timer.repeat(3, number)) * 1e6 / (number * total_kb)
+    return results
+
+
+def _execs_per_sec(driver, inputs, duration):
+    execs = 0
+    start = time.perf_counter()
+    while True:
+        for data in inputs:
+            driver.run(data)
+        execs += len(inputs)
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return execs / elapsed
+
+
+def bench_forkserver(args):
+    results = {}
+    for name, source in (
+        ("fork_exit_us", forkserver_target_source),
+        ("persistent_iteration_us", persistent_target_source),
+    ):
+        with Driver((sys.executable, "-c", source), quiet=True) as driver:
+            results[name] = 1e6 / _execs_per_sec(driver, (b"",), args.duration)
+    return results
+
+
+def bench_examples(args):
+    rng = random.Random(0)
+    inputs = [b""] + [
+        bytes(rng.getrandbits(8) for _ in range(length))
+        for length in (1, 16, 256, 4096)
+    ]
+
+    results = {}
+    for path in sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.py"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            driver = Driver((sys.executable, path), quiet=True)
+        except TargetStartError as e:
+            # most likely the package it targets isn't installed
+            print("{}: skipped ({})".format(name, e), file=sys.stderr)
+            continue
+        with driver:
+            results[name + "_execs_per_sec"] = _execs_per_sec(driver, inputs, args.duration)
+    return results
+
+
+BENCHMARKS = {
+    "hooks": bench_hooks,
+    "rewrite": bench_rewrite,
+    "forkserver": bench_forkserver,
+    "examples": bench_examples,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark cpytraceafl's hot paths")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare results against those in this file")
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=2.0,
+        help="seconds to spend on each execs/sec measurement",
+    )
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {!r}, choose from {}".format(
+                name,
+                ", ".join(BENCHMARKS),
+            ))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        for key, value in BENCHMARKS[name](args).items():
+            results[key] = value
+            line = "{}: {:.2f}".format(key, value)
+            if baseline.get(key):
+                line += " ({:+.1f}%)".format((value / baseline[key] - 1) * 100)
+            print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,12 +1,18 @@
+import atexit
 import ctypes
+import gc
+import importlib
+import marshal
 import os
 import signal
 import struct
 import sys
+import time
+import warnings
 
 import sysv_ipc
 
-from cpytraceafl import tracehook
+from cpytraceafl import postfork, tracehook
 
 
 # these values *must* agree with those set in afl's config.h, and also those used when compiling
@@ -14,9 +20,48 @@ from cpytraceafl import tracehook
 FORKSRV_FD = 198
 DEFAULT_MAP_SIZE_BITS = 16
 DEFAULT_SHM_ENV_VAR = "__AFL_SHM_ID"
+DEFAULT_SHM_FUZZ_ENV_VAR = "__AFL_SHM_FUZZ_ID"
+# *must* agree with CMPLOG_SHM_ENV_VAR in rewriter.py
+DEFAULT_CMPLOG_SHM_ENV_VAR = "__AFL_CMPLOG_SHM_ID"
+
+# AFL++ forkserver option flags, from afl's types.h
+FS_OPT_ENABLED = 0x80000001
+FS_OPT_MAPSIZE = 0x40000000
+FS_OPT_SHDMEM_FUZZ = 0x01000000
+FS_OPT_NEWCMPLOG = 0x02000000
+FS_OPT_AUTODICT = 0x10000000
+FS_OPT_MAX_MAPSIZE = (0x00fffffe >> 1) + 1
 
 MAP_SIZE_ENV_VAR = "AFL_MAP_SIZE"
 NGRAM_SIZE_ENV_VAR = "AFL_NGRAM_SIZE"
+# path of file to append summaries of post-fork import & compilation work to, if set
+POSTFORK_PROFILE_ENV_VAR = "CPYTRACEAFL_POSTFORK_PROFILE"
+# path of file to record exactly which instrumentation points are reached to, in place of
+# tracing to the map, if set
+BLOCK_COVERAGE_ENV_VAR = "CPYTRACEAFL_BLOCK_COVERAGE"
+# path of tcplistenfeeder.py's notification socket to tell of socket reads that would block,
+# if set
+READ_NOTIFY_ENV_VAR = "CPYTRACEAFL_READ_NOTIFY"
+
+# sys.monitoring tool identity used on python 3.12+ - we are, after all, a coverage tool
+MONITORING_TOOL_ID = 1
+MONITORING_TOOL_NAME = "cpytraceafl"
+
+# memoryview of AFL++'s shared memory testcase area, set if its use has been negotiated with
+# the fuzzer
+_testcase_shm_view = None
+
+# minimum interval between rewrites of forkserver's fault statistics file, in seconds
+FAULT_STATS_INTERVAL = 1.0
+# minimum interval between forkserver's checks for saturated code, in seconds
+SATURATION_CHECK_INTERVAL = 5.0
+# how long a hung child is given to dump its stacks before being stopped, in seconds
+HANG_DUMP_WAIT = 0.5
+# name of the file in the forkserver's triage_dir listing each slow or hung exec
+TRIAGE_LOG_NAME = "triage.log"
+
+# listening socket set by cpytraceafl.launcher when it is running the harness
+_launcher_listener = None
 
 
 def get_map_size_bits_env():
@@ -28,7 +73,32 @@ def get_map_size_bits_env():
         return map_size_bits
 
 
-def install_trace_hook(map_start_addr, map_size_bits=None, ngram_size=None):
+def install_trace_hook(
+    map_start_addr,
+    map_size_bits=None,
+    ngram_size=None,
+    native=True,
+    cmplog_map_start_addr=None,
+):
+    """
+        Point tracehook at AFL map at `map_start_addr` and start tracing the current thread.
+
+        If `cmplog_map_start_addr` is provided, operands of comparisons in code rewritten with
+        `cmplog` are logged to the AFL++ CmpLog map at this address. This is only possible for
+        python < 3.11, where it uses line tracing, so `native` has no effect on the backend
+        used there.
+
+        With `native` set, the trace hook is registered directly as a C-level trace function,
+        avoiding the overhead of cpython's python-callable trace machinery. Otherwise it is
+        installed through `sys.settrace`. Both should record identical map locations.
+
+        On python 3.12+, `native` instead registers a `sys.monitoring` tool receiving only
+        branch & jump events, which is considerably cheaper again. This records the subset of
+        locations which are entered through a branch or jump, so maps will differ from those
+        produced through `sys.settrace`. Note `sys.monitoring` is not confined to the current
+        thread, and that code objects of frames executing at the time of installation will
+        subsequently be excluded from tracing entirely.
+    """
     if map_size_bits is None:
         map_size_bits = get_map_size_bits_env() or DEFAULT_MAP_SIZE_BITS
     if ngram_size is None:
@@ -38,7 +108,30 @@ def install_trace_hook(map_start_addr, map_size_bits=None, ngram_size=None):
     tracehook.set_map_size_bits(map_size_bits)
     tracehook.set_ngram_size(ngram_size)
 
-    sys.settrace(tracehook.global_trace_hook)
+    if cmplog_map_start_addr is not None:
+        if hasattr(tracehook, "set_cmplog_map_start"):
+            tracehook.set_cmplog_map_start(cmplog_map_start_addr)
+        else:
+            warnings.warn("Comparison operand logging not supported on this python version")
+
+    if native and hasattr(sys, "monitoring"):
+        # sys.settrace doesn't trace frames which are already executing. we can't be quite so
+        # precise with sys.monitoring, but we can exclude these frames' code objects.
+        frame = sys._getframe()
+        while frame is not None:
+            tracehook.set_instrumented(frame.f_code, False)
+            frame = frame.f_back
+
+        monitoring = sys.monitoring
+        if monitoring.get_tool(MONITORING_TOOL_ID) != MONITORING_TOOL_NAME:
+            monitoring.use_tool_id(MONITORING_TOOL_ID, MONITORING_TOOL_NAME)
+        for event in (monitoring.events.BRANCH, monitoring.events.JUMP):
+            monitoring.register_callback(MONITORING_TOOL_ID, event, tracehook.monitoring_hook)
+        monitoring.set_events(MONITORING_TOOL_ID, monitoring.events.BRANCH | monitoring.events.JUMP)
+    elif native:
+        tracehook.set_native_trace_hook()
+    else:
+        sys.settrace(tracehook.global_trace_hook)
 
 
 def attach_afl_map_shm(shm_env_var=None):
@@ -48,6 +141,28 @@ def attach_afl_map_shm(shm_env_var=None):
     return shm
 
 
+def attach_afl_testcase_shm(shm_fuzz_env_var=None):
+    """
+        Attach to AFL++'s shared memory testcase area if the fuzzer has offered one, else
+        return None.
+    """
+    shm_fuzz_env_var = shm_fuzz_env_var or DEFAULT_SHM_FUZZ_ENV_VAR
+    if shm_fuzz_env_var not in os.environ:
+        return None
+    return sysv_ipc.attach(int(os.environ[shm_fuzz_env_var]), flags=sysv_ipc.SHM_RDONLY)
+
+
+def attach_afl_cmplog_shm(cmplog_shm_env_var=None):
+    """
+        Attach to AFL++'s CmpLog shared memory area if we've been started to collect
+        comparison operands, else return None.
+    """
+    cmplog_shm_env_var = cmplog_shm_env_var or DEFAULT_CMPLOG_SHM_ENV_VAR
+    if cmplog_shm_env_var not in os.environ:
+        return None
+    return sysv_ipc.attach(int(os.environ[cmplog_shm_env_var]))
+
+
 def cheap_excepthook(exc_class, exc, traceback):
     "An excepthook which won't waste any time rendering a traceback"
     sys.exit(99)
@@ -58,11 +173,243 @@ def crashing_excepthook(exc_class, exc, traceback):
     ctypes.memset(0, 1, 1)
 
 
-def forkserver(forksrv_read_fd=None, forksrv_write_fd=None):
+def write_afl_dictionary(path, tokens):
+    "Write bytes `tokens` to `path` in the format of an AFL (-x) dictionary file"
+    with open(path, "w") as f:
+        for i, token in enumerate(sorted(tokens)):
+            f.write('token_{}="{}"\n'.format(i, "".join(
+                chr(c) if 0x20 <= c < 0x7f and c not in b'"\\' else "\\x{:02x}".format(c)
+                for c in token
+            )))
+
+
+def freeze_heap():
+    """
+        Prepare the heap of a warmed-up process for forking. Garbage is collected, then any
+        surviving objects are moved to the cyclic garbage collector's "permanent generation"
+        (on python 3.7+), so that collections in forked children don't touch, and so copy,
+        the pages they occupy.
+    """
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def _describe_code(code):
+    # note the rewriter will have scrambled co_firstlineno
+    return "{} ({})".format(getattr(code, "co_qualname", code.co_name), code.co_filename)
+
+
+def _run_seeds(target, seed_paths):
+    for seed_path in seed_paths:
+        with open(seed_path, "rb") as f:
+            data = f.read()
+        try:
+            target(data)
+        except (Exception, SystemExit):
+            pass
+
+
+def warm_up(target, seed_paths, prime=True):
+    """
+        Call `target` with the contents of each of `seed_paths` in turn, priming any lazy
+        imports and caches it may use ahead of forking. Exceptions raised are ignored.
+
+        The seeds are then run again in a forked "probe" child, as the forkserver's children
+        would be, and a warning is issued for any modules imported and any code first
+        executed there, work which each real child would have to repeat. With `prime`, any
+        such modules are also imported in this process.
+
+        Returns the set of names of modules imported as a result.
+    """
+    seed_paths = list(seed_paths)
+    modules_before = set(sys.modules)
+
+    executed = set()
+    def profiler(frame, event, arg):
+        if event == "call":
+            executed.add(frame.f_code)
+
+    sys.setprofile(profiler)
+    try:
+        _run_seeds(target, seed_paths)
+    finally:
+        sys.setprofile(None)
+
+    modules_warmed = set(sys.modules)
+
+    read_fd, write_fd = os.pipe()
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+    probe_pid = os.fork()
+    if not probe_pid:
+        # we are the probe child
+        os.close(read_fd)
+        try:
+            first_executed = set()
+            def probe_profiler(frame, event, arg):
+                if event == "call" and frame.f_code not in executed:
+                    first_executed.add(_describe_code(frame.f_code))
+
+            sys.setprofile(probe_profiler)
+            try:
+                _run_seeds(target, seed_paths)
+            finally:
+                sys.setprofile(None)
+
+            with open(write_fd, "wb") as f:
+                f.write(marshal.dumps((
+                    sorted(set(sys.modules) - modules_warmed),
+                    sorted(first_executed),
+                )))
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with open(read_fd, "rb") as f:
+        report = f.read()
+    os.waitpid(probe_pid, 0)
+    post_fork_modules, post_fork_code = marshal.loads(report) if report else ((), ())
+
+    if post_fork_modules:
+        warnings.warn("Modules imported post-fork: {}".format(", ".join(post_fork_modules)))
+        if prime:
+            for name in post_fork_modules:
+                try:
+                    importlib.import_module(name)
+                except ImportError:
+                    pass
+    if post_fork_code:
+        warnings.warn("Code first executed post-fork: {}".format(", ".join(post_fork_code)))
+
+    return set(sys.modules) - modules_before
+
+
+def _write_fault_stats(path, execs, minor_faults):
+    # in the style of afl's fuzzer_stats
+    with open(path, "w") as f:
+        f.write("execs           : {}\n".format(execs))
+        f.write("minor_faults    : {}\n".format(minor_faults))
+        f.write("faults_per_exec : {:.2f}\n".format(minor_faults / execs if execs else 0))
+
+
+def _wait_child(pid, deadline):
+    # with SIGCHLD blocked, so that it remains pending for sigtimedwait to pick up. returns
+    # None if deadline passes first
+    while True:
+        waited_pid, status, rusage = os.wait4(pid, os.WUNTRACED | os.WNOHANG)
+        if waited_pid:
+            return status, rusage
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        signal.sigtimedwait((signal.SIGCHLD,), remaining)
+
+
+def _stop_hung_child(pid, stacks_fd):
+    # returns the status and rusage of the child if it finished after all (otherwise None,
+    # having left it stopped) and any stacks it dumped
+    result = stacks = None
+    if stacks_fd is not None:
+        os.lseek(stacks_fd, 0, os.SEEK_SET)
+        os.ftruncate(stacks_fd, 0)
+        os.kill(pid, signal.SIGALRM)
+        result = _wait_child(pid, time.monotonic() + HANG_DUMP_WAIT)
+
+        os.lseek(stacks_fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(stacks_fd, 0x10000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        stacks = b"".join(chunks)
+
+    if result is None:
+        os.kill(pid, signal.SIGSTOP)
+        result = os.wait4(pid, os.WUNTRACED)[1:]
+        if os.WIFSTOPPED(result[0]):
+            result = None
+    return result, stacks
+
+
+def _write_triage(triage_dir, name, elapsed, input_path=None, stacks=None):
+    # must be called before the fuzzer is told the exec is over and moves on to the next
+    # testcase
+    try:
+        data = read_input(input_path)
+    except (OSError, IndexError):
+        data = None
+    if data is not None:
+        with open(os.path.join(triage_dir, name + ".input"), "wb") as f:
+            f.write(data)
+    if stacks is not None:
+        with open(os.path.join(triage_dir, name + ".stacks"), "wb") as f:
+            f.write(stacks)
+    with open(os.path.join(triage_dir, TRIAGE_LOG_NAME), "a") as f:
+        f.write("{}\t{:.3f}\n".format(name, elapsed))
+
+
+def forkserver(
+    forksrv_read_fd=None,
+    forksrv_write_fd=None,
+    testcase_shm=None,
+    map_size_bits=None,
+    dictionary=None,
+    fault_stats_path=None,
+    saturation_threshold=None,
+    saturation_codes=None,
+    exec_timeout=None,
+    slow_threshold=None,
+    triage_dir=None,
+    input_path=None,
+):
     """
         Attempt to start forkserver for AFL, if successful, parent process will never
         return, child will return True. If not successful, parent will return False.
+
+        If `testcase_shm` is provided, an attempt will be made to negotiate delivery of
+        testcases through this AFL++ shared memory area, after which `read_input` will read
+        from it.
+
+        If `map_size_bits` is provided, the size of the map we will be using is advertised to
+        AFL++, allowing it to avoid processing any more of the map than necessary.
+
+        If `dictionary` is provided, its bytes tokens are offered to AFL++ as an
+        "autodictionary", as the runtime of LTO-instrumented targets would.
+
+        Children which stop themselves with SIGSTOP (see `fuzz_loop`) are considered to have
+        completed a persistent-mode iteration and will be resumed for the next testcase
+        rather than a new child being forked.
+
+        If `fault_stats_path` is provided, the number of minor page faults incurred by
+        children is periodically written to this file, giving an idea of how many pages of
+        the parent's heap each execution ends up copying.
+
+        If `saturation_threshold` is provided, children count visits to each instrumentation
+        point and code objects all of whose points have been visited this many times are
+        periodically de-instrumented (see `cpytraceafl.saturation`). The code objects
+        considered are `saturation_codes` if provided, otherwise those found by
+        `find_instrumented_code` at the first check.
+
+        If `exec_timeout` is provided, children which take longer than this many seconds
+        over an exec are stopped by the forkserver, then left for the fuzzer to time out and
+        kill, so that it classifies them as hangs and doesn't examine their partial traces
+        for new coverage. This should be set below the fuzzer's own timeout by more than
+        HANG_DUMP_WAIT. It buys no time back from hung execs, only spares the CPU they would
+        spend spinning. With `triage_dir` also provided, each hung child is first sent
+        SIGALRM, on which it dumps the stacks of all its threads using `faulthandler`, and
+        the testcase and dump are saved to this directory as hang-<exec number>.input and
+        .stacks.
+
+        If `slow_threshold` is provided, the testcases of execs which complete but take
+        longer than this many seconds are saved to `triage_dir` as slow-<exec number>.input.
+        All saved execs are listed in its TRIAGE_LOG_NAME file along with the time they took.
+        Testcases are read as `read_input` would, from `input_path` if not in shared memory.
     """
+    if slow_threshold is not None and triage_dir is None:
+        raise ValueError("slow_threshold requires triage_dir")
+
     forksrv_read_fd = forksrv_read_fd or FORKSRV_FD
     forksrv_write_fd = forksrv_write_fd or (forksrv_read_fd + 1)
 
@@ -73,35 +420,314 @@ def forkserver(forksrv_read_fd=None, forksrv_write_fd=None):
         # don't run a forkserver
         return False
 
-    # tell parent we're alive
-    forksrv_writer.write(b"\0" * 4)
+    options = 0
+    if map_size_bits is not None and (1<<map_size_bits) <= FS_OPT_MAX_MAPSIZE:
+        options |= FS_OPT_MAPSIZE | (((1<<map_size_bits) - 1) << 1)
+    if testcase_shm is not None:
+        options |= FS_OPT_SHDMEM_FUZZ
+    # each token prefixed by its length
+    autodict = b"".join(
+        bytes((len(token),)) + token for token in sorted(dictionary or ()) if 0 < len(token) < 0x100
+    )
+    if autodict:
+        options |= FS_OPT_AUTODICT
+    if options:
+        # as with AFL++'s own runtime, we set FS_OPT_NEWCMPLOG alongside any other options
+        # to prevent recent AFL++ versions rejecting us. with no options at all, we send
+        # the plain zero "hello" of the original AFL protocol.
+        options |= FS_OPT_ENABLED | FS_OPT_NEWCMPLOG
+
+    # tell parent we're alive, along with any options we'd like to use
+    forksrv_writer.write(struct.pack("I", options))
+
+    if options & (FS_OPT_SHDMEM_FUZZ | FS_OPT_AUTODICT):
+        # parent will confirm which options it has accepted
+        accepted_options, = struct.unpack("I", forksrv_reader.read(4))
+        if accepted_options & (FS_OPT_ENABLED | FS_OPT_SHDMEM_FUZZ) == (
+            FS_OPT_ENABLED | FS_OPT_SHDMEM_FUZZ
+        ):
+            global _testcase_shm_view
+            _testcase_shm_view = memoryview(testcase_shm)
+        if autodict and accepted_options & (FS_OPT_ENABLED | FS_OPT_AUTODICT) == (
+            FS_OPT_ENABLED | FS_OPT_AUTODICT
+        ):
+            forksrv_writer.write(struct.pack("I", len(autodict)) + autodict)
 
+    if saturation_threshold is not None:
+        from cpytraceafl import saturation
+        saturation.install_hit_counters(
+            map_size_bits or get_map_size_bits_env() or DEFAULT_MAP_SIZE_BITS
+        )
+
+    stacks_fd = None
+    parent_sigmask = None
+    if triage_dir is not None:
+        os.makedirs(triage_dir, exist_ok=True)
+    if exec_timeout is not None:
+        if triage_dir is not None:
+            import faulthandler
+            # an anonymous scratch file, its offset shared with all children
+            stacks_path = os.path.join(triage_dir, ".stacks-{}".format(os.getpid()))
+            stacks_fd = os.open(stacks_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.unlink(stacks_path)
+            # done here so that it's inherited by children at no cost to them. children carry
+            # on once they've dumped, until stopped.
+            faulthandler.register(signal.SIGALRM, file=stacks_fd, all_threads=True)
+        parent_sigmask = signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGCHLD,))
+
+    child_pid = None
+    child_stopped = False
+    # minor faults of the current child as of its last stop, for persistent mode
+    child_minor_faults = 0
+    execs = 0
+    minor_faults = 0
+    next_fault_stats_time = 0
+    # leave the first check until there's been a chance to count something
+    next_saturation_check_time = time.monotonic() + SATURATION_CHECK_INTERVAL
     while True:
-        # check parent is alive
-        forksrv_reader.read(4)
+        # check parent is alive, and whether it killed the last child
+        was_killed_bytes = forksrv_reader.read(4)
+        if len(was_killed_bytes) != 4:
+            # parent has gone away
+            if fault_stats_path is not None:
+                _write_fault_stats(fault_stats_path, execs, minor_faults)
+            os._exit(1)
+        was_killed, = struct.unpack("I", was_killed_bytes)
+
+        if child_stopped and was_killed:
+            # a stopped persistent-mode child has been killed by the parent and needs reaping
+            child_stopped = False
+            os.waitpid(child_pid, 0)
 
-        child_pid = os.fork()
+        if child_stopped:
+            # resume persistent-mode child for its next iteration
+            child_stopped = False
+            os.kill(child_pid, signal.SIGCONT)
+        else:
+            child_pid = os.fork()
+            child_minor_faults = 0
 
-        if not child_pid:
-            # we are the child
-            forksrv_reader.close()
-            forksrv_writer.close()
-            return True
+            if not child_pid:
+                # we are the child
+                forksrv_reader.close()
+                forksrv_writer.close()
+                if parent_sigmask is not None:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, parent_sigmask)
+                return True
 
         # we are the parent. continue in loop forever.
         forksrv_writer.write(struct.pack("I", child_pid))
-        _, child_exit_status = os.waitpid(child_pid, 0)
+        execs += 1
+        start_time = time.monotonic()
+        if exec_timeout is None:
+            result = os.wait4(child_pid, os.WUNTRACED)[1:]
+        else:
+            result = _wait_child(child_pid, start_time + exec_timeout)
+        elapsed = time.monotonic() - start_time
+        if result is None:
+            result, stacks = _stop_hung_child(child_pid, stacks_fd)
+            if result is None:
+                if triage_dir is not None:
+                    _write_triage(
+                        triage_dir,
+                        "hang-{:06d}".format(execs),
+                        elapsed,
+                        input_path,
+                        stacks,
+                    )
+                # reporting only what becomes of it once the fuzzer's timeout kills it
+                result = os.wait4(child_pid, 0)[1:]
+        elif slow_threshold is not None and elapsed >= slow_threshold:
+            _write_triage(triage_dir, "slow-{:06d}".format(execs), elapsed, input_path)
+        child_exit_status, child_rusage = result
+        child_stopped = os.WIFSTOPPED(child_exit_status)
         forksrv_writer.write(struct.pack("I", child_exit_status))
 
+        if fault_stats_path is not None:
+            # a stopped child's rusage is cumulative over its lifetime so far
+            minor_faults += child_rusage.ru_minflt - child_minor_faults
+            child_minor_faults = child_rusage.ru_minflt
+            now = time.monotonic()
+            if now >= next_fault_stats_time:
+                next_fault_stats_time = now + FAULT_STATS_INTERVAL
+                _write_fault_stats(fault_stats_path, execs, minor_faults)
 
-def fuzz_from_here(excepthook=cheap_excepthook):
+        if saturation_threshold is not None and time.monotonic() >= next_saturation_check_time:
+            saturation.deinstrument_saturated(saturation_threshold, saturation_codes)
+            # (so that the time taken by the check isn't included)
+            next_saturation_check_time = time.monotonic() + SATURATION_CHECK_INTERVAL
+
+
+def fuzz_from_here(
+    excepthook=cheap_excepthook,
+    dictionary=None,
+    freeze=False,
+    disable_gc=False,
+    fault_stats_path=None,
+    saturation_threshold=None,
+    exec_timeout=None,
+    slow_threshold=None,
+    triage_dir=None,
+    input_path=None,
+):
     """
         Shortcut to setup & start forkserver on parent process, Child processes will return
         from this function with tracing started. Will also install `excepthook` if provided.
+
+        If AFL++ has started us to collect comparison operands, these will be logged for
+        code rewritten with `cmplog` (see `install_rewriter`).
+
+        `dictionary`, a collection of bytes tokens such as that populated by `install_rewriter`,
+        is passed on to `forkserver`, as are `fault_stats_path`, `saturation_threshold`,
+        `exec_timeout`, `slow_threshold`, `triage_dir` and `input_path`.
+
+        With `freeze` set, the heap is prepared for forking using `freeze_heap`, reducing
+        the amount of copy-on-write each child has to do. Code objects to watch for
+        saturation are found before this, as frozen objects are invisible to the garbage
+        collector's object listings. `disable_gc` additionally disables
+        the cyclic garbage collector in children, which is only likely to be a good idea for
+        short-lived children.
+
+        When run under `cpytraceafl.launcher`'s "serve" mode, the AFL instances to fuzz for
+        are first waited for here, each receiving its own child of this process.
+
+        If the environment variable CPYTRACEAFL_POSTFORK_PROFILE is set, forked children
+        profile any importing or compilation they do (see `cpytraceafl.postfork`), appending
+        a summary to the file it names on exit.
+
+        If the environment variable CPYTRACEAFL_BLOCK_COVERAGE is set, forked children don't
+        trace to the map at all, instead recording the instrumentation points they reach to
+        the file it names (see `cpytraceafl.symbolize`).
+
+        If the environment variable CPYTRACEAFL_READ_NOTIFY is set, socket reads about to
+        block are announced to the tcplistenfeeder.py listening on the unix socket it names
+        (see `cpytraceafl.readnotify`).
     """
+    saturation_codes = None
+    if saturation_threshold is not None:
+        from cpytraceafl.saturation import find_instrumented_code
+        saturation_codes = find_instrumented_code()
+    if freeze:
+        freeze_heap()
+
+    if _launcher_listener is not None:
+        from cpytraceafl.launcher import serve_clients
+        serve_clients(_launcher_listener)
+
+    if os.environ.get(READ_NOTIFY_ENV_VAR):
+        from cpytraceafl.readnotify import install_read_notifier
+        install_read_notifier(os.environ[READ_NOTIFY_ENV_VAR])
+
+    map_size_bits = get_map_size_bits_env() or DEFAULT_MAP_SIZE_BITS
     shm = attach_afl_map_shm()
-    forked = forkserver()
-    install_trace_hook(shm.address)
+    cmplog_shm = attach_afl_cmplog_shm()
+    forked = forkserver(
+        testcase_shm=attach_afl_testcase_shm(),
+        map_size_bits=map_size_bits,
+        dictionary=dictionary,
+        fault_stats_path=fault_stats_path,
+        saturation_threshold=saturation_threshold,
+        saturation_codes=saturation_codes,
+        exec_timeout=exec_timeout,
+        slow_threshold=slow_threshold,
+        triage_dir=triage_dir,
+        input_path=input_path,
+    )
+    if disable_gc:
+        # only now, leaving the long-lived forkserver parent with a working collector
+        gc.disable()
+    if forked and os.environ.get(POSTFORK_PROFILE_ENV_VAR):
+        postfork.install_profiler(os.environ[POSTFORK_PROFILE_ENV_VAR])
+        atexit.register(postfork.write_summary)
+    if forked and os.environ.get(BLOCK_COVERAGE_ENV_VAR):
+        from cpytraceafl.symbolize import install_block_recorder
+        install_block_recorder(os.environ[BLOCK_COVERAGE_ENV_VAR])
+    else:
+        install_trace_hook(
+            shm.address,
+            map_size_bits=map_size_bits,
+            cmplog_map_start_addr=None if cmplog_shm is None else cmplog_shm.address,
+        )
     if excepthook:
         sys.excepthook = excepthook
     return forked
+
+
+@tracehook.exclude_from_tracing
+def read_input(input_path=None, zero_copy=False):
+    """
+        Read the current testcase, from AFL++'s shared memory testcase area if its use was
+        negotiated by the forkserver, otherwise from the file at `input_path`, defaulting to
+        the first program argument.
+
+        With `zero_copy`, a read-only memoryview onto the shared memory area is returned
+        instead of a bytes copy where possible. Its contents are only valid until the next
+        testcase is started.
+    """
+    if _testcase_shm_view is not None:
+        length, = struct.unpack_from("I", _testcase_shm_view)
+        view = _testcase_shm_view[4:4+length]
+        return view if zero_copy else view.tobytes()
+
+    with open(input_path or sys.argv[1], "rb") as f:
+        return f.read()
+
+
+@tracehook.exclude_from_tracing
+def fuzz_loop(
+    max_iterations=1000,
+    excepthook=cheap_excepthook,
+    input_path=None,
+    zero_copy=False,
+    dictionary=None,
+    freeze=False,
+    disable_gc=False,
+    fault_stats_path=None,
+    saturation_threshold=None,
+    exec_timeout=None,
+    slow_threshold=None,
+    triage_dir=None,
+):
+    """
+        Persistent-mode alternative to `fuzz_from_here`, a generator to be iterated over,
+        yielding the contents of the current testcase for each iteration, e.g.
+
+            for data in fuzz_loop():
+                function_under_test(data)
+
+        Each forked child will process up to `max_iterations` testcases before exiting and
+        being replaced by a fresh child. The code under test must be careful not to let
+        state persist between iterations that would affect the result of later iterations.
+
+        Input is obtained using `read_input`, to which `input_path` and `zero_copy` are
+        passed. If a forkserver couldn't be started, only a single iteration will be run.
+        `dictionary`, `freeze`, `disable_gc`, `fault_stats_path`, `saturation_threshold`,
+        `exec_timeout`, `slow_threshold`, `triage_dir` and `input_path` are passed to
+        `fuzz_from_here`.
+    """
+    forked = fuzz_from_here(
+        excepthook=excepthook,
+        dictionary=dictionary,
+        freeze=freeze,
+        disable_gc=disable_gc,
+        fault_stats_path=fault_stats_path,
+        saturation_threshold=saturation_threshold,
+        exec_timeout=exec_timeout,
+        slow_threshold=slow_threshold,
+        triage_dir=triage_dir,
+        input_path=input_path,
+    )
+
+    for i in range(max_iterations if forked else 1):
+        if i:
+            # summarize each persistent-mode iteration individually
+            postfork.write_summary()
+            # signal completion of the previous iteration to the forkserver, which will
+            # resume us when the next testcase is ready
+            os.kill(os.getpid(), signal.SIGSTOP)
+
+        data = read_input(input_path, zero_copy=zero_copy)
+
+        # don't let the trace of the previous iteration bleed into this one
+        tracehook.reset_prev_loc()
+        yield data
@@ -1,10 +1,18 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <frameobject.h>
+#if PY_VERSION_HEX < 0x030B0000
+#include <opcode.h>
+#endif
 
 #include "cpytraceafl.h"
 
 #define HASH_PRIME 0xedb6417b
 
+// set in the line numbers of code rewritten with block_ids, these line numbers being usable as
+// map locations verbatim. *must* agree with BLOCK_ID_LINENO_FLAG in rewriter.py
+#define BLOCK_ID_LINENO_FLAG 0x40000000U
+
 unsigned char afl_map_size_bits = 16;
 unsigned char afl_ngram_size = 0;
 
@@ -17,6 +25,159 @@ __thread afl_prev_loc_vector_t __afl_prev_loc;
 // needed by AFL++'s context sensitive coverage feature
 __thread uint32_t __afl_prev_ctx;
 
+// AFL++'s CmpLog map, per its cmplog.h (as of AFL++ 4.x). comparison sites are allotted a
+// row of CMP_MAP_H operand slots each, used as a ring buffer. "instruction" comparisons log
+// integer operands, "routine" comparisons log (up to 32 byte) buffers, squeezing half as many
+// of their larger operand slots into the same row.
+#define CMP_MAP_W 65536
+#define CMP_MAP_H 32
+#define CMP_MAP_RTN_H (CMP_MAP_H / 2)
+
+#define CMP_TYPE_INS 0
+#define CMP_TYPE_RTN 1
+
+// attribute flags for instruction comparisons
+#define CMP_IS_EQUAL 1
+#define CMP_IS_GREATER 2
+#define CMP_IS_LESSER 4
+
+#define CMPLOG_RTN_LEN_MAX 32
+
+typedef struct {
+    unsigned hits : 6;
+    unsigned shape : 5;
+    unsigned type : 1;
+    unsigned attribute : 4;
+} __attribute__((packed)) cmp_header_t;
+
+typedef struct {
+    uint64_t v0;
+    uint64_t v0_128;
+    uint64_t v0_256_0;
+    uint64_t v0_256_1;
+    uint64_t v1;
+    uint64_t v1_128;
+    uint64_t v1_256_0;
+    uint64_t v1_256_1;
+    uint8_t unused[8];
+} __attribute__((packed)) cmp_operands_t;
+
+typedef struct {
+    uint8_t v0[CMPLOG_RTN_LEN_MAX];
+    uint8_t v1[CMPLOG_RTN_LEN_MAX];
+    uint8_t v0_len;
+    uint8_t v1_len;
+    uint8_t unused[6];
+} __attribute__((packed)) cmpfn_operands_t;
+
+typedef struct {
+    cmp_header_t headers[CMP_MAP_W];
+    cmp_operands_t log[CMP_MAP_W][CMP_MAP_H];
+} cmp_map_t;
+
+#if PY_VERSION_HEX < 0x030B0000
+// NULL unless we're collecting comparison operands
+static cmp_map_t* cmplog_map = NULL;
+#endif
+
+// our own bound line_trace_hook, kept to save an attribute lookup on every basic block
+static PyObject* line_trace_hook = NULL;
+
+// saturating hit counts of each location (before combining with the previous location),
+// shared with the forkserver so that it can stop tracing code which has been exercised
+// enough. NULL unless in use.
+static uint16_t* hit_counts = NULL;
+
+#if PY_VERSION_HEX >= 0x030C0000
+// sys.monitoring.DISABLE, returned by our monitoring callbacks for locations we never want
+// to hear about again
+static PyObject* monitoring_disable = NULL;
+#endif
+
+// the table the rewriter uses to signal its intentions - lnotab became co_linetable in 3.10
+#if PY_VERSION_HEX >= 0x030A0000
+#define CODE_LINE_TABLE(code) ((code)->co_linetable)
+#define CODE_LINE_TABLE_ATTR "co_linetable"
+#else
+#define CODE_LINE_TABLE(code) ((code)->co_lnotab)
+#define CODE_LINE_TABLE_ATTR "co_lnotab"
+#endif
+
+// size in bytes of a (wordcode) instruction
+#define CODE_UNIT_SIZE 2
+
+// co_extra access graduated to the "unstable" api in 3.12
+#if PY_VERSION_HEX >= 0x030C0000
+#define code_get_extra PyUnstable_Code_GetExtra
+#define code_set_extra PyUnstable_Code_SetExtra
+#define eval_request_code_extra_index PyUnstable_Eval_RequestCodeExtraIndex
+#elif PY_VERSION_HEX >= 0x03060000
+#define code_get_extra _PyCode_GetExtra
+#define code_set_extra _PyCode_SetExtra
+#define eval_request_code_extra_index _PyEval_RequestCodeExtraIndex
+#endif
+
+// Frame accessors papering over the differences between versions. From 3.11 the frame
+// struct is opaque and we have to go through the API (or attributes) for everything.
+
+// returns a borrowed reference
+static inline PyCodeObject* frame_get_code(PyFrameObject* frame) {
+#if PY_VERSION_HEX >= 0x030B0000
+    PyCodeObject* code = PyFrame_GetCode(frame);
+    // the frame keeps its code object alive for us
+    Py_DECREF(code);
+    return code;
+#else
+    return frame->f_code;
+#endif
+}
+
+// bytecode offset of the current instruction, in bytes, as python's frame.f_lasti
+static inline int frame_get_lasti(PyFrameObject* frame) {
+#if PY_VERSION_HEX >= 0x030B0000
+    return PyFrame_GetLasti(frame);
+#elif PY_VERSION_HEX >= 0x030A0000
+    // 3.10 counts in code units internally
+    return frame->f_lasti < 0 ? -1 : frame->f_lasti * CODE_UNIT_SIZE;
+#else
+    return frame->f_lasti;
+#endif
+}
+
+// only valid during a trace callback, where ceval keeps f_lineno up to date for us, so
+// there's no need for any line table lookup
+static inline int frame_get_traced_lineno(PyFrameObject* frame) {
+#if PY_VERSION_HEX >= 0x030B0000
+    return PyFrame_GetLineNumber(frame);
+#else
+    return frame->f_lineno;
+#endif
+}
+
+#if PY_VERSION_HEX >= 0x03070000
+static inline int frame_set_trace_lines(PyFrameObject* frame, int value) {
+#if PY_VERSION_HEX >= 0x030B0000
+    return PyObject_SetAttrString((PyObject*)frame, "f_trace_lines", value ? Py_True : Py_False);
+#else
+    frame->f_trace_lines = value;
+    return 0;
+#endif
+}
+
+// returns -1 on error
+static inline int frame_get_trace_lines(PyFrameObject* frame) {
+#if PY_VERSION_HEX >= 0x030B0000
+    PyObject* value = PyObject_GetAttrString((PyObject*)frame, "f_trace_lines");
+    if (value == NULL) return -1;
+    int result = PyObject_IsTrue(value);
+    Py_DECREF(value);
+    return result;
+#else
+    return frame->f_trace_lines;
+#endif
+}
+#endif
+
 static PyObject * tracehook_set_map_start(PyObject *self, PyObject *args) {
     unsigned long long _afl_map_start;
 
@@ -53,6 +214,114 @@ static PyObject * tracehook_set_ngram_size(PyObject *self, PyObject *args) {
     return Py_None;
 }
 
+static PyObject * tracehook_set_hit_counts_start(PyObject *self, PyObject *args) {
+    unsigned long long _hit_counts_start;
+
+    if (!PyArg_ParseTuple(args, "K", &_hit_counts_start))
+        return NULL;
+
+    hit_counts = (uint16_t *) _hit_counts_start;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject * tracehook_reset_prev_loc(PyObject *self, PyObject *unused) {
+    memset(&__afl_prev_loc, 0, sizeof(__afl_prev_loc));
+    __afl_prev_ctx = 0;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+// Per-code-object information, computed the first time we see a code object called and
+// stored in the code object's co_extra scratch space so that deciding whether a frame is
+// of interest costs us little more than a pointer lookup.
+typedef struct {
+    // does this code object have a lnotab we're interested in tracing?
+    char instrumented;
+#if PY_VERSION_HEX >= 0x030C0000
+    // for the sys.monitoring backend: the line number beginning at each code unit, or -1 if
+    // a line doesn't begin there. lazily built.
+    int32_t* line_starts;
+    Py_ssize_t n_code_units;
+#endif
+} code_info_t;
+
+#if PY_VERSION_HEX >= 0x03060000
+static Py_ssize_t code_extra_index = -1;
+
+static void free_code_info(void* extra) {
+#if PY_VERSION_HEX >= 0x030C0000
+    PyMem_RawFree(((code_info_t*)extra)->line_starts);
+#endif
+    PyMem_RawFree(extra);
+}
+#endif
+
+static inline code_info_t* get_code_info(PyCodeObject* code) {
+#if PY_VERSION_HEX >= 0x03060000
+    void* extra = NULL;
+    if (code_get_extra((PyObject*)code, code_extra_index, &extra))
+        return NULL;
+    if (extra != NULL)
+        return (code_info_t*)extra;
+
+    code_info_t* code_info = PyMem_RawMalloc(sizeof(code_info_t));
+    if (code_info == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    // a blank lnotab is used by the rewriter to signal we don't want line tracing here
+    code_info->instrumented = PyBytes_GET_SIZE(CODE_LINE_TABLE(code)) > 0;
+#if PY_VERSION_HEX >= 0x030C0000
+    code_info->line_starts = NULL;
+    code_info->n_code_units = 0;
+#endif
+
+    if (code_set_extra((PyObject*)code, code_extra_index, code_info)) {
+        free_code_info(code_info);
+        return NULL;
+    }
+    return code_info;
+#else
+    // no co_extra available, so we have to make the decision every time
+    static code_info_t code_info;
+    code_info.instrumented = PyBytes_GET_SIZE(CODE_LINE_TABLE(code)) > 0;
+    return &code_info;
+#endif
+}
+
+static PyObject * tracehook_set_instrumented(PyObject *self, PyObject *args) {
+    PyCodeObject* code;
+    int instrumented;
+
+    if (!PyArg_ParseTuple(args, "O!p", &PyCode_Type, &code, &instrumented))
+        return NULL;
+
+    code_info_t* code_info = get_code_info(code);
+    if (code_info == NULL) return NULL;
+    // (without co_extra this will have no lasting effect)
+    code_info->instrumented = instrumented;
+
+#if PY_VERSION_HEX >= 0x030C0000
+    if (instrumented) {
+        // we may have previously told sys.monitoring not to bother us with this code
+        PyObject* monitoring = PySys_GetObject("monitoring");
+        if (monitoring == NULL) {
+            PyErr_SetString(PyExc_RuntimeError, "sys.monitoring unavailable");
+            return NULL;
+        }
+        PyObject* result = PyObject_CallMethod(monitoring, "restart_events", NULL);
+        if (result == NULL) return NULL;
+        Py_DECREF(result);
+    }
+#endif
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 static PyObject * tracehook_global_trace_hook(PyObject *self, PyObject *args) {
     PyObject* frame;
     char* event;
@@ -62,16 +331,25 @@ static PyObject * tracehook_global_trace_hook(PyObject *self, PyObject *args) {
         return NULL;
 
     if (!strcmp(event, "call")) {
-        PyObject* code = PyObject_GetAttrString(frame, "f_code");
-        if (code == NULL) return NULL;
-        PyObject* lnotab = PyObject_GetAttrString(code, "co_lnotab");
-        Py_DECREF(code);
-        if (lnotab == NULL) return NULL;
-        Py_ssize_t len = PyObject_Length(lnotab);
-        Py_DECREF(lnotab);
-        if (len > 0) {  // else this is not a function we're interested in
-            PyObject* line_trace_hook = PyObject_GetAttrString(self, "line_trace_hook");
-            if (line_trace_hook == NULL) return NULL;
+        int instrumented;
+        if (PyFrame_Check(frame)) {
+            code_info_t* code_info = get_code_info(frame_get_code((PyFrameObject*)frame));
+            if (code_info == NULL) return NULL;
+            instrumented = code_info->instrumented;
+        } else {
+            // slow path for frame-like objects
+            PyObject* code = PyObject_GetAttrString(frame, "f_code");
+            if (code == NULL) return NULL;
+            PyObject* lnotab = PyObject_GetAttrString(code, CODE_LINE_TABLE_ATTR);
+            Py_DECREF(code);
+            if (lnotab == NULL) return NULL;
+            Py_ssize_t len = PyObject_Length(lnotab);
+            Py_DECREF(lnotab);
+            if (len < 0) return NULL;
+            instrumented = len > 0;
+        }
+
+        if (instrumented) {  // else this is not a function we're interested in
             Py_INCREF(line_trace_hook);
             return line_trace_hook;
         }
@@ -81,12 +359,287 @@ static PyObject * tracehook_global_trace_hook(PyObject *self, PyObject *args) {
     return Py_None;
 }
 
+static inline uint32_t hash_lineno_lasti(uint32_t lineno, uint32_t bytecode_offset) {
+    if (!lineno)  // avoid zero multiplication
+        lineno = ~(uint32_t)0;
+    if (!bytecode_offset)  // avoid zero multiplication
+        bytecode_offset = ~(uint32_t)0;
+
+    // multiplicative hashing - the most significant bits of a modular multiplication are to
+    // be kept as "hash"
+    uint32_t state = HASH_PRIME;
+    state *= lineno;
+    state *= bytecode_offset;
+    return state;
+}
+
+static inline void record_block_loc(uint32_t this_loc) {
+    if (hit_counts != NULL) {
+        uint16_t* count = &hit_counts[this_loc & ((~(uint32_t)0) >> (32-afl_map_size_bits))];
+        if (*count != UINT16_MAX)
+            (*count)++;
+    }
+    cpytraceafl_record_loc(this_loc);
+}
+
+static inline void record_lineno_lasti(uint32_t lineno, uint32_t bytecode_offset) {
+    record_block_loc(hash_lineno_lasti(lineno, bytecode_offset) >> (32-afl_map_size_bits));
+}
+
+static inline int is_block_id(uint32_t lineno) {
+    return (lineno & BLOCK_ID_LINENO_FLAG) != 0;
+}
+
+#if PY_VERSION_HEX < 0x030B0000
+// CmpLog support is confined to versions where we're able to peek at a traced frame's value
+// stack, which ceval keeps up to date for us during "line" trace callbacks.
+
+static void cmplog_log_ins(uint32_t k, uint64_t v0, uint64_t v1, unsigned shape, unsigned attribute) {
+    // mirroring AFL++'s own __cmplog_ins_hook* functions
+    cmp_header_t* header = &cmplog_map->headers[k];
+    unsigned hits;
+    if (header->type != CMP_TYPE_INS) {
+        header->type = CMP_TYPE_INS;
+        header->hits = 1;
+        header->shape = shape;
+        hits = 0;
+    } else {
+        hits = header->hits;
+        header->hits = hits + 1;
+        if (header->shape < shape)
+            header->shape = shape;
+    }
+    header->attribute = attribute;
+
+    hits &= CMP_MAP_H - 1;
+    cmplog_map->log[k][hits].v0 = v0;
+    cmplog_map->log[k][hits].v1 = v1;
+}
+
+static void cmplog_log_rtn(uint32_t k, const void* v0, Py_ssize_t v0_len, const void* v1, Py_ssize_t v1_len) {
+    if (v0_len > CMPLOG_RTN_LEN_MAX) v0_len = CMPLOG_RTN_LEN_MAX;
+    if (v1_len > CMPLOG_RTN_LEN_MAX) v1_len = CMPLOG_RTN_LEN_MAX;
+    Py_ssize_t len = v0_len > v1_len ? v0_len : v1_len;
+    if (!len)
+        return;
+
+    // mirroring AFL++'s own __cmplog_rtn_hook* functions
+    cmp_header_t* header = &cmplog_map->headers[k];
+    unsigned hits;
+    if (header->type != CMP_TYPE_RTN) {
+        header->type = CMP_TYPE_RTN;
+        header->hits = 1;
+        header->shape = len - 1;
+        hits = 0;
+    } else {
+        hits = header->hits;
+        header->hits = hits + 1;
+        if (header->shape < len - 1)
+            header->shape = len - 1;
+    }
+
+    hits &= CMP_MAP_RTN_H - 1;
+    cmpfn_operands_t* operands = &((cmpfn_operands_t*)cmplog_map->log[k])[hits];
+    memset(operands, 0, sizeof(cmpfn_operands_t));
+    memcpy(operands->v0, v0, v0_len);
+    memcpy(operands->v1, v1, v1_len);
+    operands->v0_len = v0_len;
+    operands->v1_len = v1_len;
+}
+
+// returns 0 on success, -1 if value isn't representable as 64 bits, never raising
+static int cmplog_long_value(PyObject* obj, uint64_t* value) {
+    int overflow;
+    long long signed_value = PyLong_AsLongLongAndOverflow(obj, &overflow);
+    if (!overflow) {
+        if (signed_value == -1 && PyErr_Occurred()) {
+            PyErr_Clear();
+            return -1;
+        }
+        *value = (uint64_t)signed_value;
+        return 0;
+    }
+    if (overflow > 0) {
+        unsigned long long unsigned_value = PyLong_AsUnsignedLongLong(obj);
+        if (unsigned_value == (unsigned long long)-1 && PyErr_Occurred()) {
+            PyErr_Clear();
+            return -1;
+        }
+        *value = unsigned_value;
+        return 0;
+    }
+    return -1;
+}
+
+// AFL++'s "shape" of an integer comparison is its operand width in bytes, minus one
+static inline unsigned cmplog_int_shape(uint64_t value) {
+    if (value <= 0xff) return 0;
+    if (value <= 0xffff) return 1;
+    if (value <= 0xffffffff) return 3;
+    return 7;
+}
+
+// log a comparison between left & right if they're of types we know how to log. must not
+// raise or call back into python code, as we're in the middle of a trace callback.
+static void cmplog_log_pair(uint32_t k, PyObject* left, PyObject* right, unsigned attribute) {
+    if (PyLong_Check(left) && PyLong_Check(right)) {
+        uint64_t v0, v1;
+        if (cmplog_long_value(left, &v0) || cmplog_long_value(right, &v1))
+            return;
+        unsigned shape0 = cmplog_int_shape(v0), shape1 = cmplog_int_shape(v1);
+        cmplog_log_ins(k, v0, v1, shape0 > shape1 ? shape0 : shape1, attribute);
+    } else if (PyUnicode_Check(left) && PyUnicode_Check(right)) {
+        Py_ssize_t v0_len, v1_len;
+        const char* v0 = PyUnicode_AsUTF8AndSize(left, &v0_len);
+        const char* v1 = v0 == NULL ? NULL : PyUnicode_AsUTF8AndSize(right, &v1_len);
+        if (v1 == NULL) {
+            PyErr_Clear();
+            return;
+        }
+        cmplog_log_rtn(k, v0, v0_len, v1, v1_len);
+    } else if (PyObject_CheckBuffer(left) && PyObject_CheckBuffer(right)) {
+        // bytes, bytearrays, memoryviews...
+        Py_buffer v0, v1;
+        if (PyObject_GetBuffer(left, &v0, PyBUF_SIMPLE)) {
+            PyErr_Clear();
+            return;
+        }
+        if (PyObject_GetBuffer(right, &v1, PyBUF_SIMPLE)) {
+            PyErr_Clear();
+            PyBuffer_Release(&v0);
+            return;
+        }
+        cmplog_log_rtn(k, v0.buf, v0.len, v1.buf, v1.len);
+        PyBuffer_Release(&v1);
+        PyBuffer_Release(&v0);
+    }
+}
+
+// for "needle in haystack", log comparisons of needle against each member of a reasonably
+// small container, which is where we expect to find any magic values
+static void cmplog_log_contains(uint32_t k, PyObject* needle, PyObject* haystack) {
+    if (PyDict_Check(haystack)) {
+        if (PyDict_Size(haystack) > CMP_MAP_H)
+            return;
+        Py_ssize_t pos = 0;
+        PyObject* key;
+        PyObject* value;
+        while (PyDict_Next(haystack, &pos, &key, &value))
+            cmplog_log_pair(k, needle, key, CMP_IS_EQUAL);
+    } else if (PyTuple_Check(haystack) || PyList_Check(haystack)) {
+        if (PySequence_Fast_GET_SIZE(haystack) > CMP_MAP_H)
+            return;
+        for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(haystack); i++)
+            cmplog_log_pair(k, needle, PySequence_Fast_GET_ITEM(haystack, i), CMP_IS_EQUAL);
+    } else if (PyAnySet_Check(haystack)) {
+        if (PySet_GET_SIZE(haystack) > CMP_MAP_H)
+            return;
+        PyObject* iter = PyObject_GetIter(haystack);
+        if (iter == NULL) {
+            PyErr_Clear();
+            return;
+        }
+        PyObject* item;
+        while ((item = PyIter_Next(iter)) != NULL) {
+            cmplog_log_pair(k, needle, item, CMP_IS_EQUAL);
+            Py_DECREF(item);
+        }
+        Py_DECREF(iter);
+        PyErr_Clear();
+    }
+}
+
+// called for "line" events, which in cmplog-rewritten code may be about to execute a
+// comparison
+static void cmplog_record_frame(PyFrameObject* frame, uint32_t lineno) {
+    int lasti = frame_get_lasti(frame);
+    PyObject* co_code = frame->f_code->co_code;
+    if (lasti < 0 || lasti + 1 >= PyBytes_GET_SIZE(co_code))
+        return;
+    const unsigned char* instruction = (const unsigned char*)PyBytes_AS_STRING(co_code) + lasti;
+
+    int opcode = instruction[0];
+#ifdef CONTAINS_OP
+    if (opcode != COMPARE_OP && opcode != CONTAINS_OP)
+#else
+    if (opcode != COMPARE_OP)
+#endif
+        return;
+#if PY_VERSION_HEX >= 0x03060000
+    int oparg = instruction[1];
+#else
+    if (lasti + 2 >= PyBytes_GET_SIZE(co_code))
+        return;
+    int oparg = instruction[1] | (instruction[2] << 8);
+#endif
+
+#if PY_VERSION_HEX >= 0x030A0000
+    if (frame->f_stackdepth < 2)
+        return;
+    PyObject** stacktop = frame->f_valuestack + frame->f_stackdepth;
+#else
+    PyObject** stacktop = frame->f_stacktop;
+    if (stacktop == NULL || stacktop - frame->f_valuestack < 2)
+        return;
+#endif
+    PyObject* left = stacktop[-2];
+    PyObject* right = stacktop[-1];
+
+    uint32_t k = hash_lineno_lasti(lineno, (uint32_t)lasti) >> 16;
+
+#ifdef CONTAINS_OP
+    if (opcode == CONTAINS_OP) {
+        cmplog_log_contains(k, left, right);
+        return;
+    }
+#endif
+    switch (oparg) {
+        case Py_LT:
+            cmplog_log_pair(k, left, right, CMP_IS_LESSER);
+            break;
+        case Py_LE:
+            cmplog_log_pair(k, left, right, CMP_IS_LESSER | CMP_IS_EQUAL);
+            break;
+        case Py_EQ:
+        case Py_NE:
+            cmplog_log_pair(k, left, right, CMP_IS_EQUAL);
+            break;
+        case Py_GT:
+            cmplog_log_pair(k, left, right, CMP_IS_GREATER);
+            break;
+        case Py_GE:
+            cmplog_log_pair(k, left, right, CMP_IS_GREATER | CMP_IS_EQUAL);
+            break;
+#ifndef CONTAINS_OP
+        // before 3.9, COMPARE_OP's "in" and "not in"
+        case 6:
+        case 7:
+            cmplog_log_contains(k, left, right);
+            break;
+#endif
+    }
+}
+
+static PyObject * tracehook_set_cmplog_map_start(PyObject *self, PyObject *args) {
+    unsigned long long _cmplog_map_start;
+
+    if (!PyArg_ParseTuple(args, "K", &_cmplog_map_start))
+        return NULL;
+
+    cmplog_map = (cmp_map_t *) _cmplog_map_start;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+#endif
+
 static PyObject * tracehook_line_trace_hook(PyObject *self, PyObject *args) {
     PyObject* frame;
-    char* event;
+    PyObject* event;
     PyObject* arg;
 
-    if (!PyArg_ParseTuple(args, "OsO", &frame, &event, &arg))
+    // we have no use for the event name, so don't bother parsing it
+    if (!PyArg_UnpackTuple(args, "line_trace_hook", 3, 3, &frame, &event, &arg))
         return NULL;
 
     // In instrumented code objects, this number is effectively the current basic block number
@@ -94,35 +647,271 @@ static PyObject * tracehook_line_trace_hook(PyObject *self, PyObject *args) {
     // object). Previously we used the raw memory location of the code object for this, but
     // that has the potential to be chaotic if an execution path affects the order in which
     // various memory allocations are made.
-    PyObject* f_lineno = PyObject_GetAttrString(frame, "f_lineno");
-    if (f_lineno == NULL) return NULL;
-    uint32_t lineno = (uint32_t)PyLong_AsUnsignedLong(f_lineno);
-    Py_DECREF(f_lineno);
-
+    // If the code object was rewritten with block_ids, it is instead a precomputed map location
+    // which we can use as-is.
+    uint32_t lineno;
     // bytecode offset is also useful & consistent entropy - we'll have that too.
-    PyObject* f_lasti = PyObject_GetAttrString(frame, "f_lasti");
-    if (f_lasti == NULL) return NULL;
-    uint32_t bytecode_offset = (uint32_t)PyLong_AsUnsignedLong(f_lasti);
-    Py_DECREF(f_lasti);
+    uint32_t bytecode_offset;
 
-    if (!lineno)  // avoid zero multiplication
-        lineno = ~(uint32_t)0;
-    if (!bytecode_offset)  // avoid zero multiplication
-        bytecode_offset = ~(uint32_t)0;
+    if (PyFrame_Check(frame)) {
+        // fast path, reading values straight from the frame struct without allocating
+        lineno = (uint32_t)PyFrame_GetLineNumber((PyFrameObject*)frame);
+        if (is_block_id(lineno)) {
+            record_block_loc(lineno);
+        } else {
+            bytecode_offset = (uint32_t)frame_get_lasti((PyFrameObject*)frame);
+            record_lineno_lasti(lineno, bytecode_offset);
+        }
+#if PY_VERSION_HEX < 0x030B0000
+        // (only "line" events are guaranteed an up to date value stack)
+        if (
+            cmplog_map != NULL
+            && PyUnicode_Check(event)
+            && !PyUnicode_CompareWithASCIIString(event, "line")
+        )
+            cmplog_record_frame((PyFrameObject*)frame, lineno);
+#endif
+    } else {
+        // slow path for frame-like objects
+        PyObject* f_lineno = PyObject_GetAttrString(frame, "f_lineno");
+        if (f_lineno == NULL) return NULL;
+        lineno = (uint32_t)PyLong_AsUnsignedLong(f_lineno);
+        Py_DECREF(f_lineno);
 
-    // multiplicative hashing - keep most significant bits of a modular multiplication as "hash"
-    uint32_t state = HASH_PRIME;
-    state *= lineno;
-    state *= bytecode_offset;
+        if (is_block_id(lineno)) {
+            record_block_loc(lineno);
+        } else {
+            PyObject* f_lasti = PyObject_GetAttrString(frame, "f_lasti");
+            if (f_lasti == NULL) return NULL;
+            bytecode_offset = (uint32_t)PyLong_AsUnsignedLong(f_lasti);
+            Py_DECREF(f_lasti);
 
-    cpytraceafl_record_loc(state >> (32-afl_map_size_bits));
+            record_lineno_lasti(lineno, bytecode_offset);
+        }
+    }
 
-    PyObject* line_trace_hook = PyObject_GetAttrString(self, "line_trace_hook");
-    if (line_trace_hook == NULL) return NULL;
     Py_INCREF(line_trace_hook);
     return line_trace_hook;
 }
 
+static inline void record_traced_frame_loc(PyFrameObject* frame) {
+    uint32_t lineno = (uint32_t)frame_get_traced_lineno(frame);
+    if (is_block_id(lineno))
+        record_block_loc(lineno);
+    else
+        record_lineno_lasti(lineno, (uint32_t)frame_get_lasti(frame));
+}
+
+#if PY_VERSION_HEX >= 0x030B0000
+// whether tracehook_native_trace_hook should record a "line", "return" or "exception" event
+// in frame, -1 on error. from 3.11 uninstrumented frames aren't marked by the "call" event,
+// and f_trace_lines is only reachable through the (comparatively expensive) attribute, so we
+// avoid consulting it unless the code object is of interest. we won't be called for "line"
+// events with it unset anyway.
+static inline int frame_is_traced(PyFrameObject* frame, int what) {
+    code_info_t* code_info = get_code_info(frame_get_code(frame));
+    if (code_info == NULL)
+        return -1;
+    if (!code_info->instrumented)
+        return 0;
+    return what == PyTrace_LINE ? 1 : frame_get_trace_lines(frame);
+}
+#endif
+
+// A Py_tracefunc for use with PyEval_SetTrace, performing the equivalent of the
+// global_trace_hook/line_trace_hook pair without any python-level calling overhead. We have
+// to take care to replicate the behaviour of sys.settrace's trampoline: only frames which
+// have seen a "call" event deemed interesting should record locations, and these do so for
+// "line", "return" and "exception" events alike.
+static int tracehook_native_trace_hook(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg) {
+    switch (what) {
+        case PyTrace_CALL: {
+            PyCodeObject* code = frame_get_code(frame);
+            code_info_t* code_info = get_code_info(code);
+            if (code_info == NULL)
+                return -1;
+
+            if (!code_info->instrumented) {
+                // not a function we're interested in
+#if PY_VERSION_HEX >= 0x030B0000
+                // f_trace_lines is only reachable through the (comparatively expensive)
+                // attribute from 3.11, so rather than setting it for every call, leave the
+                // other events to check the code object for themselves
+                return 0;
+#elif PY_VERSION_HEX >= 0x03070000
+                // this will prevent cpython even calling us for "line" events in this frame
+                return frame_set_trace_lines(frame, 0);
+#endif
+            } else {
+#if PY_VERSION_HEX >= 0x030B0000
+                // a resumed generator frame may have been executing when tracing was started.
+                // any other frame is new, so already has f_trace_lines set.
+                if (code->co_flags & (CO_GENERATOR | CO_COROUTINE | CO_ASYNC_GENERATOR)) {
+                    int trace_lines = frame_get_trace_lines(frame);
+                    if (trace_lines == 0)
+                        return frame_set_trace_lines(frame, 1);
+                    if (trace_lines < 0)
+                        return -1;
+                }
+#elif PY_VERSION_HEX >= 0x03070000
+                // a resumed generator frame may have been executing when tracing was started
+                return frame_set_trace_lines(frame, 1);
+#else
+                // without f_trace_lines, we mark frames we're interested in with a non-NULL
+                // f_trace, which we otherwise have no use for
+                Py_INCREF(Py_None);
+                Py_XSETREF(frame->f_trace, Py_None);
+#endif
+            }
+            return 0;
+        }
+        case PyTrace_LINE:
+        case PyTrace_RETURN:
+        case PyTrace_EXCEPTION:
+#if PY_VERSION_HEX >= 0x030B0000
+            {
+                int traced = frame_is_traced(frame, what);
+                if (traced <= 0)
+                    return traced;
+            }
+#elif PY_VERSION_HEX >= 0x03070000
+            if (!frame->f_trace_lines)
+                return 0;
+#else
+            if (frame->f_trace == NULL)
+                return 0;
+#endif
+            // see tracehook_line_trace_hook for what these values represent
+            record_traced_frame_loc(frame);
+#if PY_VERSION_HEX < 0x030B0000
+            if (cmplog_map != NULL && what == PyTrace_LINE)
+                cmplog_record_frame(frame, (uint32_t)frame_get_traced_lineno(frame));
+#endif
+            return 0;
+        default:
+            return 0;
+    }
+}
+
+static PyObject * tracehook_set_native_trace_hook(PyObject *self, PyObject *unused) {
+#if PY_VERSION_HEX >= 0x030B0000
+    // sys.settrace doesn't trace frames which are already executing, so neither should we
+    PyFrameObject* frame = PyEval_GetFrame();
+    Py_XINCREF(frame);
+    while (frame != NULL) {
+        if (frame_set_trace_lines(frame, 0)) {
+            Py_DECREF(frame);
+            return NULL;
+        }
+        PyFrameObject* back = PyFrame_GetBack(frame);
+        Py_DECREF(frame);
+        frame = back;
+    }
+#elif PY_VERSION_HEX >= 0x03070000
+    // sys.settrace doesn't trace frames which are already executing, so neither should we
+    for (PyFrameObject* frame = PyEval_GetFrame(); frame != NULL; frame = frame->f_back) {
+        frame->f_trace_lines = 0;
+    }
+#endif
+    PyEval_SetTrace(tracehook_native_trace_hook, NULL);
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+#if PY_VERSION_HEX >= 0x030C0000
+static int build_line_starts(PyCodeObject* code, code_info_t* code_info) {
+    Py_ssize_t n_code_units = Py_SIZE(code);
+    int32_t* line_starts = PyMem_RawMalloc(sizeof(int32_t) * (n_code_units ? n_code_units : 1));
+    if (line_starts == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    for (Py_ssize_t i = 0; i < n_code_units; i++)
+        line_starts[i] = -1;
+
+    // this is only done once per code object, so we can afford to use the python-level
+    // co_lines() rather than decoding the location table ourselves
+    PyObject* lines = PyObject_CallMethod((PyObject*)code, "co_lines", NULL);
+    if (lines == NULL) goto error;
+    PyObject* iter = PyObject_GetIter(lines);
+    Py_DECREF(lines);
+    if (iter == NULL) goto error;
+
+    long prev_line = -1;
+    PyObject* item;
+    while ((item = PyIter_Next(iter)) != NULL) {
+        Py_ssize_t start, end;
+        PyObject* line;
+        if (!PyArg_ParseTuple(item, "nnO", &start, &end, &line)) {
+            Py_DECREF(item);
+            Py_DECREF(iter);
+            goto error;
+        }
+        long lineno = line == Py_None ? -1 : PyLong_AsLong(line);
+        Py_DECREF(item);
+        if (lineno == -1 && PyErr_Occurred()) {
+            Py_DECREF(iter);
+            goto error;
+        }
+
+        // as with line tracing, a location of interest is an instruction whose line differs
+        // from that of the preceding instruction
+        Py_ssize_t unit = start / CODE_UNIT_SIZE;
+        if (lineno != -1 && lineno != prev_line && end > start && unit < n_code_units)
+            line_starts[unit] = (int32_t)lineno;
+        prev_line = lineno;
+    }
+    Py_DECREF(iter);
+    if (PyErr_Occurred()) goto error;
+
+    code_info->line_starts = line_starts;
+    code_info->n_code_units = n_code_units;
+    return 0;
+
+error:
+    PyMem_RawFree(line_starts);
+    return -1;
+}
+
+// A sys.monitoring callback for BRANCH and JUMP events, taking the arguments (code,
+// instruction_offset, destination_offset). Rather than depending on cpython's line tracing
+// to tell us when a new "line" (basic block) of rewritten code has been entered, we check
+// the destination of each jump or branch against the line table ourselves, meaning we don't
+// get called at all for plain fall-through from one block to the next. Code objects we have
+// no interest in get DISABLEd, after which cpython won't call us for them again.
+static PyObject * tracehook_monitoring_hook(PyObject *self, PyObject *const *args, Py_ssize_t nargs) {
+    if (nargs != 3 || !PyCode_Check(args[0])) {
+        PyErr_SetString(PyExc_TypeError, "expected (code, instruction_offset, destination_offset)");
+        return NULL;
+    }
+    PyCodeObject* code = (PyCodeObject*)args[0];
+
+    code_info_t* code_info = get_code_info(code);
+    if (code_info == NULL) return NULL;
+    if (!code_info->instrumented)
+        return Py_NewRef(monitoring_disable);
+
+    if (code_info->line_starts == NULL && build_line_starts(code, code_info))
+        return NULL;
+
+    Py_ssize_t destination_offset = PyLong_AsSsize_t(args[2]);
+    if (destination_offset == -1 && PyErr_Occurred()) return NULL;
+
+    Py_ssize_t unit = destination_offset / CODE_UNIT_SIZE;
+    if (unit >= 0 && unit < code_info->n_code_units && code_info->line_starts[unit] != -1) {
+        // the same values line tracing would have given us on entering this block
+        uint32_t lineno = (uint32_t)code_info->line_starts[unit];
+        if (is_block_id(lineno))
+            record_block_loc(lineno);
+        else
+            record_lineno_lasti(lineno, (uint32_t)destination_offset);
+    }
+
+    Py_RETURN_NONE;
+}
+#endif
+
 static PyMethodDef TracehookMethods[] = {
     {
         "set_map_start",
@@ -142,6 +931,32 @@ static PyMethodDef TracehookMethods[] = {
         METH_VARARGS,
         "Set number of branches to remember, 0 to disable ngram mode"
     },
+#if PY_VERSION_HEX < 0x030B0000
+    {
+        "set_cmplog_map_start",
+        tracehook_set_cmplog_map_start,
+        METH_VARARGS,
+        "Set start address of AFL++ CmpLog shared memory region, 0 to disable"
+    },
+#endif
+    {
+        "set_hit_counts_start",
+        tracehook_set_hit_counts_start,
+        METH_VARARGS,
+        "Set start address of region of uint16 location hit counts to maintain, 0 to disable"
+    },
+    {
+        "reset_prev_loc",
+        tracehook_reset_prev_loc,
+        METH_NOARGS,
+        "Reset current thread's record of previously visited locations"
+    },
+    {
+        "set_instrumented",
+        tracehook_set_instrumented,
+        METH_VARARGS,
+        "Override whether frames of the given code object should be traced"
+    },
     {
         "global_trace_hook",
         tracehook_global_trace_hook,
@@ -154,6 +969,20 @@ static PyMethodDef TracehookMethods[] = {
         METH_VARARGS,
         "'line' tracehook callable, returned by global_trace_hook when appropriate"
     },
+    {
+        "set_native_trace_hook",
+        tracehook_set_native_trace_hook,
+        METH_NOARGS,
+        "Install native equivalent of global_trace_hook for current thread using PyEval_SetTrace"
+    },
+#if PY_VERSION_HEX >= 0x030C0000
+    {
+        "monitoring_hook",
+        (PyCFunction)(void(*)(void))tracehook_monitoring_hook,
+        METH_FASTCALL,
+        "sys.monitoring callback for BRANCH and JUMP events"
+    },
+#endif
     {NULL, NULL, 0, NULL}
 };
 
@@ -171,5 +1000,40 @@ static struct PyModuleDef tracehookmodule = {
 PyMODINIT_FUNC
 PyInit__tracehook(void)
 {
-    return PyModule_Create(&tracehookmodule);
+    PyObject* module = PyModule_Create(&tracehookmodule);
+    if (module == NULL) return NULL;
+
+#if PY_VERSION_HEX >= 0x03060000
+    if (code_extra_index == -1) {
+        code_extra_index = eval_request_code_extra_index(free_code_info);
+        if (code_extra_index == -1) {
+            Py_DECREF(module);
+            PyErr_SetString(PyExc_RuntimeError, "Unable to obtain co_extra index");
+            return NULL;
+        }
+    }
+#endif
+
+#if PY_VERSION_HEX >= 0x030C0000
+    if (monitoring_disable == NULL) {
+        PyObject* monitoring = PySys_GetObject("monitoring");
+        if (monitoring != NULL)
+            monitoring_disable = PyObject_GetAttrString(monitoring, "DISABLE");
+        if (monitoring_disable == NULL) {
+            Py_DECREF(module);
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_RuntimeError, "sys.monitoring unavailable");
+            return NULL;
+        }
+    }
+#endif
+
+    Py_CLEAR(line_trace_hook);
+    line_trace_hook = PyObject_GetAttrString(module, "line_trace_hook");
+    if (line_trace_hook == NULL) {
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    return module;
 }
@@ -0,0 +1,148 @@
+"""
+    Corpus minimization in the manner of afl-cmin, but streaming every input through a
+    single forkserver (see `cpytraceafl.driver`) rather than starting the target afresh for
+    each, e.g.
+
+        python -m cpytraceafl.cmin INPUT_DIR OUTPUT_DIR -- python harness.py @@
+
+    copies the smallest subset of the files in INPUT_DIR which together exhibit all the
+    coverage "tuples" (map location & bucketed hit count, as afl-showmap would report them)
+    of the whole to OUTPUT_DIR. Inputs which crash or time out are left out. Passing
+    `--maps MAPS_DIR` also writes an afl-showmap style tuple file for each input to
+    MAPS_DIR.
+"""
+import argparse
+import collections
+import os
+import re
+import shutil
+import sys
+
+from cpytraceafl import DEFAULT_MAP_SIZE_BITS
+from cpytraceafl.driver import Driver, TargetStartError, iter_corpus
+
+
+# maps hit counts to afl's buckets: 1, 2, 3, 4-7, 8-15, 16-31, 32-127 & 128+
+BUCKET_TABLE = bytes(
+    0 if count == 0
+    else count if count <= 2
+    else 3 if count == 3
+    else 4 if count <= 7
+    else 8 if count <= 15
+    else 16 if count <= 31
+    else 32 if count <= 127
+    else 128
+    for count in range(256)
+)
+
+_NONZERO_RE = re.compile(b"[^\x00]")
+
+
+def get_tuples(coverage):
+    """
+        Set of the (location, bucket) tuples exhibited by map `coverage`, each encoded as
+        an integer location * 256 + bucket
+    """
+    classified = coverage.translate(BUCKET_TABLE)
+    return frozenset(
+        (match.start() << 8) | classified[match.start()]
+        for match in _NONZERO_RE.finditer(classified)
+    )
+
+
+def write_showmap(path, tuples):
+    "Write `tuples` to `path` in the format of afl-showmap"
+    with open(path, "w") as f:
+        for tuple_ in sorted(tuples):
+            f.write("{:06d}:{}\n".format(tuple_ >> 8, tuple_ & 0xff))
+
+
+def minimize(candidates):
+    """
+        Given `candidates`, an iterable of (key, size, tuples), return the set of keys of a
+        small subset of candidates that between them cover all the tuples covered by
+        `candidates`. Uses the same greedy approach as afl-cmin: for each tuple, rarest
+        first, the smallest candidate exhibiting it is chosen unless it's already covered.
+    """
+    # smallest first, so the first candidate seen with each tuple is its best
+    candidates = sorted(candidates, key=lambda candidate: candidate[1])
+    best = {}
+    tuple_counts = collections.Counter()
+    for candidate in candidates:
+        tuple_counts.update(candidate[2])
+        for tuple_ in candidate[2]:
+            best.setdefault(tuple_, candidate)
+
+    chosen = set()
+    covered = set()
+    for tuple_, _ in sorted(tuple_counts.items(), key=lambda item: (item[1], item[0])):
+        if tuple_ not in covered:
+            key, _, tuples = best[tuple_]
+            chosen.add(key)
+            covered.update(tuples)
+    return chosen
+
+
+def main(argv):
+    separator = argv.index("--") if "--" in argv else len(argv)
+    parser = argparse.ArgumentParser(
+        prog="python -m cpytraceafl.cmin",
+        usage="%(prog)s [options] INPUT_DIR OUTPUT_DIR -- TARGET_COMMAND...",
+        description="Minimize a corpus, running inputs through a target's forkserver",
+    )
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--maps", metavar="MAPS_DIR", help="write afl-showmap tuple files here")
+    parser.add_argument("--map-size-bits", type=int, default=DEFAULT_MAP_SIZE_BITS)
+    parser.add_argument("--shm-fuzz", action="store_true", help="deliver inputs through shm")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds allowed per input")
+    args = parser.parse_args(argv[:separator])
+    target_args = argv[separator+1:]
+    if not target_args:
+        parser.error("no target command given")
+
+    for dir_path in (args.output_dir, args.maps):
+        if dir_path is not None:
+            os.makedirs(dir_path, exist_ok=True)
+
+    try:
+        driver = Driver(
+            target_args,
+            map_size_bits=args.map_size_bits,
+            shm_fuzz=args.shm_fuzz,
+            timeout=args.timeout,
+            quiet=True,
+        )
+    except TargetStartError as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+
+    candidates = []
+    n_inputs = 0
+    with driver:
+        for path, data in iter_corpus((args.input_dir,)):
+            n_inputs += 1
+            result = driver.run(data)
+            if os.WIFSIGNALED(result.status):
+                # crashed or timed out
+                continue
+            tuples = get_tuples(result.coverage)
+            candidates.append((path, len(data), tuples))
+            if args.maps is not None:
+                write_showmap(os.path.join(args.maps, os.path.basename(path)), tuples)
+
+    chosen = minimize(candidates)
+    for path in sorted(chosen):
+        shutil.copy(path, args.output_dir)
+
+    print("{} inputs ({} usable) minimized to {} covering {} tuples".format(
+        n_inputs,
+        len(candidates),
+        len(chosen),
+        len(set().union(*(tuples for _, _, tuples in candidates))),
+    ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
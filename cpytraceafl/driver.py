@@ -0,0 +1,337 @@
+"""
+    Stand-in for afl-fuzz's side of the forkserver protocol, for running inputs through a
+    target without AFL itself, e.g.
+
+        python -m cpytraceafl.driver CORPUS_DIR -- python harness.py @@
+
+    runs each file in CORPUS_DIR through harness.py's forkserver, reporting each input's
+    exit status, number of map locations covered and execution time, followed by totals.
+    As with afl-fuzz, "@@" in the target's arguments is replaced by the path of the current
+    input, which is otherwise appended to them.
+"""
+import argparse
+import collections
+import os
+import select
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import sysv_ipc
+
+from cpytraceafl import (
+    DEFAULT_MAP_SIZE_BITS,
+    DEFAULT_SHM_ENV_VAR,
+    DEFAULT_SHM_FUZZ_ENV_VAR,
+    FORKSRV_FD,
+    FS_OPT_AUTODICT,
+    FS_OPT_ENABLED,
+    FS_OPT_MAPSIZE,
+    FS_OPT_SHDMEM_FUZZ,
+    MAP_SIZE_ENV_VAR,
+)
+
+
+# size of testcase shared memory area, as used by AFL++
+TESTCASE_SHM_SIZE = 1<<20
+
+# maps every nonzero byte to 1, for merging coverage maps
+_NONZERO_TABLE = bytes((0,)) + bytes((1,)) * 255
+
+
+RunResult = collections.namedtuple("RunResult", ("pid", "status", "coverage", "elapsed"))
+RunResult.__doc__ = """
+    Outcome of running a single input: the child's `pid`, its wait `status` (which for a
+    persistent-mode child will be a stopped status), the `coverage` map it produced and
+    the `elapsed` seconds taken
+"""
+
+
+class TargetStartError(Exception):
+    pass
+
+
+class Driver:
+    """
+        Start target command `args` and drive its forkserver as afl-fuzz would. "@@" in
+        `args` is replaced by the path of the file inputs are written to, otherwise this path
+        is appended to `args`.
+
+        With `shm_fuzz`, testcases are offered to the target through shared memory instead.
+        Any runs taking longer than `timeout` seconds have their child killed. `env` replaces
+        the environment the target is started with. The target's stdout & stderr are
+        inherited unless `quiet` is set.
+    """
+    def __init__(
+        self,
+        args,
+        map_size_bits=DEFAULT_MAP_SIZE_BITS,
+        shm_fuzz=False,
+        timeout=None,
+        env=None,
+        quiet=False,
+    ):
+        self.timeout = timeout
+        self.map_size = 1<<map_size_bits
+        self.autodict = None
+        self.process = None
+        self.ctl_writer = self.st_reader = None
+        self.testcase_shm = None
+        self._child_killed = False
+        # a persistent-mode child left waiting for its next input
+        self._stopped_pid = None
+
+        self._work_dir = tempfile.mkdtemp(prefix="cpytraceafl-driver-")
+        self.shm = sysv_ipc.SharedMemory(None, size=self.map_size, flags=sysv_ipc.IPC_CREX)
+        try:
+            self.input_path = os.path.join(self._work_dir, "input")
+            env = dict(os.environ if env is None else env, **{
+                DEFAULT_SHM_ENV_VAR: str(self.shm.id),
+                MAP_SIZE_ENV_VAR: str(self.map_size),
+            })
+            if shm_fuzz:
+                self.testcase_shm = sysv_ipc.SharedMemory(
+                    None,
+                    size=TESTCASE_SHM_SIZE,
+                    flags=sysv_ipc.IPC_CREX,
+                )
+                env[DEFAULT_SHM_FUZZ_ENV_VAR] = str(self.testcase_shm.id)
+
+            args = tuple(args)
+            if "@@" in args:
+                args = tuple(self.input_path if arg == "@@" else arg for arg in args)
+            else:
+                args += (self.input_path,)
+
+            self._start(args, env, quiet)
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, args, env, quiet):
+        ctl_read_fd, ctl_write_fd = os.pipe()
+        st_read_fd, st_write_fd = os.pipe()
+        self.ctl_writer = open(ctl_write_fd, "wb", buffering=0)
+        self.st_reader = open(st_read_fd, "rb", buffering=0)
+
+        def remap_fds():
+            # in the child only, leaving alone any of our caller's fds with these numbers
+            st_fd = os.dup(st_write_fd) if st_write_fd == FORKSRV_FD else st_write_fd
+            os.dup2(ctl_read_fd, FORKSRV_FD)
+            os.dup2(st_fd, FORKSRV_FD+1)
+            for fd in (FORKSRV_FD, FORKSRV_FD+1):
+                os.set_inheritable(fd, True)
+
+        try:
+            self.process = subprocess.Popen(
+                args,
+                # close_fds would take the remapped fds with it. the pipes themselves, as
+                # with any other fds we create, aren't inheritable.
+                close_fds=False,
+                preexec_fn=remap_fds,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL if quiet else None,
+                stderr=subprocess.DEVNULL if quiet else None,
+            )
+        finally:
+            for fd in (ctl_read_fd, st_write_fd):
+                os.close(fd)
+
+        # hello
+        hello = self.st_reader.read(4)
+        if len(hello) != 4:
+            raise TargetStartError("Target exited without starting forkserver")
+        self.options, = struct.unpack("I", hello)
+
+        if self.options & FS_OPT_MAPSIZE:
+            # no need to look at any more of the map than the target will be using
+            self.map_size = min(self.map_size, ((self.options & 0x00fffffe) >> 1) + 1)
+
+        accepted_options = self.options & (FS_OPT_AUTODICT | (
+            FS_OPT_SHDMEM_FUZZ if self.testcase_shm is not None else 0
+        ))
+        if self.options & (FS_OPT_SHDMEM_FUZZ | FS_OPT_AUTODICT):
+            self.ctl_writer.write(struct.pack("I", FS_OPT_ENABLED | accepted_options))
+        if not accepted_options & FS_OPT_SHDMEM_FUZZ and self.testcase_shm is not None:
+            self.testcase_shm.detach()
+            self.testcase_shm.remove()
+            self.testcase_shm = None
+
+        if accepted_options & FS_OPT_AUTODICT:
+            length, = struct.unpack("I", self.st_reader.read(4))
+            data = self.st_reader.read(length)
+            self.autodict = set()
+            offset = 0
+            while offset < length:
+                self.autodict.add(data[offset+1:offset+1+data[offset]])
+                offset += 1 + data[offset]
+
+    def _read_status(self, deadline):
+        if deadline is not None:
+            readable, _, _ = select.select((self.st_reader,), (), (), max(
+                deadline - time.perf_counter(),
+                0,
+            ))
+            if not readable:
+                return None
+        status_bytes = self.st_reader.read(4)
+        if len(status_bytes) != 4:
+            raise EOFError("Forkserver went away")
+        return struct.unpack("I", status_bytes)[0]
+
+    def run(self, data):
+        "Run `data` through the target, returning a `RunResult`"
+        if self.testcase_shm is not None:
+            self.testcase_shm.write(struct.pack("I", len(data)) + data)
+        else:
+            with open(self.input_path, "wb") as f:
+                f.write(data)
+        self.shm.write(bytes(self.map_size))
+
+        start = time.perf_counter()
+        self.ctl_writer.write(struct.pack("I", self._child_killed))
+        self._child_killed = False
+        child_pid = self._read_status(None)
+        status = self._read_status(None if self.timeout is None else start + self.timeout)
+        if status is None:
+            # as afl-fuzz would, kill the child and let the forkserver report the result
+            try:
+                os.kill(child_pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._child_killed = True
+            status = self._read_status(None)
+        elapsed = time.perf_counter() - start
+        self._stopped_pid = child_pid if os.WIFSTOPPED(status) else None
+
+        return RunResult(child_pid, status, self.shm.read(self.map_size), elapsed)
+
+    def close(self):
+        "Shut down the target and release its resources"
+        if self._stopped_pid is not None:
+            # the forkserver won't clean this up for us
+            try:
+                os.kill(self._stopped_pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._stopped_pid = None
+        for f in (self.ctl_writer, self.st_reader):
+            if f is not None:
+                f.close()
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        for shm in (self.shm, self.testcase_shm):
+            if shm is not None:
+                shm.detach()
+                shm.remove()
+        self.shm = self.testcase_shm = None
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def count_covered(coverage):
+    "Number of locations covered in map `coverage`"
+    return len(coverage) - coverage.count(0)
+
+
+def merge_coverage(merged, coverage):
+    """
+        Merge map `coverage` into an integer summarizing previously-merged maps (start with
+        0), returning the result. The number of locations covered by the merged maps is its
+        number of set bits.
+    """
+    return merged | int.from_bytes(coverage.translate(_NONZERO_TABLE), "little")
+
+
+def describe_status(status):
+    if os.WIFSTOPPED(status):
+        return "stopped"
+    if os.WIFSIGNALED(status):
+        return "signal {}".format(os.WTERMSIG(status))
+    return "exit {}".format(os.WEXITSTATUS(status))
+
+
+def iter_corpus(paths):
+    "Yield (path, contents) for each file in `paths`, or directly within directories in `paths`"
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, name)
+                if os.path.isfile(file_path):
+                    with open(file_path, "rb") as f:
+                        yield file_path, f.read()
+        else:
+            with open(path, "rb") as f:
+                yield path, f.read()
+
+
+def main(argv):
+    separator = argv.index("--") if "--" in argv else len(argv)
+    parser = argparse.ArgumentParser(
+        prog="python -m cpytraceafl.driver",
+        usage="%(prog)s [options] CORPUS [CORPUS...] -- TARGET_COMMAND...",
+        description="Run inputs through a target's forkserver without afl-fuzz",
+    )
+    parser.add_argument("corpus", nargs="+", help="input files or directories of them")
+    parser.add_argument("--map-size-bits", type=int, default=DEFAULT_MAP_SIZE_BITS)
+    parser.add_argument("--shm-fuzz", action="store_true", help="deliver inputs through shm")
+    parser.add_argument("--timeout", type=float, help="seconds after which to kill a run")
+    parser.add_argument("--quiet", action="store_true", help="discard target output")
+    args = parser.parse_args(argv[:separator])
+    target_args = argv[separator+1:]
+    if not target_args:
+        parser.error("no target command given")
+
+    execs = 0
+    total_elapsed = 0.0
+    merged = 0
+    try:
+        driver = Driver(
+            target_args,
+            map_size_bits=args.map_size_bits,
+            shm_fuzz=args.shm_fuzz,
+            timeout=args.timeout,
+            quiet=args.quiet,
+        )
+    except TargetStartError as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+
+    with driver:
+        for path, data in iter_corpus(args.corpus):
+            result = driver.run(data)
+            execs += 1
+            total_elapsed += result.elapsed
+            merged = merge_coverage(merged, result.coverage)
+            print("{}\t{}\t{}\t{:.3f}ms".format(
+                path,
+                describe_status(result.status),
+                count_covered(result.coverage),
+                result.elapsed * 1000,
+            ))
+
+    print("{} execs, {} locations covered, {:.1f} execs/sec".format(
+        execs,
+        bin(merged).count("1"),
+        execs / total_elapsed if total_elapsed else 0,
+    ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,305 @@
+"""
+    In-process stand-in for tcplistenfeeder.py, for targets which connect out to a TCP server.
+    Once `install_fake_network` has been called (e.g. just before `fuzz_from_here` or
+    `fuzz_loop`, so that it's only done once, but after any warming up that needs the real
+    network), TCP connections made through `socket.socket.connect`,
+    `socket.create_connection` or asyncio's `create_connection` (and so `open_connection`)
+    never leave the process. Each is instead served the current testcase, split into chunks
+    at CHUNK_SEPARATOR, by a fake peer which delivers the next chunk as soon as the target
+    reads with nothing left to read, discarding anything the target sends. Once all chunks
+    have been delivered, the peer closes the connection.
+
+    Fake sockets don't become readable as far as `select` and friends are concerned, so
+    targets are expected to simply block on reading. For asyncio connections, which have no
+    such thing as a blocking read, each chunk is delivered one event loop iteration after
+    the previous one. asyncio must already have been imported when the fake network is
+    installed, and TLS isn't emulated: connections asking for it get plain data regardless.
+"""
+import socket
+import sys
+import weakref
+
+from cpytraceafl import read_input, tracehook
+
+
+# *must* agree with CHUNK_SEPARATOR in tcplistenfeeder.py
+CHUNK_SEPARATOR = b"\xde\xad\xbe\xef"
+
+_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+_get_input = None
+_ports = None
+# socket -> _FakeConnection of sockets "connected" to the fake peer
+_connections = None
+# (owner, name) -> attribute defined directly on owner (if any) of those replaced by
+# install_fake_network
+_originals = {}
+
+
+@tracehook.exclude_from_tracing
+class _FakeConnection:
+    def __init__(self, address, data):
+        self.address = address
+        self.chunks = data.split(CHUNK_SEPARATOR)
+        self.chunks.reverse()
+        self.buffer = bytearray()
+
+    def take(self, size=None, flags=0):
+        while not self.buffer and self.chunks:
+            # target would block, so it's the peer's turn
+            self.buffer += self.chunks.pop()
+        if size is None:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        if not flags & socket.MSG_PEEK:
+            del self.buffer[:size]
+        return data
+
+
+@tracehook.exclude_from_tracing
+def _is_faked(address):
+    return isinstance(address, tuple) and (_ports is None or address[1] in _ports)
+
+
+@tracehook.exclude_from_tracing
+def _fake_connect(self, address):
+    if self.family in _FAMILIES and self.type == socket.SOCK_STREAM and _is_faked(address):
+        _connections[self] = _FakeConnection(address, _get_input())
+        return True
+    return False
+
+
+@tracehook.exclude_from_tracing
+def _recv(connection, bufsize, flags=0):
+    return connection.take(bufsize, flags)
+
+
+@tracehook.exclude_from_tracing
+def _recv_into(connection, buffer, nbytes=0, flags=0):
+    buffer = memoryview(buffer).cast("B")
+    data = connection.take(nbytes or len(buffer), flags)
+    buffer[:len(data)] = data
+    return len(data)
+
+
+@tracehook.exclude_from_tracing
+def _recvfrom(connection, bufsize, flags=0):
+    return connection.take(bufsize, flags), connection.address
+
+
+@tracehook.exclude_from_tracing
+def _recvfrom_into(connection, buffer, nbytes=0, flags=0):
+    return _recv_into(connection, buffer, nbytes, flags), connection.address
+
+
+@tracehook.exclude_from_tracing
+def _send(connection, data, flags=0):
+    return len(memoryview(data).cast("B"))
+
+
+@tracehook.exclude_from_tracing
+def _sendall(connection, data, flags=0):
+    return None
+
+
+@tracehook.exclude_from_tracing
+def _getpeername(connection):
+    return connection.address
+
+
+@tracehook.exclude_from_tracing
+def _shutdown(connection, how):
+    return None
+
+
+# socket.socket method name -> implementation for fake connections
+_FAKE_METHODS = {
+    "recv": _recv,
+    "recv_into": _recv_into,
+    "recvfrom": _recvfrom,
+    "recvfrom_into": _recvfrom_into,
+    "send": _send,
+    "sendall": _sendall,
+    "getpeername": _getpeername,
+    "shutdown": _shutdown,
+}
+
+
+def _wrap_socket_method(method, fake_method):
+    @tracehook.exclude_from_tracing
+    def wrapper(self, *args, **kwargs):
+        connection = _connections.get(self)
+        if connection is None:
+            return method(self, *args, **kwargs)
+        return fake_method(connection, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _wrap_connect(method):
+    @tracehook.exclude_from_tracing
+    def connect(self, address):
+        if not _fake_connect(self, address):
+            return method(self, address)
+    return connect
+
+
+def _wrap_connect_ex(method):
+    @tracehook.exclude_from_tracing
+    def connect_ex(self, address):
+        if not _fake_connect(self, address):
+            return method(self, address)
+        return 0
+    return connect_ex
+
+
+def _wrap_close(method):
+    @tracehook.exclude_from_tracing
+    def close(self):
+        _connections.pop(self, None)
+        return method(self)
+    return close
+
+
+def _wrap_create_connection(function):
+    @tracehook.exclude_from_tracing
+    def create_connection(address, *args, **kwargs):
+        if not _is_faked(address):
+            return function(address, *args, **kwargs)
+        # sparing us any name resolution
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    create_connection.__doc__ = function.__doc__
+    return create_connection
+
+
+def _get_fake_transport_class(asyncio):
+    @tracehook.exclude_from_tracing
+    class _FakeTransport(asyncio.Transport):
+        def __init__(self, loop, protocol, address, data):
+            super().__init__({"peername": address})
+            self._loop = loop
+            self._protocol = protocol
+            self._connection = _FakeConnection(address, data)
+            self._closing = False
+            self._paused = False
+            loop.call_soon(protocol.connection_made, self)
+            loop.call_soon(self._deliver)
+
+        def _deliver(self):
+            if self._closing or self._paused:
+                return
+            data = self._connection.take()
+            if data:
+                self._protocol.data_received(data)
+                # giving the protocol an event loop iteration to act on it
+                self._loop.call_soon(self._deliver)
+            else:
+                self._protocol.eof_received()
+                self.close()
+
+        def pause_reading(self):
+            self._paused = True
+
+        def resume_reading(self):
+            if self._paused:
+                self._paused = False
+                self._loop.call_soon(self._deliver)
+
+        def is_reading(self):
+            return not (self._paused or self._closing)
+
+        def write(self, data):
+            pass
+
+        def write_eof(self):
+            pass
+
+        def can_write_eof(self):
+            return True
+
+        def get_write_buffer_size(self):
+            return 0
+
+        def is_closing(self):
+            return self._closing
+
+        def close(self):
+            if not self._closing:
+                self._closing = True
+                self._loop.call_soon(self._protocol.connection_lost, None)
+
+        def abort(self):
+            self.close()
+
+    return _FakeTransport
+
+
+def _wrap_loop_create_connection(method, transport_class):
+    @tracehook.exclude_from_tracing
+    async def create_connection(self, protocol_factory, host=None, port=None, **kwargs):
+        if kwargs.get("sock") is not None or not _is_faked((host, port)):
+            return await method(self, protocol_factory, host, port, **kwargs)
+        protocol = protocol_factory()
+        transport = transport_class(self, protocol, (host, port), _get_input())
+        return transport, protocol
+    create_connection.__doc__ = method.__doc__
+    return create_connection
+
+
+def _replace(owner, name, wrapper):
+    _originals[owner, name] = vars(owner).get(name)
+    setattr(owner, name, wrapper(getattr(owner, name)))
+
+
+def install_fake_network(get_input=read_input, ports=None):
+    """
+        Have TCP connections to any of `ports` (or to anywhere, if not provided) served by an
+        in-process fake peer (see module docstring), each new connection being served the
+        result of calling `get_input`.
+    """
+    global _get_input, _ports, _connections
+    if _connections is not None:
+        raise RuntimeError("Fake network already installed")
+
+    _get_input = get_input
+    _ports = None if ports is None else frozenset(ports)
+    _connections = weakref.WeakKeyDictionary()
+
+    for name, fake_method in _FAKE_METHODS.items():
+        _replace(
+            socket.socket,
+            name,
+            lambda method, fake_method=fake_method: _wrap_socket_method(method, fake_method),
+        )
+    _replace(socket.socket, "connect", _wrap_connect)
+    _replace(socket.socket, "connect_ex", _wrap_connect_ex)
+    _replace(socket.socket, "close", _wrap_close)
+    _replace(socket, "create_connection", _wrap_create_connection)
+
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is not None:
+        transport_class = _get_fake_transport_class(asyncio)
+        _replace(
+            asyncio.BaseEventLoop,
+            "create_connection",
+            lambda method: _wrap_loop_create_connection(method, transport_class),
+        )
+
+
+def uninstall_fake_network():
+    "Restore everything replaced by `install_fake_network`"
+    global _get_input, _ports, _connections
+    if _connections is None:
+        return
+
+    for (owner, name), value in _originals.items():
+        if value is None:
+            # was inherited
+            delattr(owner, name)
+        else:
+            setattr(owner, name, value)
+    _originals.clear()
+    _get_input = _ports = _connections = None
@@ -0,0 +1,178 @@
+"""
+    Launcher allowing many AFL instances to share a single warmed-up target process, e.g.
+
+        python -m cpytraceafl.launcher serve /tmp/target.sock harness.py [ARGS...]
+
+    runs harness.py, which should be written as any other target harness. Once it has done
+    its rewriting, importing and warming up and calls `fuzz_from_here` (or `fuzz_loop`), it
+    starts waiting for connections. Each AFL instance is then pointed at
+
+        python -m cpytraceafl.launcher connect /tmp/target.sock [ARGS...]
+
+    which hands its forkserver file descriptors, stdio, environment, working directory and
+    arguments over to the waiting process. This forks a child taking on these as its own,
+    which returns from `fuzz_from_here` to become that instance's forkserver. The warmed-up
+    heap is shared copy-on-write between all instances' forkservers.
+
+    The client process hangs around until its forkserver has exited, but resource limits
+    applied to it by AFL will not affect the forkserver.
+"""
+import marshal
+import os
+import runpy
+import signal
+import struct
+import sys
+
+# the plain C socket module avoids importing socket.py's dependencies before the harness has
+# had a chance to install the rewriter
+import _socket
+
+import cpytraceafl
+from cpytraceafl import FORKSRV_FD
+
+
+# file descriptors passed from client to server, in order
+_PASSED_FDS = (FORKSRV_FD, FORKSRV_FD+1, 0, 1, 2)
+
+# held by each forked child so that its client remains connected until all of its processes
+# have exited
+_client_connection = None
+
+
+def _recv_exactly(conn, length):
+    chunks = []
+    while length:
+        chunk = conn.recv(length)
+        if not chunk:
+            raise EOFError("Launcher connection closed prematurely")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+def _receive_client(conn):
+    # returns the client's passed file descriptors and its (environ, cwd, args)
+    fds = []
+    try:
+        header, ancdata, _, _ = conn.recvmsg(4, _socket.CMSG_LEN(4 * len(_PASSED_FDS)))
+        for level, type_, data in ancdata:
+            if level == _socket.SOL_SOCKET and type_ == _socket.SCM_RIGHTS:
+                fds.extend(struct.unpack("{}i".format(len(data) // 4), data))
+        if len(header) != 4 or len(fds) != len(_PASSED_FDS):
+            raise ValueError("Malformed launcher client request")
+        length, = struct.unpack("I", header)
+        return fds, marshal.loads(_recv_exactly(conn, length))
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def serve_clients(listener):
+    """
+        Accept connections from launcher clients on socket `listener` forever, forking a
+        child for each, which takes on the client's file descriptors, environment, working
+        directory and arguments. Only these children return.
+    """
+    # the forkservers are our children, but we have no interest in their exit status
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        # (the C socket's equivalent of accept())
+        conn_fd, _ = listener._accept()
+        conn = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM, 0, conn_fd)
+        try:
+            fds, (client_environ, client_cwd, client_args) = _receive_client(conn)
+        except (OSError, EOFError, ValueError, TypeError):
+            conn.close()
+            continue
+
+        if not os.fork():
+            # we are the child
+            listener.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd, target_fd in zip(fds, _PASSED_FDS):
+                os.dup2(fd, target_fd)
+            for fd in fds:
+                if fd not in _PASSED_FDS:
+                    os.close(fd)
+
+            os.environ.clear()
+            os.environ.update(client_environ)
+            os.chdir(client_cwd)
+            sys.argv[1:] = client_args
+
+            global _client_connection
+            _client_connection = conn
+            return
+
+        # we are the parent
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+
+def listen(socket_path):
+    "Create a listening launcher socket at `socket_path`, replacing any stale one"
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    listener = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    return listener
+
+
+def connect(socket_path, args):
+    """
+        Hand our forkserver file descriptors etc. over to the launcher server listening at
+        `socket_path` and wait for the resulting forkserver to exit.
+    """
+    for fd in _PASSED_FDS[:2]:
+        try:
+            os.fstat(fd)
+        except OSError:
+            sys.stderr.write("Launcher client must be run by AFL's forkserver\n")
+            return 2
+
+    conn = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    payload = marshal.dumps((dict(os.environ), os.getcwd(), list(args)))
+    conn.sendmsg(
+        (struct.pack("I", len(payload)),),
+        ((_socket.SOL_SOCKET, _socket.SCM_RIGHTS, struct.pack(
+            "{}i".format(len(_PASSED_FDS)),
+            *_PASSED_FDS
+        )),),
+    )
+    conn.sendall(payload)
+    for fd in _PASSED_FDS[:2]:
+        os.close(fd)
+
+    # the server side only closes once the forkserver and all its children have exited
+    while conn.recv(4096):
+        pass
+    return 0
+
+
+def main(argv):
+    usage = (
+        "usage: python -m cpytraceafl.launcher serve SOCKET_PATH SCRIPT [ARGS...]\n"
+        "       python -m cpytraceafl.launcher connect SOCKET_PATH [ARGS...]\n"
+    )
+    if len(argv) >= 3 and argv[0] == "serve":
+        cpytraceafl._launcher_listener = listen(argv[1])
+        sys.argv[:] = argv[2:]
+        runpy.run_path(argv[2], run_name="__main__")
+        return 0
+    if len(argv) >= 2 and argv[0] == "connect":
+        return connect(argv[1], argv[2:])
+
+    sys.stderr.write(usage)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
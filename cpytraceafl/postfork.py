@@ -0,0 +1,123 @@
+"""
+    Profiler for work being done in forked children which could have been done before
+    forking: imports of modules not already imported and compilation of code. Any such work
+    is repeated for every single exec.
+"""
+import builtins
+import os
+import sys
+import time
+
+import _frozen_importlib_external
+
+from cpytraceafl import tracehook
+
+
+# (kind, name) -> [count, total seconds] of work recorded since the last summary
+_records = {}
+_summary_path = None
+
+_original_import = None
+_original_compile = None
+_original_compile_bytecode = None
+
+
+@tracehook.exclude_from_tracing
+def _record(kind, name, elapsed):
+    record = _records.setdefault((kind, str(name)), [0, 0.0])
+    record[0] += 1
+    record[1] += elapsed
+
+
+@tracehook.exclude_from_tracing
+def _profiling_import(name, *args, **kwargs):
+    n_modules = len(sys.modules)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        # only imports which actually loaded something are of interest
+        if len(sys.modules) != n_modules:
+            _record("import", name, time.perf_counter() - start)
+
+
+@tracehook.exclude_from_tracing
+def _profiling_compile(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return _original_compile(*args, **kwargs)
+    finally:
+        filename = args[1] if len(args) >= 2 else kwargs.get("filename")
+        _record("compile", filename, time.perf_counter() - start)
+
+
+@tracehook.exclude_from_tracing
+def _profiling_compile_bytecode(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return _original_compile_bytecode(*args, **kwargs)
+    finally:
+        name = kwargs.get("bytecode_path") or kwargs.get("name") or (args[1:2] or (None,))[0]
+        _record("bytecode", name, time.perf_counter() - start)
+
+
+def install_profiler(summary_path):
+    """
+        Start counting & timing imports, calls to `compile` and loads of cached bytecode,
+        summaries of which will be appended to `summary_path` by `write_summary`. Should be
+        called after the rewriter has been installed, so that its wrappers are included.
+    """
+    global _summary_path, _original_import, _original_compile, _original_compile_bytecode
+    if _original_import is not None:
+        raise RuntimeError("Profiler already installed")
+
+    _summary_path = summary_path
+    _records.clear()
+
+    _original_import = builtins.__import__
+    builtins.__import__ = _profiling_import
+    _original_compile = builtins.compile
+    builtins.compile = _profiling_compile
+    _original_compile_bytecode = _frozen_importlib_external._compile_bytecode
+    _frozen_importlib_external._compile_bytecode = _profiling_compile_bytecode
+
+
+def uninstall_profiler():
+    "Restore everything wrapped by `install_profiler`, discarding any unwritten records"
+    global _original_import, _original_compile, _original_compile_bytecode
+    if _original_import is None:
+        return
+
+    builtins.__import__ = _original_import
+    builtins.compile = _original_compile
+    _frozen_importlib_external._compile_bytecode = _original_compile_bytecode
+    _original_import = _original_compile = _original_compile_bytecode = None
+    _records.clear()
+
+
+@tracehook.exclude_from_tracing
+def write_summary():
+    """
+        Append a summary of the work recorded since the last call to the summary file, if
+        there was any.
+    """
+    if not _records or _summary_path is None:
+        return
+
+    totals = {}
+    for (kind, _), (count, elapsed) in _records.items():
+        total = totals.setdefault(kind, [0, 0.0])
+        total[0] += count
+        total[1] += elapsed
+
+    lines = ["pid {}: {}".format(os.getpid(), ", ".join(
+        "{} {} ({:.3f}ms)".format(count, kind, elapsed * 1000)
+        for kind, (count, elapsed) in sorted(totals.items())
+    ))]
+    # most expensive first
+    for (kind, name), (count, elapsed) in sorted(_records.items(), key=lambda item: -item[1][1]):
+        lines.append("    {} {} x{} ({:.3f}ms)".format(kind, name, count, elapsed * 1000))
+    _records.clear()
+
+    with open(_summary_path, "a") as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,131 @@
+"""
+    Target-side counterpart to tcplistenfeeder.py's `--notify` option. Once installed, each
+    read of a blocking TCP socket which finds no data waiting first sends the socket's local
+    address to the feeder's notification socket, telling it the target has finished talking
+    and is ready for the next chunk of input. This saves the feeder having to wait out a
+    period of silence before each chunk. Notifications also carry the number of bytes read
+    from the socket so far, so that the feeder can tell a late notification, sent before
+    the previous chunk arrived, from one sent once the target has consumed it.
+
+    Only reads made through `socket.socket`'s recv methods (which include those made through
+    its `makefile` objects) are covered, not those of non-blocking sockets, such as asyncio
+    uses.
+"""
+import select
+import socket
+import weakref
+
+from cpytraceafl import tracehook
+
+
+@tracehook.exclude_from_tracing
+def _bytes_len(result):
+    return len(result)
+
+
+@tracehook.exclude_from_tracing
+def _count(result):
+    return result
+
+
+@tracehook.exclude_from_tracing
+def _from_len(result):
+    return len(result[0])
+
+
+@tracehook.exclude_from_tracing
+def _from_count(result):
+    return result[0]
+
+
+# name -> (index of flags among arguments, function giving the number of bytes read from the
+# method's return value)
+_READ_METHODS = {
+    "recv": (1, _bytes_len),
+    "recv_into": (2, _count),
+    "recvfrom": (1, _from_len),
+    "recvfrom_into": (2, _from_count),
+}
+_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+_notify_path = None
+_notify_socket = None
+# socket -> total bytes read from it
+_bytes_read = None
+# name -> method defined directly on socket.socket (if any) of those wrapped by
+# install_read_notifier
+_original_methods = {}
+
+
+@tracehook.exclude_from_tracing
+def _notify_if_blocking(sock):
+    if (
+        sock.family not in _FAMILIES
+        or sock.type != socket.SOCK_STREAM
+        or sock.gettimeout() == 0.0
+    ):
+        return
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    if poller.poll(0):
+        # won't block
+        return
+    host, port = sock.getsockname()[:2]
+    message = "{} {} {}".format(host, port, _bytes_read.get(sock, 0))
+    try:
+        _notify_socket.sendto(message.encode(), _notify_path)
+    except OSError:
+        # nobody listening
+        pass
+
+
+def _wrap_read_method(method, flags_index, get_length):
+    @tracehook.exclude_from_tracing
+    def notifying_read(self, *args, **kwargs):
+        _notify_if_blocking(self)
+        result = method(self, *args, **kwargs)
+        flags = args[flags_index] if len(args) > flags_index else kwargs.get("flags", 0)
+        if not flags & socket.MSG_PEEK:
+            _bytes_read[self] = _bytes_read.get(self, 0) + get_length(result)
+        return result
+    notifying_read.__name__ = method.__name__
+    notifying_read.__doc__ = method.__doc__
+    return notifying_read
+
+
+def install_read_notifier(notify_path):
+    """
+        Have reads of blocking TCP sockets which would block notify the feeder listening on
+        unix datagram socket `notify_path` beforehand
+    """
+    global _notify_path, _notify_socket, _bytes_read
+    if _notify_socket is not None:
+        raise RuntimeError("Read notifier already installed")
+
+    _notify_path = notify_path
+    _notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    _bytes_read = weakref.WeakKeyDictionary()
+    for name, (flags_index, get_length) in _READ_METHODS.items():
+        _original_methods[name] = socket.socket.__dict__.get(name)
+        setattr(socket.socket, name, _wrap_read_method(
+            getattr(socket.socket, name),
+            flags_index,
+            get_length,
+        ))
+
+
+def uninstall_read_notifier():
+    "Restore the methods wrapped by `install_read_notifier`"
+    global _notify_path, _notify_socket, _bytes_read
+    if _notify_socket is None:
+        return
+
+    for name, method in _original_methods.items():
+        if method is None:
+            # inherited from _socket.socket
+            delattr(socket.socket, name)
+        else:
+            setattr(socket.socket, name, method)
+    _original_methods.clear()
+    _notify_socket.close()
+    _notify_path = _notify_socket = _bytes_read = None
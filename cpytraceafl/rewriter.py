@@ -1,14 +1,192 @@
 INST_RATIO_PRECISION_BITS = 7
 
+# set in the co_firstlineno of code objects rewritten with `block_ids`, telling the tracehook
+# their line numbers are to be used as map locations verbatim. *must* agree with
+# BLOCK_ID_LINENO_FLAG in _tracehookmodule.c
+BLOCK_ID_LINENO_FLAG = 0x40000000
+# leaving plenty of headroom below the flag for the block ids themselves
+BLOCK_ID_BASE_MASK = 0x0fffffff
+
+
+# presence of this variable in the environment indicates we're being run by AFL++ to collect
+# comparison operands. *must* agree with DEFAULT_CMPLOG_SHM_ENV_VAR in __init__.py
+CMPLOG_SHM_ENV_VAR = "__AFL_CMPLOG_SHM_ID"
+
+
+# opcode-derived lookup tables used by rewrite(), built once per (python version, dis module)
+_opcode_tables = {}
+
+
+def has_line_table(python_version, code):
+    """
+        Whether `code` has a line number table. The rewriter blanks this for code objects it
+        hasn't selected for instrumentation, telling the tracehook to ignore them.
+    """
+    return bool(code.co_linetable if python_version[:2] >= (3, 10) else code.co_lnotab)
+
+
+def _get_opcode_tables(python_version, dis):
+    key = (tuple(python_version[:2]), dis)
+    tables = _opcode_tables.get(key)
+    if tables is None:
+        # opcodes after which we consider a new basic block to begin. these are (mostly
+        # conditional) jumps whose fall-through path we also want to distinguish, plus yields,
+        # after which execution resumes from who-knows-where.
+        delayed_flag_opcodes = frozenset(dis.opmap[m] for m in (
+            "YIELD_VALUE",
+            "YIELD_FROM",
+            "SEND",
+            "POP_JUMP_IF_TRUE",
+            "POP_JUMP_IF_FALSE",
+            "POP_JUMP_IF_NONE",
+            "POP_JUMP_IF_NOT_NONE",
+            "POP_JUMP_FORWARD_IF_TRUE",
+            "POP_JUMP_FORWARD_IF_FALSE",
+            "POP_JUMP_FORWARD_IF_NONE",
+            "POP_JUMP_FORWARD_IF_NOT_NONE",
+            "POP_JUMP_BACKWARD_IF_TRUE",
+            "POP_JUMP_BACKWARD_IF_FALSE",
+            "POP_JUMP_BACKWARD_IF_NONE",
+            "POP_JUMP_BACKWARD_IF_NOT_NONE",
+            "JUMP_IF_TRUE_OR_POP",
+            "JUMP_IF_FALSE_OR_POP",
+            "JUMP_IF_NOT_EXC_MATCH",
+        ) if m in dis.opmap)
+        jrel_opcodes = frozenset(dis.hasjrel)
+
+        # number of inline CACHE code units following each opcode (3.11+)
+        inline_cache_entries = getattr(dis, "_inline_cache_entries", ())
+        if isinstance(inline_cache_entries, dict):
+            # 3.13+ keys these by opname
+            cache_entries = tuple(inline_cache_entries.get(name, 0) for name in dis.opname[:256])
+        else:
+            cache_entries = tuple(inline_cache_entries[:256]) + (0,) * (256 - len(inline_cache_entries))
+
+        tables = _opcode_tables[key] = (
+            delayed_flag_opcodes,
+            jrel_opcodes,
+            frozenset(op for op in jrel_opcodes if "JUMP_BACKWARD" in dis.opname[op]),
+            frozenset(dis.hasjabs),
+            cache_entries,
+            # comparisons whose operands the tracehook can log in cmplog mode. before 3.9,
+            # COMPARE_OP also covered "in" and "is".
+            frozenset(dis.opmap[m] for m in ("COMPARE_OP", "CONTAINS_OP") if m in dis.opmap),
+        )
+    return tables
+
+
+# names of methods whose arguments are likely to be compared against some part of the input
+DICTIONARY_METHOD_NAMES = frozenset((
+    "startswith",
+    "endswith",
+    "find",
+    "rfind",
+    "index",
+    "rindex",
+    "count",
+    "split",
+    "rsplit",
+    "partition",
+    "rpartition",
+    "removeprefix",
+    "removesuffix",
+    "get",
+))
+# AFL's limit on dictionary token length, MAX_DICT_FILE
+DICTIONARY_TOKEN_MAX_LEN = 128
+
+
+# opcode-derived lookup tables used by collect_dictionary_tokens()
+_dictionary_opcode_tables = {}
+
+
+def _get_dictionary_opcode_tables(python_version, dis):
+    key = (tuple(python_version[:2]), dis)
+    tables = _dictionary_opcode_tables.get(key)
+    if tables is None:
+        opmap = dis.opmap
+        tables = _dictionary_opcode_tables[key] = (
+            opmap["LOAD_CONST"],
+            # opcodes looking up a method (or attribute) name
+            frozenset(opmap[m] for m in ("LOAD_METHOD", "LOAD_ATTR") if m in opmap),
+            # from 3.12, LOAD_ATTR does the job of LOAD_METHOD, its name index shifted left
+            opmap["LOAD_ATTR"] if python_version[:2] >= (3, 12) else None,
+            frozenset(opmap[m] for m in (
+                "CALL",
+                "CALL_KW",
+                "PRECALL",
+                "CALL_METHOD",
+                "CALL_FUNCTION",
+                "CALL_FUNCTION_KW",
+            ) if m in opmap),
+            # opcodes which consume constants in ways we're interested in
+            frozenset(opmap[m] for m in (
+                "COMPARE_OP",
+                "CONTAINS_OP",
+                "BINARY_SUBSCR",
+            ) if m in opmap),
+            # opcodes after which any constants loaded are considered to have been used for
+            # something else
+            frozenset(
+                op for name, op in opmap.items()
+                if name.startswith(("STORE_", "RETURN_", "POP_TOP", "POP_JUMP_", "JUMP_"))
+            ),
+        )
+    return tables
+
+
+def _encode_linetable(python_version, block_offsets, co_code_len):
+    """
+        Build a line table for a code object of `co_code_len` bytes, beginning a new "line"
+        at each of `block_offsets`, in the format used by cpython >= 3.10. Any code before
+        the first block retains the code object's co_firstlineno.
+    """
+    # (start offset, line delta) for each range
+    ranges = ([(0, 0)] if block_offsets[0] else []) + [(offset, 1) for offset in block_offsets]
+    ends = [start for start, _ in ranges[1:]] + [co_code_len]
+
+    table = bytearray()
+    if python_version[:2] < (3, 11):
+        # pairs of (unsigned byte offset delta, signed line delta), where a range longer than
+        # 254 bytes is continued by further pairs with a zero line delta
+        for (start, line_delta), end in zip(ranges, ends):
+            offset_delta = end - start
+            while offset_delta > 254:
+                table.append(254)
+                table.append(line_delta)
+                line_delta = 0
+                offset_delta -= 254
+            table.append(offset_delta)
+            table.append(line_delta)
+    else:
+        # "location" entries each covering up to 8 code units, of which we only use the
+        # "no column information" kind (code 13) carrying a signed varint line delta
+        for (start, line_delta), end in zip(ranges, ends):
+            units = (end - start) // 2
+            while units:
+                entry_units = min(units, 8)
+                table.append(0x80 | (13 << 3) | (entry_units - 1))
+                # zigzag-ish signed encoding, then little-endian 6-bit varint chunks
+                value = ((-line_delta) << 1) | 1 if line_delta < 0 else line_delta << 1
+                while value >= 0x40:
+                    table.append(0x40 | (value & 0x3f))
+                    value >>= 6
+                table.append(value)
+                line_delta = 0
+                units -= entry_units
+
+    return bytes(table)
+
 
 # here we rely on injected dependencies, the `dis` module and the class `ramdom.Random`,
 # because of the risk of recursion during import. we avoid module-level imports so we can
 # ensure we're only importing whatever's strictly necessary before the rewriter has been
 # installed
-def rewrite(python_version, dis, random_class, code, selector=True):
+def rewrite(python_version, dis, random_class, code, selector=True, block_ids=False, cmplog=False):
     code_type = type(code)
     consts = tuple(
-        rewrite(python_version, dis, random_class, const, selector) if isinstance(const, code_type) else const
+        rewrite(python_version, dis, random_class, const, selector, block_ids, cmplog)
+        if isinstance(const, code_type) else const
         for const in code.co_consts
     )
 
@@ -34,41 +212,127 @@ def rewrite(python_version, dis, random_class, code, selector=True):
         # tracing mechanism to call a tracehook in places we choose. in this case, we decide
         # to denote these "new lines" as starting at the beginning of "basic blocks", or at
         # least a rough approximation of basic blocks as far as they apply to the cpython vm.
-        delayed_flag_opcodes = tuple(dis.opmap[m] for m in (
-            "YIELD_VALUE",
-            "YIELD_FROM",
-            "POP_JUMP_IF_TRUE",
-            "POP_JUMP_IF_FALSE",
-            "JUMP_IF_TRUE_OR_POP",
-            "JUMP_IF_FALSE_OR_POP",
-        ))
+        (
+            delayed_flag_opcodes,
+            jrel_opcodes,
+            jrel_backward_opcodes,
+            jabs_opcodes,
+            cache_entries,
+            compare_opcodes,
+        ) = _get_opcode_tables(python_version, dis)
+        have_argument = dis.HAVE_ARGUMENT
+        extended_arg_opcode = dis.opmap["EXTENDED_ARG"]
+        wordcode = python_version[:2] >= (3, 6)
+        # from 3.10, jump arguments are expressed in code units rather than bytes
+        jump_arg_scale = 2 if python_version[:2] >= (3, 10) else 1
 
-        flagged_offsets = []
-        flag_next_instr = True
-        for instr in dis.Bytecode(code):
-            if flag_next_instr or instr.is_jump_target:
-                flagged_offsets.append(instr.offset)
+        # a single pass over the raw bytecode, avoiding the construction of dis.Instructions,
+        # collecting offsets of jump targets and instructions following a "delayed flag"
+        # opcode, along with the first instruction. the decoding of jump arguments here
+        # deliberately mirrors that of dis.findlabels for each version.
+        co_code = code.co_code
+        co_code_len = len(co_code)
+        flagged_offsets = {0}
+        # in cmplog mode, comparisons also begin a new "line" so that the tracehook gets to see
+        # them before they're executed, with their operands still on the value stack. these
+        # are exempt from instrumentation ratio selection.
+        compare_offsets = set()
+        offset = 0
+        extended_arg = 0
+        while offset < co_code_len:
+            opcode = co_code[offset]
+            if wordcode:
+                # skipping any inline CACHE entries following the instruction
+                next_offset = offset + 2 + 2*cache_entries[opcode]
+                if opcode >= have_argument:
+                    arg = co_code[offset+1] | extended_arg
+                    extended_arg = (arg << 8) if opcode == extended_arg_opcode else 0
+            elif opcode >= have_argument:
+                next_offset = offset + 3
+                arg = co_code[offset+1] | (co_code[offset+2] << 8)
+            else:
+                next_offset = offset + 1
 
-            flag_next_instr = instr.opcode in delayed_flag_opcodes
+            if opcode >= have_argument:
+                if opcode in jrel_opcodes:
+                    if opcode in jrel_backward_opcodes:
+                        flagged_offsets.add(next_offset - arg*jump_arg_scale)
+                    else:
+                        flagged_offsets.add(next_offset + arg*jump_arg_scale)
+                elif opcode in jabs_opcodes:
+                    flagged_offsets.add(arg*jump_arg_scale)
+            if opcode in delayed_flag_opcodes:
+                flagged_offsets.add(next_offset)
+            if cmplog and opcode in compare_opcodes:
+                compare_offsets.add(offset)
 
-        lnotab = b""
-        last_offset = 0
-
-        for offset in (
-            fo for fo in flagged_offsets
-            if inst_sel is True or inst_sel()
-        ):
-            offset_delta = offset - last_offset
-            lnotab = (
-                lnotab
-                + (b"\xff\x01" * (offset_delta // 0x100))
-                + bytes(((offset_delta % 0x100), 1,))
-            )
-            last_offset += offset_delta
+            offset = next_offset
+
+        # from 3.11, exception handlers are no longer the targets of jumps but are instead
+        # listed in the exception table. each entry is a run of four varints (big-endian
+        # 6-bit chunks): start, length, target and depth/lasti, of which we want the target.
+        exception_table = getattr(code, "co_exceptiontable", b"")
+        i = 0
+        field = 0
+        while i < len(exception_table):
+            value = exception_table[i] & 0x3f
+            while exception_table[i] & 0x40:
+                i += 1
+                value = (value << 6) | (exception_table[i] & 0x3f)
+            i += 1
+            if field == 2:
+                flagged_offsets.add(value * 2)
+            field = (field + 1) % 4
+
+        flagged_offsets |= compare_offsets
+
+        if python_version[:2] >= (3, 10):
+            block_offsets = [
+                offset for offset in sorted(flagged_offsets)
+                if offset < co_code_len and (
+                    inst_sel is True or offset in compare_offsets or inst_sel()
+                )
+            ]
+            # (an empty table signals the same as an empty lnotab below)
+            lnotab = _encode_linetable(python_version, block_offsets, co_code_len) if block_offsets else b""
+        else:
+            lnotab = bytearray()
+            last_offset = 0
+
+            for offset in sorted(flagged_offsets):
+                if offset >= co_code_len:
+                    break
+                if inst_sel is True or offset in compare_offsets or inst_sel():
+                    offset_delta = offset - last_offset
+                    lnotab.extend(b"\xff\x01" * (offset_delta // 0x100))
+                    lnotab.append(offset_delta % 0x100)
+                    lnotab.append(1)
+                    last_offset = offset
+
+            lnotab = bytes(lnotab)
     else:
-        # a blank lnotab signals to the trace hook that we don't want line tracing here
+        # a blank lnotab (or linetable) signals to the trace hook that we don't want line
+        # tracing here
         lnotab = b""
 
+    # construct co_firstlineno - this value effectively gets used as the "base hash" for
+    # the identity of instrumentation points in the code object. we mix in the original
+    # co_filename and co_firstlineno as these are not included in PyCodeObject's hash
+    # implementation and we want to reduce the possibility of aliases as much as possible.
+    # note the use of hash() here makes use of PYTHONHASHSEED critical when fuzzing
+    base_hash = abs(hash(code) ^ hash(code.co_filename) ^ code.co_firstlineno)
+    if block_ids:
+        # each basic block's "line number" is used directly as its map location, an id which
+        # is unique within this code object (map size permitting). the tracehook can skip any
+        # hashing of its own.
+        firstlineno = BLOCK_ID_LINENO_FLAG | (base_hash & BLOCK_ID_BASE_MASK)
+    else:
+        firstlineno = base_hash & 0xffff
+
+    if python_version[:2] >= (3, 10):
+        # the code constructor's signature is a moving target from here on
+        return code.replace(co_consts=consts, co_firstlineno=firstlineno, co_linetable=lnotab)
+
     code_args = (
         code.co_argcount,
     ) + (() if python_version[:2] < (3, 8) else (code.co_posonlyargcount,)) + (
@@ -82,12 +346,7 @@ def rewrite(python_version, dis, random_class, code, selector=True):
         code.co_varnames,
         code.co_filename,
         code.co_name,
-        # construct co_firstlineno - this value effectively gets used as the "base hash" for
-        # the identity of instrumentation points in the code object. we mix in the original
-        # co_filename and co_firstlineno as these are not included in PyCodeObject's hash
-        # implementation and we want to reduce the possibility of aliases as much as possible.
-        # note the use of hash() here makes use of PYTHONHASHSEED critical when fuzzing
-        abs(hash(code) ^ hash(code.co_filename) ^ code.co_firstlineno) & 0xffff,
+        firstlineno,
         lnotab,
         code.co_freevars,
         code.co_cellvars,
@@ -96,7 +355,190 @@ def rewrite(python_version, dis, random_class, code, selector=True):
     return code_type(*code_args)
 
 
-def install_rewriter(selector=None):
+def _iter_dictionary_tokens(value):
+    if isinstance(value, (tuple, frozenset)):
+        # e.g. `x in ("foo", "bar")` or `x.startswith((b"foo", b"bar"))`
+        for member in value:
+            yield from _iter_dictionary_tokens(member)
+    elif isinstance(value, str):
+        try:
+            yield from _iter_dictionary_tokens(value.encode("utf-8"))
+        except UnicodeEncodeError:
+            pass
+    elif isinstance(value, bytes):
+        # single bytes aren't going to be much help to the fuzzer
+        if 2 <= len(value) <= DICTIONARY_TOKEN_MAX_LEN:
+            yield value
+    elif isinstance(value, int) and not isinstance(value, bool):
+        # small integers are cheap enough for the fuzzer to find by itself, larger ones we
+        # provide in the byte orders they're likely to be unpacked from
+        if 0x100 <= abs(value) < (1<<63):
+            width = next(w for w in (2, 4, 8) if abs(value) < (1<<(8*w - 1)))
+            for byteorder in ("little", "big"):
+                yield value.to_bytes(width, byteorder, signed=True)
+
+
+def collect_dictionary_tokens(python_version, dis, code, tokens):
+    """
+        Add to set `tokens` the bytes of constants in (instrumented) code object `code` which
+        look like they could be magic values, being compared against, tested for containment,
+        used as subscripts or passed to methods such as `startswith`.
+
+        Only the bytecode & constants are inspected, which are left untouched by `rewrite`,
+        so this can be used on code objects before or after rewriting.
+    """
+    code_type = type(code)
+    for const in code.co_consts:
+        if isinstance(const, code_type):
+            collect_dictionary_tokens(python_version, dis, const, tokens)
+
+    # the rewriter blanks the line table of code objects it hasn't selected for
+    # instrumentation, which we take to mean they aren't of interest here either
+    if not has_line_table(python_version, code):
+        return
+
+    (
+        load_const_opcode,
+        load_attr_opcodes,
+        shifted_load_attr_opcode,
+        call_opcodes,
+        consuming_opcodes,
+        clearing_opcodes,
+    ) = _get_dictionary_opcode_tables(python_version, dis)
+    cache_entries = _get_opcode_tables(python_version, dis)[4]
+    have_argument = dis.HAVE_ARGUMENT
+    extended_arg_opcode = dis.opmap["EXTENDED_ARG"]
+    wordcode = python_version[:2] >= (3, 6)
+
+    # constants loaded since they were last consumed (or discarded)
+    pending = []
+    method_of_interest = False
+
+    co_code = code.co_code
+    co_code_len = len(co_code)
+    offset = 0
+    extended_arg = 0
+    arg = None
+    while offset < co_code_len:
+        opcode = co_code[offset]
+        if wordcode:
+            next_offset = offset + 2 + 2*cache_entries[opcode]
+            if opcode >= have_argument:
+                arg = co_code[offset+1] | extended_arg
+                extended_arg = (arg << 8) if opcode == extended_arg_opcode else 0
+        elif opcode >= have_argument:
+            next_offset = offset + 3
+            arg = co_code[offset+1] | (co_code[offset+2] << 8)
+        else:
+            next_offset = offset + 1
+
+        if opcode == load_const_opcode:
+            pending.append(code.co_consts[arg])
+        elif opcode in load_attr_opcodes:
+            name_index = arg >> 1 if opcode == shifted_load_attr_opcode else arg
+            if code.co_names[name_index] in DICTIONARY_METHOD_NAMES:
+                method_of_interest = True
+        elif opcode in call_opcodes:
+            if method_of_interest:
+                method_of_interest = False
+                for value in pending:
+                    tokens.update(_iter_dictionary_tokens(value))
+                pending = []
+        elif opcode in consuming_opcodes:
+            for value in pending:
+                tokens.update(_iter_dictionary_tokens(value))
+            pending = []
+        elif opcode in clearing_opcodes:
+            pending = []
+
+        offset = next_offset
+
+
+def block_starts(python_version, dis, code):
+    """
+        List of (offset, lineno, traced_offset) for each block of instrumented code object
+        `code` (not recursing into nested code), `offset` being where the block begins and
+        `traced_offset` the offset the tracehook will see on entering it through line tracing
+    """
+    # from 3.11, no line event is generated for the code object's RESUME (or anything
+    # preceding it), so the first block is first seen at the instruction following it
+    first_traced_offset = 0
+    if python_version[:2] >= (3, 11):
+        co_code = code.co_code
+        resume_opcode = dis.opmap["RESUME"]
+        # (none of the instructions which can precede RESUME have inline caches)
+        first_traced_offset = next(
+            (
+                offset + 2 for offset in range(0, len(co_code), 2)
+                if co_code[offset] == resume_opcode
+            ),
+            0,
+        )
+
+    end_for_opcode = dis.opmap["END_FOR"] if python_version[:2] == (3, 12) else None
+
+    starts = list(dis.findlinestarts(code))
+    blocks = []
+    for j, (offset, lineno) in enumerate(starts):
+        next_offset = starts[j+1][0] if j + 1 < len(starts) else None
+        traced_offset = offset
+        if offset < first_traced_offset and (next_offset is None or next_offset > first_traced_offset):
+            traced_offset = first_traced_offset
+        elif end_for_opcode is not None and code.co_code[offset] == end_for_opcode:
+            # 3.12's FOR_ITER skips its END_FOR when exhausted, END_FOR itself never being
+            # executed, so such a block is first seen at the following instruction
+            traced_offset += 2
+        blocks.append((offset, lineno, traced_offset))
+    return blocks
+
+
+def index_blocks(python_version, dis, original_code, rewritten_code, entries):
+    """
+        Append to list `entries` a tuple describing each instrumented code object in
+        `rewritten_code` (recursively), the result of rewriting `original_code`, of the form
+
+            (co_filename, co_name, co_firstlineno, original_firstlineno, blocks)
+
+        where `blocks` is a tuple of (lineno, offset, original_lineno) for each instrumentation
+        point, `lineno` and `offset` being the values the tracehook will see on entering it
+        and `original_lineno` the source line it starts on (which may be None).
+    """
+    code_type = type(rewritten_code)
+    for original_const, rewritten_const in zip(original_code.co_consts, rewritten_code.co_consts):
+        if isinstance(rewritten_const, code_type):
+            index_blocks(python_version, dis, original_const, rewritten_const, entries)
+
+    if not has_line_table(python_version, rewritten_code):
+        return
+
+    original_starts = list(dis.findlinestarts(original_code))
+    blocks = []
+    i = 0
+    original_lineno = None
+    for offset, lineno, traced_offset in block_starts(python_version, dis, rewritten_code):
+        # both sequences are in offset order
+        while i < len(original_starts) and original_starts[i][0] <= offset:
+            original_lineno = original_starts[i][1]
+            i += 1
+        blocks.append((lineno, traced_offset, original_lineno))
+
+    entries.append((
+        rewritten_code.co_filename,
+        rewritten_code.co_name,
+        rewritten_code.co_firstlineno,
+        original_code.co_firstlineno,
+        tuple(blocks),
+    ))
+
+
+def install_rewriter(
+    selector=None,
+    cache_tag=None,
+    block_ids=False,
+    cmplog=None,
+    dictionary=None,
+    index_path=None,
+):
     """
         Installs instrumenting bytecode rewriter.
 
@@ -120,8 +562,42 @@ def install_rewriter(selector=None):
         Alternatively `selector` can be set to one of the above values to act on all code
         objects with that behaviour equally.
 
+        `cpytraceafl.selector.Selector` builds a suitable callable from a list of rules
+        matching modules, packages and paths, for instance to exclude the standard library.
+
         The default, None, will attempt to read the environment variable AFL_INST_RATIO and
-        apply that behaviour to all code. Failing that, it'll instrument everything 100%.
+        apply that behaviour to all code. Failing that, it'll instrument everything 100%. If
+        the environment variable CPYTRACEAFL_SELECT is set, a `Selector` is built from the
+        rules it contains instead, with this as its default.
+
+        With `block_ids` set, each instrumented basic block is assigned a map location at
+        rewrite time, rather than the tracehook deriving one by hashing its line number and
+        bytecode offset. These are guaranteed not to collide with each other within a code
+        object (as long as it has fewer blocks than there are map locations) and are cheaper
+        for the tracehook to record.
+
+        With `cmplog` set, comparison operations additionally begin a new instrumentation
+        point, allowing the tracehook to log their operands for AFL++'s CmpLog ("redqueen")
+        input-to-state solving. The default, None, enables this only if the process has been
+        started by AFL++ to collect comparison operands, that is if __AFL_CMPLOG_SHM_ID is set.
+
+        If `dictionary` is provided, it should be a set to which likely "magic value" tokens
+        found in instrumented code will be added as bytes (see `collect_dictionary_tokens`),
+        for passing to the fuzzer through `fuzz_from_here` or `write_afl_dictionary`.
+
+        If `index_path` is provided, an index of the instrumentation points of all rewritten
+        code is written to this file (see `index_blocks`), as a stream of marshalled lists of
+        entries, for use by `cpytraceafl.symbolize`. Any existing file is overwritten.
+
+        Rewritten code for modules imported from source files is cached on disk in the
+        module's __pycache__ directory alongside the regular bytecode cache, under a name
+        including `cache_tag`, which should be a short string uniquely identifying the
+        behaviour of the rewriter. For non-callable `selector`s, this is derived from the
+        `selector` value if not provided. Callable `selector`s have to be accompanied by a
+        `cache_tag` for caching to be used, unless they have a `cache_tag` attribute of their
+        own. Setting `cache_tag` to False disables caching.
+        Because the instrumentation depends on the hash seed, caching is also only used when
+        PYTHONHASHSEED is set to a fixed value, this value also becoming part of the cache key.
     """
     # nested imports rather than module level imports to be as precise as possible about what
     # is needed for each function to operate. a module unnecessarily imported before the
@@ -130,14 +606,72 @@ def install_rewriter(selector=None):
     import functools
     import random
     import os
+    import marshal
     import _frozen_importlib_external
+    import _imp
     import builtins
+    import sys
     from sys import version_info
     from ast import PyCF_ONLY_AST
+    from cpytraceafl.version import __version__
 
     if selector is None:
+        from cpytraceafl.selector import selector_from_env
         afl_inst_ratio = os.environ.get("AFL_INST_RATIO")
         selector = int(afl_inst_ratio) if afl_inst_ratio else True
+        selector = selector_from_env(default=selector) or selector
+
+    if cache_tag is None:
+        # declarative selectors (see cpytraceafl.selector) come with their own
+        cache_tag = getattr(selector, "cache_tag", None) if callable(selector) else str(selector)
+    if cmplog is None:
+        cmplog = CMPLOG_SHM_ENV_VAR in os.environ
+
+    if cache_tag and block_ids:
+        cache_tag = "{}-ids".format(cache_tag)
+    if cache_tag and cmplog:
+        cache_tag = "{}-cmplog".format(cache_tag)
+    # the index entries are cached along with the code they describe
+    if cache_tag and index_path is not None:
+        cache_tag = "{}-index".format(cache_tag)
+    hash_seed = os.environ.get("PYTHONHASHSEED", "random")
+
+    class CodeSeededRandom(random.Random):
+        # seeding from arbitrary hashable objects (such as code objects) is no longer allowed
+        # from python 3.11, so do what older versions would have done with them ourselves
+        def seed(self, a=None, version=2):
+            if a is not None and not isinstance(a, (int, float, str, bytes, bytearray)):
+                a = hash(a) & ((1 << sys.hash_info.width) - 1)
+            super().seed(a, version)
+
+    index_file = None if index_path is None else open(index_path, "wb")
+    # index entries for the most recent call to rewrite_and_collect, for the cache to store
+    last_index_entries = []
+
+    def collect(code, index_entries):
+        if dictionary is not None:
+            collect_dictionary_tokens(version_info, dis, code, dictionary)
+        if index_entries:
+            marshal.dump(index_entries, index_file)
+            index_file.flush()
+        return code
+
+    def rewrite_and_collect(original_code):
+        code = rewrite(
+            version_info,
+            dis,
+            CodeSeededRandom,
+            original_code,
+            selector,
+            block_ids,
+            cmplog,
+        )
+        index_entries = None
+        if index_file is not None:
+            index_entries = []
+            index_blocks(version_info, dis, original_code, code, index_entries)
+            last_index_entries[:] = index_entries
+        return collect(code, index_entries)
 
     original_compile = builtins.compile
 
@@ -155,11 +689,74 @@ def install_rewriter(selector=None):
         original_retval = original_compile(*args, **kwargs)
         if flags & PyCF_ONLY_AST:
             return original_retval
-        return rewrite(version_info, dis, random.Random, original_retval, selector)
+        return rewrite_and_collect(original_retval)
     builtins.compile = rewriting_compile
 
     original_compile_bytecode = _frozen_importlib_external._compile_bytecode
     @functools.wraps(original_compile_bytecode)
     def rewriting_compile_bytecode(*args, **kwargs):
-        return rewrite(version_info, dis, random.Random, original_compile_bytecode(*args, **kwargs), selector)
+        return rewrite_and_collect(original_compile_bytecode(*args, **kwargs))
     _frozen_importlib_external._compile_bytecode = rewriting_compile_bytecode
+
+    if not cache_tag or hash_seed == "random" or not hasattr(_imp, "source_hash"):
+        return
+
+    original_get_code = _frozen_importlib_external.SourceLoader.get_code
+    @functools.wraps(original_get_code)
+    def caching_get_code(self, fullname):
+        try:
+            source_path = self.get_filename(fullname)
+            # e.g. __pycache__/foo.cpython-38.cpytraceafl-100-0.pyc
+            cache_path = "{}.cpytraceafl-{}-{}.pyc".format(
+                _frozen_importlib_external.cache_from_source(source_path)[:-len(".pyc")],
+                cache_tag,
+                hash_seed,
+            )
+            source_bytes = self.get_data(source_path)
+        except (ImportError, OSError, NotImplementedError):
+            return original_get_code(self, fullname)
+
+        cache_key = (
+            __version__,
+            cache_tag,
+            hash_seed,
+            _imp.source_hash(_frozen_importlib_external._RAW_MAGIC_NUMBER, source_bytes),
+        )
+
+        try:
+            data = self.get_data(cache_path)
+        except OSError:
+            pass
+        else:
+            magic = _frozen_importlib_external.MAGIC_NUMBER
+            if data[:len(magic)] == magic:
+                try:
+                    cached_key, code, *cached_index_entries = marshal.loads(
+                        memoryview(data)[len(magic):]
+                    )
+                except (EOFError, ValueError, TypeError):
+                    pass
+                else:
+                    if cached_key == cache_key:
+                        return collect(code, cached_index_entries and cached_index_entries[0])
+
+        # compiling straight from source (via rewriting_compile), rather than through
+        # original_get_code, avoids the possibility of picking up an already-rewritten code
+        # object from the regular bytecode cache and rewriting it a second time
+        last_index_entries.clear()
+        code = self.source_to_code(source_bytes, source_path)
+        cached = (cache_key, code)
+        if index_file is not None:
+            cached += (list(last_index_entries),)
+
+        if not sys.dont_write_bytecode:
+            try:
+                self._cache_bytecode(
+                    source_path,
+                    cache_path,
+                    _frozen_importlib_external.MAGIC_NUMBER + marshal.dumps(cached),
+                )
+            except (AttributeError, NotImplementedError):
+                pass
+        return code
+    _frozen_importlib_external.SourceLoader.get_code = caching_get_code
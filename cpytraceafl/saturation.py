@@ -0,0 +1,157 @@
+"""
+    De-instrumentation of code which has been exercised so thoroughly that tracing it is
+    unlikely to tell AFL anything new. With hit counters installed, the tracehook counts
+    visits to each instrumentation point in memory shared between the forkserver and its
+    children (see `forkserver`'s `saturation_threshold`). Every so often the forkserver
+    marks code objects all of whose instrumentation points have been visited at least the
+    threshold number of times as uninstrumented, which all subsequently forked children
+    inherit.
+
+    Counts are kept per (pre-combination) map location, so collisions can have an
+    instrumentation point appear to have been visited more than it really has. With the
+    sys.monitoring backend of python 3.12+, which only sees blocks entered through a branch
+    or jump, only these blocks are counted and considered.
+"""
+import ctypes
+import dis
+import gc
+import mmap
+import sys
+import types
+
+from cpytraceafl import tracehook
+from cpytraceafl.rewriter import block_starts, has_line_table
+from cpytraceafl.symbolize import block_location
+
+
+# instructions after which execution may continue by way of a branch event
+_BRANCH_OPCODES = frozenset(getattr(dis, "hasjump", dis.hasjrel + dis.hasjabs))
+
+_map_size_bits = None
+_mem = None
+_first_count = None
+_counts = None
+# (code, locations) of code objects being watched for saturation, found on first check
+_candidates = None
+
+
+def install_hit_counters(map_size_bits):
+    """
+        Have the tracehook count visits to each location in a map of `map_size_bits` bits,
+        in memory which will be shared with any processes forked after this point
+    """
+    global _map_size_bits, _mem, _first_count, _counts, _candidates
+    if _mem is not None:
+        raise RuntimeError("Hit counters already installed")
+
+    _map_size_bits = map_size_bits
+    _mem = mmap.mmap(-1, 2<<map_size_bits, flags=mmap.MAP_SHARED)
+    _first_count = ctypes.c_byte.from_buffer(_mem)
+    _counts = memoryview(_mem).cast("H")
+    _candidates = None
+    tracehook.set_hit_counts_start(ctypes.addressof(_first_count))
+
+
+def uninstall_hit_counters():
+    "Stop counting visits and release the memory used"
+    global _map_size_bits, _mem, _first_count, _counts, _candidates
+    if _mem is None:
+        return
+
+    tracehook.set_hit_counts_start(0)
+    _counts.release()
+    _first_count = None
+    _mem.close()
+    _map_size_bits = _mem = _counts = _candidates = None
+
+
+def find_instrumented_code():
+    """
+        List of the instrumented code objects of all live functions, including any code
+        nested within them. Functions in the garbage collector's permanent generation (see
+        `freeze_heap`) can't be found.
+    """
+    seen = set()
+    codes = []
+    stack = [obj.__code__ for obj in gc.get_objects() if isinstance(obj, types.FunctionType)]
+    while stack:
+        code = stack.pop()
+        if not isinstance(code, types.CodeType) or id(code) in seen:
+            continue
+        seen.add(id(code))
+        if has_line_table(sys.version_info, code):
+            codes.append(code)
+        stack.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+    return codes
+
+
+def code_locations(code, map_size_bits, monitoring=False):
+    """
+        Set of the map locations (before combination with the previous location) of the
+        instrumentation points in `code` which will be counted, given whether the
+        sys.monitoring backend is in use
+    """
+    mask = (1<<map_size_bits) - 1
+    # (code which hasn't been rewritten can have instructions belonging to no line, which
+    # are never seen)
+    blocks = [block for block in block_starts(sys.version_info, dis, code) if block[1] is not None]
+    if sys.version_info >= (3, 13):
+        # a block starting with the END_FOR which an exhausted FOR_ITER jumps over is never
+        # seen by either backend
+        end_for_opcode = dis.opmap["END_FOR"]
+        blocks = [block for block in blocks if code.co_code[block[0]] != end_for_opcode]
+
+    if not monitoring:
+        return frozenset(
+            block_location(lineno, traced_offset, map_size_bits) & mask
+            for _, lineno, traced_offset in blocks
+        )
+
+    instructions = list(dis.get_instructions(code))
+    branch_destinations = set(
+        instruction.offset for instruction in instructions if instruction.is_jump_target
+    ) | set(
+        following.offset for instruction, following in zip(instructions, instructions[1:])
+        if instruction.opcode in _BRANCH_OPCODES
+    )
+    # the first block can't be entered through a branch, nor can 3.12's END_FOR blocks be
+    # entered at their start
+    return frozenset(
+        block_location(lineno, offset, map_size_bits) & mask
+        for offset, lineno, traced_offset in blocks
+        if offset == traced_offset and offset in branch_destinations
+    )
+
+
+def deinstrument_saturated(threshold, codes=None, monitoring=None):
+    """
+        Mark code objects all of whose instrumentation points have been visited at least
+        `threshold` times as uninstrumented, returning a list of them. Code objects considered
+        are those remaining from `codes` (or those found by `find_instrumented_code`) as of the
+        first call. `monitoring` defaults to whether `install_trace_hook` would use the
+        sys.monitoring backend.
+    """
+    global _candidates
+    if _counts is None:
+        raise RuntimeError("Hit counters not installed")
+    if not 0 < threshold <= 0xffff:
+        raise ValueError("threshold must be between 1 and 65535")
+    if monitoring is None:
+        monitoring = hasattr(sys, "monitoring")
+
+    if _candidates is None:
+        _candidates = [
+            (code, code_locations(code, _map_size_bits, monitoring))
+            for code in (find_instrumented_code() if codes is None else codes)
+        ]
+
+    saturated = []
+    remaining = []
+    for code, locations in _candidates:
+        if all(_counts[loc] >= threshold for loc in locations):
+            tracehook.set_instrumented(code, False)
+            saturated.append(code)
+        else:
+            remaining.append((code, locations))
+    _candidates = remaining
+    return saturated
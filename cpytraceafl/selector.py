@@ -0,0 +1,278 @@
+"""
+    Declarative `selector`s for `install_rewriter`, choosing how much of each source file to
+    instrument from a list of rules, e.g.
+
+        install_rewriter(selector=Selector((
+            ("mypkg", True),
+            ("mypkg.vendor", False),
+            (":stdlib:", False),
+            ("/opt/plugins/", 25),
+        ), default=50))
+
+    Each rule's selection is anything `install_rewriter` accepts as a non-callable selector.
+    Patterns may be:
+     - a module or package name, e.g. "mypkg.sub", covering the module and anything within
+       it, or "mypkg.sub.*", covering only modules within it
+     - a path prefix, any pattern containing a path separator, e.g. "/opt/plugins/"
+     - ":stdlib:", the standard library, excluding any site-packages directories within it
+     - a glob, any of the above containing "*", "?" or "[", matched against module names or
+       absolute paths as `fnmatch.fnmatchcase` would
+    Glob rules are tried first, in the order given. Failing a match, the rule with the
+    longest matching path prefix applies (module names are resolved to path prefixes
+    up front using `sys.path` as it is at construction). Failing that, `default` does.
+
+    Decisions are made per file, so each file's rules are only looked up once. Nothing beyond
+    what `install_rewriter` already needs is imported, as that would go uninstrumented when
+    the selector is built before the rewriter is installed. The same rules can be given
+    through the environment variable CPYTRACEAFL_SELECT as comma separated
+    pattern=percentage pairs, e.g.
+
+        CPYTRACEAFL_SELECT="mypkg=100,mypkg.vendor=0,:stdlib:=0,*=50"
+
+    where "*" sets the default. This is used by `install_rewriter` when no `selector` is
+    given, with any AFL_INST_RATIO supplying the default.
+"""
+import os
+import sys
+
+
+SELECT_ENV_VAR = "CPYTRACEAFL_SELECT"
+STDLIB_PATTERN = ":stdlib:"
+
+_GLOB_CHARS = frozenset("*?[")
+# trie nodes' key for the selection of a rule ending at that node
+_SELECTION_KEY = ""
+
+
+class _NoRule:
+    # stable repr for cache tags
+    def __repr__(self):
+        return "_NO_RULE"
+
+
+_NO_RULE = _NoRule()
+
+
+def _is_glob(pattern):
+    return not _GLOB_CHARS.isdisjoint(pattern)
+
+
+def _is_path(pattern):
+    return os.sep in pattern or (os.altsep is not None and os.altsep in pattern)
+
+
+def _stdlib_prefixes():
+    # (prefix, whether covered) pairs. os lives directly in the standard library directory
+    stdlib_dir = os.path.dirname(os.path.abspath(os.__file__))
+    prefixes = [(stdlib_dir + os.sep, True)]
+    for name in ("site-packages", "dist-packages"):
+        prefixes.append((os.path.join(stdlib_dir, name) + os.sep, False))
+    return prefixes
+
+
+def _match_class(pattern, start, char):
+    # for the "[...]" class at pattern[start], whether char matches it and the index after it,
+    # or None if it is unterminated, leaving the "[" to be taken literally
+    i = start + 1
+    negate = i < len(pattern) and pattern[i] == "!"
+    if negate:
+        i += 1
+    first = i
+    matched = False
+    # a "]" right at the start is taken literally
+    while i < len(pattern) and (pattern[i] != "]" or i == first):
+        if i + 2 < len(pattern) and pattern[i+1] == "-" and pattern[i+2] != "]":
+            matched = matched or pattern[i] <= char <= pattern[i+2]
+            i += 3
+        else:
+            matched = matched or pattern[i] == char
+            i += 1
+    if i >= len(pattern):
+        return None
+    return matched != negate, i + 1
+
+
+def _glob_match(name, pattern):
+    "`fnmatch.fnmatchcase` without the imports of `re` and friends it brings"
+    n = p = 0
+    # where to resume from should what follows the last "*" fail to match
+    star_p = star_n = None
+    while n < len(name):
+        if p < len(pattern):
+            if pattern[p] == "*":
+                star_p, star_n = p, n
+                p += 1
+                continue
+            result = _match_class(pattern, p, name[n]) if pattern[p] == "[" else None
+            if result is None:
+                result = pattern[p] in ("?", name[n]), p + 1
+            matched, next_p = result
+            if matched:
+                n += 1
+                p = next_p
+                continue
+        if star_p is None:
+            return False
+        # let the "*" swallow one more character
+        star_n += 1
+        n = star_n
+        p = star_p + 1
+    while p < len(pattern) and pattern[p] == "*":
+        p += 1
+    return p == len(pattern)
+
+
+def _module_prefixes(name, path_entries):
+    parts = name.split(".")
+    submodules_only = parts[-1] == "*"
+    if submodules_only:
+        parts.pop()
+    prefixes = []
+    for entry in path_entries:
+        base = os.path.join(os.path.abspath(entry), *parts)
+        # the package directory
+        prefixes.append(base + os.sep)
+        if not submodules_only:
+            # a plain module, whatever its extension
+            prefixes.append(base + ".")
+    return prefixes
+
+
+def _module_name(filename, path_entries):
+    # the longest sys.path entry containing filename gives the most specific module name
+    best = None
+    for entry in path_entries:
+        entry = os.path.join(os.path.abspath(entry), "")
+        if filename.startswith(entry) and (best is None or len(entry) > len(best)):
+            best = entry
+    if best is None:
+        return None
+    name = os.path.splitext(filename[len(best):])[0].replace(os.sep, ".")
+    # extension modules' names carry a platform tag, e.g. "mod.cpython-38-x86_64-linux-gnu"
+    name = name.split(".cpython-")[0].split(".abi3")[0]
+    if name.endswith(".__init__"):
+        name = name[:-len(".__init__")]
+    return name
+
+
+class Selector:
+    """
+        A callable `selector` for `install_rewriter`, applying `rules`, a sequence of
+        (pattern, selection) pairs, and `default` as described in the module docstring.
+        Has a `cache_tag` suitable for passing to `install_rewriter`, which will use it
+        automatically.
+    """
+    def __init__(self, rules, default=True):
+        self.default = default
+        self._path_entries = [entry or os.getcwd() for entry in sys.path if isinstance(entry, str)]
+        self._globs = []
+        self._trie = {}
+        self._memo = {}
+
+        prefixes = []
+        for pattern, selection in rules:
+            if _is_glob(pattern):
+                self._globs.append((pattern, _is_path(pattern), selection))
+            elif pattern == STDLIB_PATTERN:
+                prefixes.extend(
+                    (prefix, selection if covered else _NO_RULE)
+                    for prefix, covered in _stdlib_prefixes()
+                )
+            elif _is_path(pattern):
+                prefix = os.path.abspath(pattern)
+                if pattern.endswith(os.sep):
+                    prefix = os.path.join(prefix, "")
+                prefixes.append((prefix, selection))
+            else:
+                prefixes.extend(
+                    (prefix, selection) for prefix in _module_prefixes(pattern, self._path_entries)
+                )
+
+        for prefix, selection in prefixes:
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            # first rule given for a prefix wins
+            node.setdefault(_SELECTION_KEY, selection)
+
+        # a stable digest of everything that can affect our decisions, hashed as
+        # install_rewriter's cache hashes sources. without _imp.source_hash it wouldn't be
+        # caching anyway.
+        import _frozen_importlib_external
+        import _imp
+        self.cache_tag = None
+        if hasattr(_imp, "source_hash"):
+            self.cache_tag = "sel" + _imp.source_hash(
+                _frozen_importlib_external._RAW_MAGIC_NUMBER,
+                repr((
+                    [(pattern, selection) for pattern, _, selection in self._globs],
+                    sorted(prefixes, key=repr),
+                    default,
+                )).encode(),
+            ).hex()
+
+    def select_filename(self, filename):
+        "The selection applying to code from file `filename`"
+        selection = self._memo.get(filename, _NO_RULE)
+        if selection is _NO_RULE:
+            selection = self._memo[filename] = self._select_filename(filename)
+        return selection
+
+    def _select_filename(self, filename):
+        if not filename.startswith("<"):
+            filename = os.path.abspath(filename)
+
+        module_name = _NO_RULE
+        for pattern, is_path, selection in self._globs:
+            if is_path:
+                subject = filename
+            else:
+                if module_name is _NO_RULE:
+                    module_name = _module_name(filename, self._path_entries)
+                subject = module_name
+            if subject is not None and _glob_match(subject, pattern):
+                return selection
+
+        selection = _NO_RULE
+        node = self._trie
+        for char in filename:
+            node = node.get(char)
+            if node is None:
+                break
+            selection = node.get(_SELECTION_KEY, selection)
+        return self.default if selection is _NO_RULE else selection
+
+    def __call__(self, code):
+        return self.select_filename(code.co_filename)
+
+
+def parse_rules(spec):
+    """
+        Parse `spec`, in the format of CPYTRACEAFL_SELECT, into a list of (pattern, selection)
+        rules and a default selection (None if not specified)
+    """
+    rules = []
+    default = None
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        pattern, sep, value = item.rpartition("=")
+        if not sep or not pattern:
+            raise ValueError("Invalid {} item {!r}".format(SELECT_ENV_VAR, item))
+        percentage = int(value)
+        selection = True if percentage >= 100 else percentage
+        if pattern == "*":
+            default = selection
+        else:
+            rules.append((pattern, selection))
+    return rules, default
+
+
+def selector_from_env(default=True):
+    "A `Selector` configured from CPYTRACEAFL_SELECT, or None if it isn't set"
+    spec = os.environ.get(SELECT_ENV_VAR)
+    if not spec:
+        return None
+    rules, env_default = parse_rules(spec)
+    return Selector(rules, default if env_default is None else env_default)
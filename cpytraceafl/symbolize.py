@@ -0,0 +1,251 @@
+"""
+    Per-function coverage reporting, mapping instrumentation points back to the source code
+    they came from using an index written by the rewriter (see `install_rewriter`'s
+    `index_path`). Either from a corpus:
+
+        python -m cpytraceafl.symbolize INDEX CORPUS_DIR -- python harness.py @@
+
+    which runs each input through the target's forkserver (see `cpytraceafl.driver`) with
+    CPYTRACEAFL_BLOCK_COVERAGE set, having its forked children record exactly which
+    instrumentation points they reach. Or, approximately, from a map:
+
+        python -m cpytraceafl.symbolize INDEX --bitmap out/default/fuzz_bitmap --virgin
+
+    Map locations are derived from the *pair* of consecutive instrumentation points
+    visited, so not every location can be attributed. A point is considered reached if a
+    set location could have resulted from entering it from another point in the same code
+    object or, for the first point in a code object, from any point at all. Points only ever
+    entered from elsewhere (e.g. on return from a call) will be missed. This assumes
+    AFL_NGRAM_SIZE was not in use.
+"""
+import argparse
+import marshal
+import os
+import sys
+import tempfile
+
+from cpytraceafl import BLOCK_COVERAGE_ENV_VAR, DEFAULT_MAP_SIZE_BITS
+from cpytraceafl.driver import Driver, TargetStartError, iter_corpus
+from cpytraceafl.rewriter import BLOCK_ID_LINENO_FLAG, has_line_table
+
+
+# *must* agree with HASH_PRIME in _tracehookmodule.c
+HASH_PRIME = 0xedb6417b
+
+_block_coverage_fd = None
+_seen_blocks = set()
+
+
+def load_index(path):
+    "List of the distinct entries (see `rewriter.index_blocks`) in index file `path`"
+    entries = {}
+    with open(path, "rb") as f:
+        while True:
+            try:
+                chunk = marshal.load(f)
+            except EOFError:
+                break
+            for entry in chunk:
+                entries.setdefault(entry[:4], entry)
+    return list(entries.values())
+
+
+def block_location(lineno, offset, map_size_bits):
+    """
+        The location the tracehook will derive for an instrumentation point, before being
+        combined with the previous location (and masked) to give a map location
+    """
+    if lineno & BLOCK_ID_LINENO_FLAG:
+        return lineno
+    # mirroring hash_lineno_lasti
+    state = HASH_PRIME * (lineno or 0xffffffff) * (offset or 0xffffffff)
+    return (state & 0xffffffff) >> (32 - map_size_bits)
+
+
+def covered_from_bitmap(entries, bitmap, map_size_bits, virgin=False):
+    """
+        Set of (entry index, block index) pairs of instrumentation points in `entries` which
+        appear to have been reached according to map `bitmap`, which if `virgin` is in the
+        inverted form of afl-fuzz's fuzz_bitmap.
+    """
+    mask = (1<<map_size_bits) - 1
+    untouched = 0xff if virgin else 0
+    set_locations = frozenset(i for i, value in enumerate(bitmap[:mask+1]) if value != untouched)
+
+    entry_locations = [
+        [block_location(lineno, offset, map_size_bits) for lineno, offset, _ in entry[4]]
+        for entry in entries
+    ]
+    # prev_loc values following each point. 0 is where reset_prev_loc leaves it.
+    all_prev_locs = frozenset(
+        (loc >> 1) & mask for locations in entry_locations for loc in locations
+    ) | {0}
+
+    covered = set()
+    for entry_i, locations in enumerate(entry_locations):
+        prev_locs = frozenset((loc >> 1) & mask for loc in locations) | {0}
+        for block_i, loc in enumerate(locations):
+            loc &= mask
+            if any(loc ^ prev_loc in set_locations for prev_loc in prev_locs) or (
+                block_i == 0 and any(loc ^ s in all_prev_locs for s in set_locations)
+            ):
+                covered.add((entry_i, block_i))
+    return covered
+
+
+def _local_tracer(frame, event, arg):
+    if event == "line":
+        code = frame.f_code
+        key = (
+            code.co_filename,
+            code.co_name,
+            code.co_firstlineno,
+            frame.f_lineno,
+            frame.f_lasti,
+        )
+        if key not in _seen_blocks:
+            _seen_blocks.add(key)
+            os.write(_block_coverage_fd, marshal.dumps(key))
+    return _local_tracer
+
+
+def _global_tracer(frame, event, arg):
+    # as with the tracehook, code with an empty line table is not of interest
+    if has_line_table(sys.version_info, frame.f_code):
+        return _local_tracer
+    return None
+
+
+def install_block_recorder(path):
+    """
+        Start tracing the current thread with a (slow) python-level trace function which
+        appends each distinct instrumentation point it sees to file `path`, for reading with
+        `read_block_coverage`. Used in place of the tracehook to collect exact coverage.
+    """
+    global _block_coverage_fd
+    _block_coverage_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _seen_blocks.clear()
+    sys.settrace(_global_tracer)
+
+
+def read_block_coverage(path):
+    """
+        Set of (co_filename, co_name, co_firstlineno, lineno, offset) of the instrumentation
+        points recorded to `path` by `install_block_recorder`
+    """
+    keys = set()
+    with open(path, "rb") as f:
+        while True:
+            try:
+                keys.add(marshal.load(f))
+            except EOFError:
+                return keys
+
+
+def covered_from_block_coverage(entries, keys):
+    "Set of (entry index, block index) pairs of `entries` recorded in `keys`"
+    block_indexes = {}
+    for entry_i, entry in enumerate(entries):
+        for block_i, (lineno, offset, _) in enumerate(entry[4]):
+            block_indexes[entry[:3] + (lineno, offset)] = (entry_i, block_i)
+    return set(block_indexes[key] for key in keys if key in block_indexes)
+
+
+def _format_lines(linenos):
+    # collapse runs into ranges
+    ranges = []
+    for lineno in sorted(linenos):
+        if ranges and lineno == ranges[-1][1] + 1:
+            ranges[-1][1] = lineno
+        else:
+            ranges.append([lineno, lineno])
+    return ", ".join(str(a) if a == b else "{}-{}".format(a, b) for a, b in ranges)
+
+
+def write_report(entries, covered, f):
+    "Write a per-function coverage report of `entries`, given `covered` (see above), to `f`"
+    total_blocks = 0
+    for entry_i, entry in sorted(enumerate(entries), key=lambda item: (item[1][0], item[1][3])):
+        filename, name, _, original_firstlineno, blocks = entry
+        covered_linenos = set()
+        uncovered_linenos = set()
+        for block_i, (_, _, original_lineno) in enumerate(blocks):
+            linenos = covered_linenos if (entry_i, block_i) in covered else uncovered_linenos
+            if original_lineno is not None:
+                linenos.add(original_lineno)
+        n_covered = sum(1 for block_i in range(len(blocks)) if (entry_i, block_i) in covered)
+        total_blocks += len(blocks)
+
+        f.write("{}/{}\t{}:{} {}\n".format(
+            n_covered,
+            len(blocks),
+            filename,
+            original_firstlineno,
+            name,
+        ))
+        # lines only reached by some of their blocks aren't of much interest
+        uncovered_linenos -= covered_linenos
+        if uncovered_linenos:
+            f.write("\tunreached lines: {}\n".format(_format_lines(uncovered_linenos)))
+
+    f.write("{}/{} blocks reached in {} code objects\n".format(
+        len(covered),
+        total_blocks,
+        len(entries),
+    ))
+
+
+def main(argv):
+    separator = argv.index("--") if "--" in argv else len(argv)
+    parser = argparse.ArgumentParser(
+        prog="python -m cpytraceafl.symbolize",
+        usage=(
+            "%(prog)s [options] INDEX CORPUS [CORPUS...] -- TARGET_COMMAND...\n"
+            "       %(prog)s [options] INDEX --bitmap BITMAP"
+        ),
+        description="Report coverage per function using an index written by the rewriter",
+    )
+    parser.add_argument("index")
+    parser.add_argument("corpus", nargs="*", help="input files or directories of them")
+    parser.add_argument("--bitmap", help="report on this map file instead of a corpus")
+    parser.add_argument("--virgin", action="store_true", help="bitmap is afl's fuzz_bitmap")
+    parser.add_argument("--map-size-bits", type=int, default=DEFAULT_MAP_SIZE_BITS)
+    parser.add_argument("--timeout", type=float, help="seconds allowed per input")
+    args = parser.parse_args(argv[:separator])
+    target_args = argv[separator+1:]
+    if args.bitmap is None and not (args.corpus and target_args):
+        parser.error("either a corpus and target command or --bitmap is required")
+
+    if args.bitmap is not None:
+        entries = load_index(args.index)
+        with open(args.bitmap, "rb") as f:
+            bitmap = f.read()
+        covered = covered_from_bitmap(entries, bitmap, args.map_size_bits, args.virgin)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            coverage_path = os.path.join(work_dir, "coverage")
+            open(coverage_path, "wb").close()
+            try:
+                driver = Driver(
+                    target_args,
+                    map_size_bits=args.map_size_bits,
+                    timeout=args.timeout,
+                    env=dict(os.environ, **{BLOCK_COVERAGE_ENV_VAR: coverage_path}),
+                    quiet=True,
+                )
+            except TargetStartError as e:
+                sys.stderr.write("{}\n".format(e))
+                return 1
+            with driver:
+                for _, data in iter_corpus(args.corpus):
+                    driver.run(data)
+            # (the index is only complete once the target has started)
+            entries = load_index(args.index)
+            covered = covered_from_block_coverage(entries, read_block_coverage(coverage_path))
+
+    write_report(entries, covered, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
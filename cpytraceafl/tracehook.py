@@ -10,3 +10,40 @@ _prev_dlopenflags = sys.getdlopenflags()
 sys.setdlopenflags(_prev_dlopenflags | ctypes.RTLD_GLOBAL)
 from cpytraceafl._tracehook import *
 sys.setdlopenflags(_prev_dlopenflags)
+
+
+def _codes_of(obj, strict=True):
+    # class attributes which aren't functions of some sort are simply skipped, not strict
+    if isinstance(obj, type(_codes_of.__code__)):
+        return [obj]
+    if isinstance(obj, (staticmethod, classmethod)):
+        return _codes_of(obj.__func__, strict)
+    if isinstance(obj, property):
+        return [
+            code
+            for accessor in (obj.fget, obj.fset, obj.fdel) if accessor is not None
+            for code in _codes_of(accessor, strict)
+        ]
+    if hasattr(obj, "__code__"):
+        return [obj.__code__]
+    if isinstance(obj, type) and strict:
+        return [code for value in vars(obj).values() for code in _codes_of(value, False)]
+    if strict:
+        raise TypeError("Can't exclude {!r} from tracing".format(obj))
+    return []
+
+
+def exclude_from_tracing(*objs):
+    """
+        Mark the code of each of `objs`, functions (including static & class methods and
+        properties), code objects or classes (meaning each of these defined directly on them),
+        and any code nested within, as uninstrumented. Our own functions have no business
+        showing up in traces. Returns the first of `objs`, so this can also be used as a
+        decorator. Raises TypeError for anything else.
+    """
+    codes = [code for obj in objs for code in _codes_of(obj)]
+    while codes:
+        code = codes.pop()
+        set_instrumented(code, False)
+        codes.extend(const for const in code.co_consts if isinstance(const, type(code)))
+    return objs[0] if objs else None
@@ -12,18 +12,16 @@ d.decode(
     b'\x0f\t\x86\xa8\xeb\x10d\x9c\xbf'
 )
 
-import sys
-from cpytraceafl import fuzz_from_here, crashing_excepthook
+from cpytraceafl import fuzz_from_here, crashing_excepthook, read_input
 
 fuzz_from_here(excepthook=crashing_excepthook)
 
-with open(sys.argv[1], "rb") as f:
-    try:
-        d = hpack.Decoder()
-        # we have inserted the sentinel 0xdeadbeef into our examples as a marker signifying
-        # a new part of a differentially encoded header
-        for fragment in f.read().split(b"\xde\xad\xbe\xef"):
-            if fragment:
-                d.decode(fragment)
-    except hpack.HPACKDecodingError:
-        pass
+try:
+    d = hpack.Decoder()
+    # we have inserted the sentinel 0xdeadbeef into our examples as a marker signifying
+    # a new part of a differentially encoded header
+    for fragment in read_input().split(b"\xde\xad\xbe\xef"):
+        if fragment:
+            d.decode(fragment)
+except hpack.HPACKDecodingError:
+    pass
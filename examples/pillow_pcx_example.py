@@ -6,7 +6,7 @@ from cpytraceafl.rewriter import install_rewriter
 
 install_rewriter()
 
-from cpytraceafl import fuzz_from_here, DEFAULT_MAP_SIZE_BITS, get_map_size_bits_env
+from cpytraceafl import fuzz_from_here, read_input, DEFAULT_MAP_SIZE_BITS, get_map_size_bits_env
 # must ensure the tracehook module gets imported *before* any instrumented native modules,
 # so that the __afl_area_ptr and __afl_prev_loc global symbols have been loaded
 from cpytraceafl.tracehook import set_map_start
@@ -29,7 +29,6 @@ PIL._plugins[:] = ["PcxImagePlugin"]
 from PIL import Image
 import codecs
 from io import BytesIO
-import sys
 # warm up code under test, ensure lazy imports are performed and internal caches are populated.
 Image.open(BytesIO(codecs.decode(
     "0A05010100000000570033004001C800000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF"
@@ -44,9 +43,8 @@ Image.open(BytesIO(codecs.decode(
 
 fuzz_from_here()
 
-with open(sys.argv[1], "rb") as f:
-    try:
-        Image.open(f).getdata()
-    except Exception:
-        # in this case, a python exception isn't the end of the world - we're after crashers
-        pass
+try:
+    Image.open(BytesIO(read_input())).getdata()
+except Exception:
+    # in this case, a python exception isn't the end of the world - we're after crashers
+    pass
@@ -24,15 +24,13 @@ try:
 except PyPdfError:
     pass
 
-import sys
-from cpytraceafl import fuzz_from_here, crashing_excepthook
+from cpytraceafl import fuzz_from_here, crashing_excepthook, read_input
 
 fuzz_from_here(excepthook=crashing_excepthook)
 
-with open(sys.argv[1], "rb") as f:
-    try:
-        r = PdfFileReader(f)
-        r.getFields()
-        r.getXmpMetadata()
-    except PyPdfError:
-        pass
+try:
+    r = PdfFileReader(BytesIO(read_input()))
+    r.getFields()
+    r.getXmpMetadata()
+except PyPdfError:
+    pass
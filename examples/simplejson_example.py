@@ -9,13 +9,11 @@ simplejson._toggle_speedups(False)
 # initial call to set up any internal caches or imports before the fork
 simplejson.loads('{"foo": "bar", "baz": ["qux", 123, false]}')
 
-import sys
-from cpytraceafl import fuzz_from_here
+from cpytraceafl import fuzz_from_here, read_input
 
 fuzz_from_here()
 
-with open(sys.argv[1], "rb") as f:
-    try:
-        simplejson.loads(f.read())
-    except simplejson.JSONDecodeError:
-        pass
+try:
+    simplejson.loads(read_input())
+except simplejson.JSONDecodeError:
+    pass
@@ -44,6 +44,19 @@ setup(
     setup_requires=["pytest-runner"],
     install_requires=["sysv_ipc"],
     tests_require=["pytest"],
-    python_requires=">=3.5, <3.9",  # not tested with other versions (yet)
+    python_requires=">=3.5, <3.14",  # 3.14 not tested (yet)
     license='MIT',
+    classifiers=[
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
+        "Programming Language :: Python :: 3.13",
+        "Programming Language :: Python :: Implementation :: CPython",
+    ],
 )
@@ -1,59 +1,168 @@
 "A useful tool for feeding input to targets which connect to a TCP 'server'"
+import argparse
+import asyncio
+import os
 import socket
-from socketserver import BaseRequestHandler, TCPServer
 import time
 
 
 SERVER_FIRST_CHUNK = True
 MAX_DATA_LEN = 2000
 CHUNK_WAIT_TIME = 0.015
+# when targets are notifying us of reads, how long to wait for one before giving up
+NOTIFY_WAIT_TIME = 1.0
 RECV_SIZE = 4096
 CHUNK_SEPARATOR = b"\xde\xad\xbe\xef"
 
 
-def get_handler(source_path):
-    class _TCPListenFeederHandler(BaseRequestHandler):
-        _source_path = source_path
+class _Connection:
+    def __init__(self, reader):
+        self.reader = reader
+        self.recv_len = 0
+        self.sent_len = 0
+        self.eof = False
+        # bytes the target had read from this connection when it last told us it was about
+        # to block reading from it
+        self.notified_len = None
+        # set on any of the above changing
+        self.activity = asyncio.Event()
 
-        def _receive_data(self):
-            recv_len = 0
+    @property
+    def blocked(self):
+        """
+            Whether the target has told us it's about to block having read everything sent,
+            rather than having sent the notification before the latest chunk arrived
+        """
+        return self.notified_len == self.sent_len
+
+    async def receive(self):
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                self.eof = True
+                self.activity.set()
+                return
+            self.recv_len += len(data)
+            self.activity.set()
+
+    async def wait_for_turn(self, wait_time):
+        """
+            Wait for the target to finish talking, returning whether it's still there and
+            said anything or told us it's waiting for more
+        """
+        start_len = self.recv_len
+        while not (self.eof or self.blocked):
+            self.activity.clear()
             try:
-                while True:
-                    new_len = len(self.request.recv(RECV_SIZE))
-                    if not new_len:
-                        break
-                    recv_len += new_len
-            except socket.timeout:
-                pass
-            print(f"{time.monotonic()} \tReceived {recv_len} B")
-            return recv_len
-
-        def handle(self):
-            self.request.settimeout(CHUNK_WAIT_TIME)
-            self.request.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-            with open(self._source_path, "rb") as f:
+                await asyncio.wait_for(self.activity.wait(), wait_time)
+            except asyncio.TimeoutError:
+                break
+        print(f"{time.monotonic()} \tReceived {self.recv_len - start_len} B")
+        return not self.eof and (self.blocked or self.recv_len != start_len)
+
+
+class _NotifyProtocol(asyncio.DatagramProtocol):
+    def __init__(self, connections):
+        self.connections = connections
+
+    def datagram_received(self, data, addr):
+        host, port, notified_len = data.decode().rsplit(" ", 2)
+        connection = self.connections.get((host, int(port)))
+        if connection is not None:
+            connection.notified_len = int(notified_len)
+            connection.activity.set()
+
+
+def get_handler(source_path, connections, notify=False):
+    """
+        Returns a `start_server` callback feeding the contents of `source_path` to each
+        connection, chunk by chunk. Each chunk is sent once the target has finished talking,
+        which with `notify` is when it says so (see `cpytraceafl.readnotify`) through
+        `connections`, a dict of peer address -> `_Connection` populated here.
+    """
+    async def handle(reader, writer):
+        peer = writer.get_extra_info("peername")[:2]
+        writer.get_extra_info("socket").setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        connection = connections[peer] = _Connection(reader)
+        receive_task = asyncio.ensure_future(connection.receive())
+        wait_time = NOTIFY_WAIT_TIME if notify else CHUNK_WAIT_TIME
+        try:
+            with open(source_path, "rb") as f:
                 data = f.read()
 
             if MAX_DATA_LEN and len(data) > MAX_DATA_LEN:
                 # make sure afl doesnt see this trace as "interesting"
                 return
             for i, chunk in enumerate(data.split(CHUNK_SEPARATOR)):
-                if (i or not SERVER_FIRST_CHUNK) and self._receive_data() == 0:
+                if (i or not SERVER_FIRST_CHUNK) and not await connection.wait_for_turn(wait_time):
                     print(f"{time.monotonic()} \tDone, chunks remaining")
                     break
+                connection.sent_len += len(chunk)
                 print(f"{time.monotonic()} \tSending {len(chunk)} B")
-                self.request.sendall(chunk)
+                writer.write(chunk)
+                await writer.drain()
             else:
-                self._receive_data()
+                await connection.wait_for_turn(wait_time)
                 print(f"{time.monotonic()} \tDone, all chunks sent")
+        except ConnectionError:
+            print(f"{time.monotonic()} \tConnection lost")
+        finally:
+            receive_task.cancel()
+            del connections[peer]
+            writer.close()
+
+    return handle
+
 
+async def serve(payloads, notify_path=None):
+    """
+        Start listening on localhost for each (port, source_path) of `payloads`, returning
+        the servers. With `notify_path`, a unix datagram socket is bound there, through which
+        targets can notify us when they've finished talking (see `cpytraceafl.readnotify`).
+    """
+    loop = asyncio.get_event_loop()
+    connections = {}
+    if notify_path is not None:
+        notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        notify_socket.bind(notify_path)
+        await loop.create_datagram_endpoint(
+            lambda: _NotifyProtocol(connections),
+            sock=notify_socket,
+        )
 
-    return _TCPListenFeederHandler
+    return [
+        await asyncio.start_server(
+            get_handler(source_path, connections, notify=notify_path is not None),
+            "127.0.0.1",
+            port,
+        )
+        for port, source_path in payloads
+    ]
 
 
-# usage: tcplistenfeeder.py <port> <payload file>
+# usage: tcplistenfeeder.py [--notify <socket path>] <port> <payload file> [<port> <payload file>...]
 if __name__ == "__main__":
-    import sys
+    parser = argparse.ArgumentParser(description="Feed payload files to connecting targets")
+    parser.add_argument("payloads", nargs="+", metavar="PORT PAYLOAD")
+    parser.add_argument(
+        "--notify",
+        metavar="SOCKET_PATH",
+        help="listen for notifications from targets with CPYTRACEAFL_READ_NOTIFY set to this",
+    )
+    args = parser.parse_args()
+    if len(args.payloads) % 2:
+        parser.error("ports and payload files must come in pairs")
 
-    with TCPServer(("127.0.0.1", int(sys.argv[1])), get_handler(sys.argv[2])) as server:
-        server.serve_forever()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(
+            [(int(port), path) for port, path in zip(args.payloads[::2], args.payloads[1::2])],
+            notify_path=args.notify,
+        ))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.notify is not None:
+            os.unlink(args.notify)
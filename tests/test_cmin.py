@@ -0,0 +1,113 @@
+import sys
+
+from cpytraceafl import cmin
+
+
+target_source = """
+import os
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile('''
+def target(data):
+    if data[:1] == b"a":
+        return 1
+    elif data[:1] == b"b":
+        for c in data:
+            if c == 0:
+                return 2
+    elif data[:1] == b"c":
+        os.abort()
+    return 3
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here()
+target(read_input())
+"""
+
+
+def test_get_tuples():
+    coverage = bytearray(1024)
+    coverage[3] = 1
+    coverage[10] = 3
+    coverage[11] = 5
+    coverage[1023] = 200
+    assert cmin.get_tuples(bytes(coverage)) == {
+        (3 << 8) | 1,
+        (10 << 8) | 3,
+        (11 << 8) | 4,
+        (1023 << 8) | 128,
+    }
+
+
+def test_write_showmap(tmp_path):
+    cmin.write_showmap(str(tmp_path / "map"), {(1023 << 8) | 128, (3 << 8) | 1})
+    assert (tmp_path / "map").read_text() == "000003:1\n001023:128\n"
+
+
+def test_minimize():
+    assert cmin.minimize((
+        ("big", 100, {1, 2, 3}),
+        ("small", 1, {1, 2}),
+        ("medium", 10, {3}),
+        ("dupe", 1, {1, 2}),
+        ("rare", 50, {2, 5}),
+    )) == {"small", "medium", "rare"}
+
+    # a candidate having a unique tuple will always be chosen
+    assert cmin.minimize((
+        ("big", 100, {1, 2, 3, 4}),
+        ("small", 1, {1, 2}),
+        ("medium", 10, {3}),
+    )) == {"big"}
+
+
+def test_main(tmp_path, capsys):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for name, data in (
+        ("1", b"a"),
+        ("2", b"aaaa"),
+        ("3", b"b\0"),
+        ("4", b"bbb\0"),
+        ("5", b"bbb"),
+        ("6", b"c"),
+        ("7", b"z"),
+    ):
+        (input_dir / name).write_bytes(data)
+
+    assert cmin.main([
+        str(input_dir),
+        str(tmp_path / "out"),
+        "--maps",
+        str(tmp_path / "maps"),
+        "--",
+        sys.executable,
+        "-c",
+        target_source,
+        "@@",
+    ]) == 0
+
+    # the crashing input is left out
+    assert sorted(p.name for p in (tmp_path / "maps").iterdir()) == [
+        "1", "2", "3", "4", "5", "7",
+    ]
+    assert (tmp_path / "maps" / "1").read_text() == (tmp_path / "maps" / "2").read_text()
+    # "bbb\0" goes round its loop more times than "b\0", reaching different buckets
+    assert (tmp_path / "maps" / "3").read_text() != (tmp_path / "maps" / "4").read_text()
+
+    def tuples(names):
+        return set().union(*(
+            (tmp_path / "maps" / name).read_text().splitlines() for name in names
+        ))
+
+    chosen = sorted(p.name for p in (tmp_path / "out").iterdir())
+    # only one of the identically-behaving inputs is needed, the smallest
+    assert "1" in chosen and "2" not in chosen
+    assert "6" not in chosen
+    assert tuples(chosen) == tuples(("1", "2", "3", "4", "5", "7"))
+    assert "7 inputs (6 usable) minimized to {}".format(len(chosen)) in capsys.readouterr().out
@@ -0,0 +1,129 @@
+import os
+import sys
+
+import pytest
+
+from cpytraceafl import FORKSRV_FD
+from cpytraceafl.driver import (
+    Driver,
+    TargetStartError,
+    count_covered,
+    describe_status,
+    iter_corpus,
+    merge_coverage,
+)
+
+
+target_source = """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+dictionary = set()
+install_rewriter(dictionary=dictionary)
+
+exec(compile('''
+def target(data):
+    if data == b"MAGIC":
+        sys.exit(12)
+    elif data == b"hang":
+        while True:
+            pass
+    elif data[:1] == b"b":
+        for c in data:
+            if c == 0:
+                return
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, fuzz_loop, read_input
+
+if sys.argv[1] == "persistent":
+    for data in fuzz_loop(2, input_path=sys.argv[2]):
+        target(data)
+else:
+    fuzz_from_here(dictionary=dictionary)
+    target(read_input(sys.argv[2]))
+"""
+
+
+@pytest.mark.parametrize("shm_fuzz", (False, True,))
+def test_driver(shm_fuzz):
+    with Driver(
+        (sys.executable, "-c", target_source, "oneshot", "@@"),
+        map_size_bits=12,
+        shm_fuzz=shm_fuzz,
+        timeout=1,
+    ) as driver:
+        assert (driver.testcase_shm is not None) == shm_fuzz
+        assert b"MAGIC" in driver.autodict
+
+        results = [driver.run(data) for data in (b"MAGIC", b"b\0", b"hang", b"c", b"b\0")]
+        assert [describe_status(result.status) for result in results] == [
+            "exit 12",
+            "exit 0",
+            "signal 9",
+            "exit 0",
+            "exit 0",
+        ]
+        assert len(set(result.pid for result in results)) == 5
+        assert results[2].elapsed >= 1
+
+        assert all(len(result.coverage) == 1<<12 for result in results)
+        assert results[1].coverage == results[4].coverage
+        assert results[1].coverage != results[3].coverage
+
+        merged = 0
+        for result in results:
+            merged = merge_coverage(merged, result.coverage)
+        assert bin(merged).count("1") >= max(count_covered(r.coverage) for r in results)
+        assert bin(merge_coverage(0, results[1].coverage)).count("1") == count_covered(
+            results[1].coverage
+        )
+
+
+def test_driver_persistent():
+    with Driver((sys.executable, "-c", target_source, "persistent"), quiet=True) as driver:
+        results = [driver.run(data) for data in (b"b\0", b"c", b"b\0")]
+        assert [describe_status(result.status) for result in results] == [
+            "stopped",
+            "exit 0",
+            "stopped",
+        ]
+        assert results[0].pid == results[1].pid != results[2].pid
+        assert results[0].coverage == results[2].coverage
+
+
+def test_driver_leaves_forkserver_fds(tmp_path):
+    # fds of our own which happen to have the numbers the target's forkserver expects
+    fds = [os.open(str(tmp_path / name), os.O_RDWR | os.O_CREAT) for name in ("a", "b")]
+    try:
+        for fd, number in zip(fds, (FORKSRV_FD, FORKSRV_FD+1)):
+            os.dup2(fd, number)
+        with Driver((sys.executable, "-c", target_source, "oneshot", "@@")) as driver:
+            assert describe_status(driver.run(b"MAGIC").status) == "exit 12"
+        for name, number in zip(("a", "b"), (FORKSRV_FD, FORKSRV_FD+1)):
+            assert os.fstat(number).st_ino == (tmp_path / name).stat().st_ino
+    finally:
+        for fd in fds + [FORKSRV_FD, FORKSRV_FD+1]:
+            os.close(fd)
+
+
+def test_driver_start_failure():
+    with pytest.raises(TargetStartError):
+        Driver((sys.executable, "-c", "pass"))
+
+
+def test_iter_corpus(tmp_path):
+    (tmp_path / "corpus").mkdir()
+    (tmp_path / "corpus" / "b").write_bytes(b"2")
+    (tmp_path / "corpus" / "a").write_bytes(b"1")
+    (tmp_path / "corpus" / "subdir").mkdir()
+    (tmp_path / "c").write_bytes(b"3")
+
+    assert [
+        (os.path.relpath(path, str(tmp_path)), data)
+        for path, data in iter_corpus((str(tmp_path / "corpus"), str(tmp_path / "c")))
+    ] == [
+        (os.path.join("corpus", "a"), b"1"),
+        (os.path.join("corpus", "b"), b"2"),
+        ("c", b"3"),
+    ]
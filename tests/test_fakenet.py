@@ -0,0 +1,119 @@
+import asyncio
+import socket
+import sys
+
+import pytest
+
+from cpytraceafl import fakenet
+from cpytraceafl.driver import Driver, describe_status
+
+
+payload = b"\xde\xad\xbe\xef".join((b"hello\nworld\n", b"", b"second"))
+
+
+@pytest.fixture
+def fake_network():
+    fakenet.install_fake_network(lambda: payload, ports=(1234,))
+    try:
+        yield
+    finally:
+        fakenet.uninstall_fake_network()
+
+
+def test_fake_socket(fake_network):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    assert sock.connect_ex(("no.such.host.invalid", 1234)) == 0
+    assert sock.getpeername() == ("no.such.host.invalid", 1234)
+    assert sock.recv(3, socket.MSG_PEEK) == b"hel"
+    assert sock.recv(3) == b"hel"
+    assert sock.sendall(b"ignored") is None
+    assert sock.send(b"ignored") == 7
+    # only the remainder of the first chunk
+    assert sock.recv(100) == b"lo\nworld\n"
+    # the empty chunk is skipped
+    buf = bytearray(4)
+    assert sock.recv_into(buf) == 4
+    assert buf == b"seco"
+    assert sock.recvfrom(100) == (b"nd", ("no.such.host.invalid", 1234))
+    assert sock.recv(100) == b""
+    sock.close()
+
+
+def test_fake_create_connection(fake_network):
+    with socket.create_connection(("no.such.host.invalid", 1234)) as sock:
+        f = sock.makefile("rb")
+        assert f.readline() == b"hello\n"
+        assert f.read() == b"world\nsecond"
+        f.close()
+
+
+def test_unfaked_port(fake_network):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        with socket.create_connection(listener.getsockname()) as sock:
+            conn, _ = listener.accept()
+            with conn:
+                conn.sendall(b"real")
+                assert sock.recv(100) == b"real"
+
+
+def test_fake_asyncio(fake_network):
+    async def client():
+        reader, writer = await asyncio.open_connection("no.such.host.invalid", 1234)
+        assert writer.get_extra_info("peername") == ("no.such.host.invalid", 1234)
+        lines = [await reader.readline()]
+        writer.write(b"ignored")
+        await writer.drain()
+        lines.append(await reader.read())
+        writer.close()
+        return lines
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(client()) == [b"hello\n", b"world\nsecond"]
+    finally:
+        loop.close()
+
+
+def test_uninstall():
+    original_connect = socket.socket.connect
+    original_create_connection = socket.create_connection
+    fakenet.install_fake_network(lambda: payload)
+    assert socket.socket.connect is not original_connect
+    fakenet.uninstall_fake_network()
+    assert socket.socket.connect is original_connect
+    assert "connect" not in vars(socket.socket)
+    assert socket.create_connection is original_create_connection
+
+
+target_source = """
+import socket
+import sys
+
+from cpytraceafl import fuzz_loop
+from cpytraceafl.fakenet import install_fake_network
+
+install_fake_network()
+
+for data in fuzz_loop(2):
+    with socket.create_connection(("no.such.host.invalid", 80)) as sock:
+        sock.sendall(b"GET / HTTP/1.0\\r\\n\\r\\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    if chunks == [b"a", b"b"]:
+        sys.exit(3)
+"""
+
+
+def test_persistent_target():
+    with Driver((sys.executable, "-c", target_source), timeout=10) as driver:
+        statuses = [
+            describe_status(driver.run(data).status)
+            for data in (b"a", b"a\xde\xad\xbe\xefb", b"ab", b"a\xde\xad\xbe\xefb")
+        ]
+    assert statuses == ["stopped", "exit 3", "stopped", "exit 3"]
@@ -0,0 +1,368 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cpytraceafl import (
+    FS_OPT_AUTODICT,
+    FS_OPT_ENABLED,
+    FS_OPT_MAPSIZE,
+    FS_OPT_SHDMEM_FUZZ,
+    POSTFORK_PROFILE_ENV_VAR,
+    TRIAGE_LOG_NAME,
+    warm_up,
+)
+from cpytraceafl.driver import Driver
+
+
+persistent_target_source = """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile('''
+def target(data):
+    if data[:1] == b"a":
+        return 1
+    elif data[:1] == b"b":
+        for c in data:
+            if c == 0:
+                return 2
+    return 3
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_loop
+
+for data in fuzz_loop(3, input_path=sys.argv[1], zero_copy=True):
+    target(data)
+"""
+
+
+oneshot_target_source = """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile('''
+def target(data):
+    if data == b"foo":
+        sys.exit(12)
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here()
+target(read_input())
+"""
+
+
+autodict_target_source = """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+dictionary = set()
+install_rewriter(dictionary=dictionary)
+
+exec(compile('''
+def target(data):
+    if data.startswith(b"MAGIC"):
+        sys.exit(12)
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here(dictionary=dictionary)
+target(read_input())
+"""
+
+
+heap_target_source = """
+import gc
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here(freeze=True, disable_gc=True, fault_stats_path={fault_stats_path!r})
+data = read_input()
+sys.exit(
+    (10 if gc.isenabled() else 0)
+    + (1 if hasattr(gc, "get_freeze_count") and not gc.get_freeze_count() else 0)
+)
+"""
+
+
+postfork_target_source = """
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile('''
+def target(data):
+    if data == b"foo":
+        import colorsys
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here()
+target(read_input())
+"""
+
+
+hang_target_source = """
+import sys
+import time
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile('''
+def spin():
+    while True:
+        pass
+
+def target(data):
+    if data == b"hang":
+        spin()
+    elif data == b"slow":
+        time.sleep(0.3)
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_loop
+
+for data in fuzz_loop(
+    {max_iterations},
+    input_path=sys.argv[2],
+    exec_timeout=0.5,
+    slow_threshold=0.2,
+    triage_dir={triage_dir!r},
+):
+    target(data)
+"""
+
+
+@pytest.mark.parametrize("shm_fuzz,map_size_bits", (
+    (False, 16),
+    (True, 16),
+    (False, 13),
+))
+def test_oneshot(shm_fuzz, map_size_bits):
+    with Driver(
+        (sys.executable, "-c", oneshot_target_source),
+        map_size_bits=map_size_bits,
+        shm_fuzz=shm_fuzz,
+    ) as driver:
+        assert driver.options & FS_OPT_ENABLED == FS_OPT_ENABLED
+        assert bool(driver.options & FS_OPT_SHDMEM_FUZZ) == shm_fuzz
+        assert driver.options & FS_OPT_MAPSIZE
+        assert ((driver.options & 0x00fffffe) >> 1) + 1 == 1<<map_size_bits
+
+        results = [driver.run(data) for data in (b"foo", b"bar", b"foo")]
+
+    assert len({result.pid for result in results}) == 3
+    assert [os.WEXITSTATUS(result.status) for result in results] == [12, 0, 12]
+
+    maps = [result.coverage for result in results]
+    assert maps[0] == maps[2]
+    assert maps[0] != maps[1]
+
+
+@pytest.mark.parametrize("shm_fuzz", (False, True,))
+def test_persistent_mode(shm_fuzz):
+    with Driver((sys.executable, "-c", persistent_target_source), shm_fuzz=shm_fuzz) as driver:
+        results = [driver.run(data) for data in (b"a", b"b\0", b"ccc", b"b\0", b"a")]
+    pids = [result.pid for result in results]
+
+    # a child should be reused for 3 iterations before being replaced
+    assert pids[0] == pids[1] == pids[2]
+    assert pids[3] == pids[4] != pids[0]
+
+    for i, result in enumerate(results):
+        if i == 2:
+            assert os.WIFEXITED(result.status) and os.WEXITSTATUS(result.status) == 0
+        else:
+            assert os.WIFSTOPPED(result.status)
+
+    maps = [result.coverage for result in results]
+    assert all(any(_map) for _map in maps)
+    # identical inputs at different iterations should produce identical traces
+    assert maps[0] == maps[4]
+    assert maps[1] == maps[3]
+    assert maps[0] != maps[1]
+
+
+@pytest.mark.parametrize("shm_fuzz", (False, True,))
+def test_autodict(shm_fuzz):
+    with Driver((sys.executable, "-c", autodict_target_source), shm_fuzz=shm_fuzz) as driver:
+        assert driver.options & FS_OPT_AUTODICT
+        assert bool(driver.options & FS_OPT_SHDMEM_FUZZ) == shm_fuzz
+        assert b"MAGIC" in driver.autodict
+
+        results = [driver.run(data) for data in (b"MAGIC", b"MAGI")]
+    assert [os.WEXITSTATUS(result.status) for result in results] == [12, 0]
+
+
+def test_launcher(tmp_path):
+    socket_path = str(tmp_path / "launcher.sock")
+    harness_path = tmp_path / "harness.py"
+    warm_up_path = tmp_path / "warm-up"
+    harness_path.write_text(
+        "open({!r}, 'a').write('warm\\n')\n".format(str(warm_up_path)) + oneshot_target_source
+    )
+
+    server = subprocess.Popen(
+        (sys.executable, "-m", "cpytraceafl.launcher", "serve", socket_path, str(harness_path)),
+    )
+    try:
+        for _ in range(1000):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.01)
+
+        connect_args = (sys.executable, "-m", "cpytraceafl.launcher", "connect", socket_path)
+        with Driver(connect_args) as driver_a, Driver(connect_args) as driver_b:
+            for driver in (driver_a, driver_b):
+                assert driver.options & FS_OPT_ENABLED == FS_OPT_ENABLED
+
+                results = [driver.run(data) for data in (b"foo", b"bar", b"foo")]
+                assert [os.WEXITSTATUS(result.status) for result in results] == [12, 0, 12]
+
+                maps = [result.coverage for result in results]
+                assert maps[0] == maps[2]
+                assert maps[0] != maps[1]
+
+        # warm-up should only have happened the once
+        assert warm_up_path.read_text() == "warm\n"
+    finally:
+        server.kill()
+        server.wait()
+
+
+def test_heap_preparation(tmp_path):
+    fault_stats_path = tmp_path / "fault_stats"
+    with Driver((
+        sys.executable,
+        "-c",
+        heap_target_source.format(fault_stats_path=str(fault_stats_path)),
+    )) as driver:
+        results = [driver.run(data) for data in (b"foo", b"bar")]
+    assert [os.WEXITSTATUS(result.status) for result in results] == [0, 0]
+
+    # the forkserver should write out its final counts on going away
+    stats = dict(
+        (key.strip(), value.strip())
+        for key, value in (line.split(":") for line in fault_stats_path.read_text().splitlines())
+    )
+    assert int(stats["execs"]) == 2
+    assert int(stats["minor_faults"]) > 0
+    assert float(stats["faults_per_exec"]) > 0
+
+
+def test_postfork_profile(tmp_path):
+    summary_path = tmp_path / "postfork"
+    with Driver(
+        (sys.executable, "-c", postfork_target_source),
+        env=dict(os.environ, **{POSTFORK_PROFILE_ENV_VAR: str(summary_path)}),
+    ) as driver:
+        results = [driver.run(data) for data in (b"bar", b"foo", b"foo")]
+    assert [os.WEXITSTATUS(result.status) for result in results] == [0, 0, 0]
+
+    # only the children which imported anything should have written a summary, each
+    # having to repeat the import
+    summary = summary_path.read_text()
+    assert summary.count("pid ") == 2
+    assert summary.count("import colorsys x1") == 2
+    assert "pid {}:".format(results[0].pid) not in summary
+
+
+@pytest.mark.parametrize("shm_fuzz,max_iterations", (
+    (False, 1),
+    (True, 1),
+    (False, 3),
+))
+def test_hang_triage(tmp_path, shm_fuzz, max_iterations):
+    triage_dir = tmp_path / "triage"
+    with Driver(
+        # the testcase isn't the first argument, so triage must be told where to find it
+        (
+            sys.executable,
+            "-c",
+            hang_target_source.format(max_iterations=max_iterations, triage_dir=str(triage_dir)),
+            "unused",
+            "@@",
+        ),
+        shm_fuzz=shm_fuzz,
+        timeout=1.5,
+    ) as driver:
+        inputs = (b"fast", b"hang", b"slow", b"fast", b"hang")
+        results = [driver.run(data) for data in inputs]
+
+    statuses = [result.status for result in results]
+    for status in (statuses[1], statuses[4]):
+        # left for the fuzzer's own timeout to kill
+        assert os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL
+    for status in statuses[:1] + statuses[2:4]:
+        assert os.WIFSTOPPED(status) or os.WEXITSTATUS(status) == 0
+    for result in results[:1] + results[2:4]:
+        assert result.elapsed < 1.5
+
+    assert sorted(p.name for p in triage_dir.iterdir()) == [
+        "hang-000002.input",
+        "hang-000002.stacks",
+        "hang-000005.input",
+        "hang-000005.stacks",
+        "slow-000003.input",
+        TRIAGE_LOG_NAME,
+    ]
+    assert (triage_dir / "hang-000002.input").read_bytes() == b"hang"
+    assert (triage_dir / "slow-000003.input").read_bytes() == b"slow"
+    stacks = (triage_dir / "hang-000005.stacks").read_text()
+    assert 'File "target.py"' in stacks
+    assert stacks.index("in spin") < stacks.index("in target")
+
+    log = [line.split("\t") for line in (triage_dir / TRIAGE_LOG_NAME).read_text().splitlines()]
+    assert [name for name, _ in log] == ["hang-000002", "slow-000003", "hang-000005"]
+    assert 0.5 <= float(log[0][1]) < 1.0
+    assert 0.2 <= float(log[1][1]) < 0.5
+
+
+def test_warm_up(tmp_path, monkeypatch):
+    for name in ("a", "b"):
+        (tmp_path / "cpytraceafl_test_lazy_{}.py".format(name)).write_text("")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    seed_paths = []
+    for i, data in enumerate((b"a", b"xyz")):
+        seed_path = tmp_path / "seed{}".format(i)
+        seed_path.write_bytes(data)
+        seed_paths.append(str(seed_path))
+
+    warm_pid = os.getpid()
+    def target(data):
+        if data == b"a":
+            import cpytraceafl_test_lazy_a
+        if os.getpid() != warm_pid:
+            # standing in for state which doesn't survive a fork
+            import cpytraceafl_test_lazy_b
+            (lambda: None)()
+        raise ValueError("should be ignored")
+
+    try:
+        with pytest.warns(UserWarning) as record:
+            imported = warm_up(target, seed_paths)
+
+        assert {"cpytraceafl_test_lazy_a", "cpytraceafl_test_lazy_b"} <= imported
+        messages = [str(warning.message) for warning in record]
+        assert any("post-fork" in m and "cpytraceafl_test_lazy_b" in m for m in messages)
+        assert any("post-fork" in m and "<lambda>" in m for m in messages)
+        assert not any("cpytraceafl_test_lazy_a" in m for m in messages)
+    finally:
+        for name in ("a", "b"):
+            sys.modules.pop("cpytraceafl_test_lazy_{}".format(name), None)
@@ -0,0 +1,31 @@
+import sys
+
+from cpytraceafl import postfork
+
+
+def test_profiler(tmp_path, monkeypatch):
+    (tmp_path / "postfork_test_module.py").write_text("VALUE = 123\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    summary_path = tmp_path / "summary"
+
+    postfork.install_profiler(str(summary_path))
+    try:
+        import postfork_test_module
+        assert postfork_test_module.VALUE == 123
+        # importing again loads nothing and shouldn't be counted
+        import postfork_test_module
+        compile("a = 1", "<postfork test>", "exec")
+
+        postfork.write_summary()
+        # nothing more recorded, so nothing further written
+        postfork.write_summary()
+    finally:
+        postfork.uninstall_profiler()
+        monkeypatch.delitem(sys.modules, "postfork_test_module", raising=False)
+
+    header, *lines = summary_path.read_text().splitlines()
+    assert header.startswith("pid ")
+    assert "1 import" in header
+    assert " compile " in header
+    assert any(l.split()[:3] == ["import", "postfork_test_module", "x1"] for l in lines)
+    assert any(l.split()[:3] == ["compile", "<postfork", "test>"] for l in lines)
@@ -1,5 +1,6 @@
 import builtins
 import dis
+import os
 from itertools import chain, count
 import random
 import sys
@@ -65,10 +66,22 @@ def zab(x, y, z, *w):
 """
 
 
+def _linetable_as_lnotab(code_obj):
+    # re-express a >= 3.10 line table in the old lnotab format so we can share a compact
+    # representation of expected results between versions
+    lnotab = bytearray()
+    last_offset, last_line = 0, code_obj.co_firstlineno
+    for start, end, line in code_obj.co_lines():
+        if line is not None and line != last_line and end > start:
+            lnotab.extend((start - last_offset, line - last_line))
+            last_offset, last_line = start, line
+    return bytes(lnotab)
+
+
 def _extract_lnotabs(code_obj):
     return (
         tuple(_extract_lnotabs(const) for const in code_obj.co_consts if isinstance(const, CodeType)),
-        code_obj.co_lnotab,
+        code_obj.co_lnotab if pv < (3, 10) else _linetable_as_lnotab(code_obj),
     )
 
 
@@ -77,102 +90,113 @@ def _l(*a):
     return bytes(chain.from_iterable((b, 1) for b in a))
 
 
+def _for_pv(*version_value_pairs):
+    # select the value given for the most recent listed python version not newer than ours
+    return [value for version, value in version_value_pairs if pv >= version][-1]
+
+
+def _expected_lnotabs(lambda_, qux, listcomp, baz, genexpr, zab, module):
+    # arrange per-code-object expectations in the shape of test_source's tree of code objects
+    return (
+        (
+            (
+                (
+                    ((((), lambda_),), qux),
+                # comprehensions get inlined from 3.12
+                ) + ((((), listcomp),) if pv < (3, 12) else ()),
+                baz,
+            ),
+            ((((), genexpr),), zab),
+        ),
+        module,
+    )
+
+
+_full_baz_lnotab = _for_pv(
+    ((3, 5), _l(0, 38, 40, 10, 17, 4, 11, 6, 4, 12, 10, 12, 6, 6, 16, 12, 47, 3, 4, 7, 4, 1,)),
+    ((3, 6), _l(0, 28, 28, 8, 14, 4, 10, 4, 4, 8, 8, 8, 4, 4, 12, 8, 34, 2, 4, 6, 4, 2,)),
+    ((3, 8), _l(0, 26, 28, 8, 14, 4, 8, 4, 4, 8, 8, 8, 4, 4, 10, 8, 34, 2, 4, 6, 4,)),
+    ((3, 9), _l(0, 26, 28, 8, 14, 4, 8, 4, 10, 8, 8, 4, 6, 8, 8, 8, 4, 4, 2, 8, 8, 34, 2, 4, 6, 4,)),
+    ((3, 10), _l(
+        0, 28, 28, 8, 14, 4, 8, 4, 10, 8, 8, 4, 4, 2, 8, 8, 8, 4, 4, 2, 16, 34, 2, 4, 6, 4, 8, 4,
+    )),
+    ((3, 11), _l(
+        0, 60, 80, 8, 52, 6, 16, 14, 14, 10, 12, 14, 14, 2, 14, 10, 12, 14, 14, 2, 6, 18, 70, 2,
+        16, 8, 4, 12, 4,
+    )),
+    ((3, 12), _l(
+        0, 48, 78, 8, 48, 6, 12, 12, 12, 10, 10, 12, 12, 16, 32, 18, 10, 4, 22, 4, 10, 8, 2, 10,
+        2, 2, 2, 12, 10, 10, 12, 12, 2, 6, 10,
+    )),
+    ((3, 13), _l(
+        0, 46, 88, 10, 48, 8, 24, 12, 14, 8, 12, 22, 12, 18, 32, 26, 8, 6, 34, 4, 10, 18, 2, 10,
+        4, 2, 2, 14, 8, 12, 22, 12, 2, 6, 10,
+    )),
+)
+_full_zab_lnotab = _for_pv(
+    ((3, 5), _l(0, 12, 6, 7, 45, 10, 14, 10, 14, 10, 18, 1, 4,)),
+    ((3, 6), _l(0, 8, 4, 6, 30, 8, 12, 8, 12, 8, 16, 6,)),
+    ((3, 8), _l(0, 8, 4, 6, 36, 8, 20, 8, 20, 8, 24, 6,)),
+    ((3, 9), _l(0, 8, 4, 6, 42, 6, 26, 6, 26, 6, 30, 14, 10,)),
+    ((3, 10), _l(0, 8, 4, 6, 42, 6, 26, 6, 26, 6, 30, 2,)),
+    ((3, 11), _l(0, 28, 4, 8, 50, 18, 36, 16, 36, 16, 48, 2, 6, 14,)),
+    ((3, 12), _l(0, 22, 4, 8, 44, 16, 30, 14, 30, 14, 36, 2, 6, 14,)),
+    ((3, 13), _l(0, 32, 4, 8, 46, 18, 30, 16, 30, 16, 36, 2, 6, 14,)),
+)
+
+
 @pytest.mark.parametrize("selector,expected_lnotabs", tuple(chain.from_iterable(
     # keep together a number of "aliases" of a selector that should result in the same output
     ((selector, expected_lnotabs) for selector in selector_aliases)
     for selector_aliases, expected_lnotabs in (
         (
             (True, lambda _: True, 100, lambda _: 100, 99.99, lambda _: 99.99, 1000,),
-            (
-                (
-                    (
-                        (
-                            (
-                                (
-                                    # lambda
-                                    ((), _l(0, 6, 7,) if pv < (3, 6) else _l(0, 4, 6,)),
-                                ),
-                                # qux
-                                (
-                                    _l(0, 73, 10, 23, 13, 1,)
-                                    if pv < (3, 6) else (
-                                        _l(0, 58, 8, 22, 10, 2,)
-                                        if pv < (3, 7) else
-                                        _l(0, 58, 8, 20, 12, 2,)
-                                    )
-                                ),
-                            ),
-                            # listcomp
-                            ((), _l(0, 6, 16, 7, 6,) if pv < (3, 6) else _l(0, 4, 12, 6, 4,),),
-                        ),
-                        # baz
-                        (
-                            _l(0, 38, 40, 10, 17, 4, 11, 6, 4, 12, 10, 12, 6, 6, 16, 12, 47, 3, 4, 7, 4, 1,)
-                            if pv < (3, 6) else (
-                                _l(0, 28, 28, 8, 14, 4, 10, 4, 4, 8, 8, 8, 4, 4, 12, 8, 34, 2, 4, 6, 4, 2,)
-                                if pv < (3, 8) else
-                                _l(0, 26, 28, 8, 14, 4, 8, 4, 4, 8, 8, 8, 4, 4, 10, 8, 34, 2, 4, 6, 4,)
-                            )
-                        ),
-                    ),
-                    (
-                        (
-                            # genexpr
-                            (
-                                (),
-                                (
-                                    _l(0, 3, 12, 12, 9, 12, 9, 1, 4,)
-                                    if pv < (3, 6) else
-                                    _l(0, 2, 8, 8, 6, 8, 6, 2, 4,)
-                                ),
-                            ),
-                        ),
-                        # zab
-                        (
-                            _l(0, 12, 6, 7, 45, 10, 14, 10, 14, 10, 18, 1, 4,)
-                            if pv < (3, 6) else (
-                                _l(0, 8, 4, 6, 30, 8, 12, 8, 12, 8, 16, 6,)
-                                if pv < (3, 8) else
-                                _l(0, 8, 4, 6, 36, 8, 20, 8, 20, 8, 24, 6,)
-                            )
-                        ),
-                    ),
+            _expected_lnotabs(
+                lambda_=_for_pv(
+                    ((3, 5), _l(0, 6, 7,)),
+                    ((3, 6), _l(0, 4, 6,)),
+                    ((3, 11), _l(0, 8, 8,)),
+                    ((3, 12), _l(0, 10, 10,)),
+                    ((3, 13), _l(0, 20, 10,)),
+                ),
+                qux=_for_pv(
+                    ((3, 5), _l(0, 73, 10, 23, 13, 1,)),
+                    ((3, 6), _l(0, 58, 8, 22, 10, 2,)),
+                    ((3, 7), _l(0, 58, 8, 20, 12, 2,)),
+                    ((3, 9), _l(0, 58, 6, 28, 8, 2,)),
+                    ((3, 10), _l(0, 60, 6, 30, 8,)),
+                    ((3, 11), _l(0, 160, 18, 42, 8, 2, 6,)),
+                    ((3, 12), _l(0, 138, 16, 36, 8, 2,)),
+                    ((3, 13), _l(0, 140, 18, 36, 8, 2,)),
                 ),
-                # module
-                _l(0,),
+                listcomp=_for_pv(
+                    ((3, 5), _l(0, 6, 16, 7, 6,)),
+                    ((3, 6), _l(0, 4, 12, 6, 4,)),
+                    ((3, 11), _l(0, 8, 20, 14, 4,)),
+                ),
+                baz=_full_baz_lnotab,
+                genexpr=_for_pv(
+                    ((3, 5), _l(0, 3, 12, 12, 9, 12, 9, 1, 4,)),
+                    ((3, 6), _l(0, 2, 8, 8, 6, 8, 6, 2, 4,)),
+                    ((3, 10), _l(0, 4, 8, 8, 6, 8, 6, 2, 4,)),
+                    ((3, 11), _l(0, 10, 8, 22, 14, 22, 20, 2, 6,)),
+                    ((3, 12), _l(0, 10, 10, 2, 16, 2, 24, 16, 14, 2, 6, 4,)),
+                    ((3, 13), _l(0, 10, 18, 4, 26, 4, 34, 16, 14, 2, 8, 6,)),
+                ),
+                zab=_full_zab_lnotab,
+                module=_l(0,),
             ),
         ),
         (
             (False, lambda _: False, 0, lambda _: 0,),
-            (
-                (
-                    (
-                        (
-                            (
-                                (
-                                    # lambda
-                                    ((), b""),
-                                ),
-                                # qux
-                                b"",
-                            ),
-                            # listcomp
-                            ((), b"",),
-                        ),
-                        # baz
-                        b"",
-                    ),
-                    (
-                        (
-                            # genexpr
-                            ((), b"",),
-                        ),
-                        # zab
-                        b"",
-                    ),
-                ),
-                # module
-                b"",
+            _expected_lnotabs(
+                lambda_=b"",
+                qux=b"",
+                listcomp=b"",
+                baz=b"",
+                genexpr=b"",
+                zab=b"",
+                module=b"",
             ),
         ),
         (
@@ -180,96 +204,55 @@ def _l(*a):
                 lambda code: code.co_name in ("baz", "zab"),
                 lambda code: 100 if code.co_name in ("baz", "zab") else 0,
             ),
-            (
-                (
-                    (
-                        (
-                            (
-                                (
-                                    # lambda
-                                    ((), b""),
-                                ),
-                                # qux
-                                b"",
-                            ),
-                            # listcomp
-                            ((), b"",),
-                        ),
-                        # baz
-                        (
-                            _l(0, 38, 40, 10, 17, 4, 11, 6, 4, 12, 10, 12, 6, 6, 16, 12, 47, 3, 4, 7, 4, 1,)
-                            if pv < (3, 6) else (
-                                _l(0, 28, 28, 8, 14, 4, 10, 4, 4, 8, 8, 8, 4, 4, 12, 8, 34, 2, 4, 6, 4, 2,)
-                                if pv < (3, 8) else
-                                _l(0, 26, 28, 8, 14, 4, 8, 4, 4, 8, 8, 8, 4, 4, 10, 8, 34, 2, 4, 6, 4,)
-                            )
-                        ),
-                    ),
-                    (
-                        (
-                            # genexpr
-                            ((), b"",),
-                        ),
-                        # zab
-                        (
-                            _l(0, 12, 6, 7, 45, 10, 14, 10, 14, 10, 18, 1, 4,)
-                            if pv < (3, 6) else (
-                                _l(0, 8, 4, 6, 30, 8, 12, 8, 12, 8, 16, 6,)
-                                if pv < (3, 8) else
-                                _l(0, 8, 4, 6, 36, 8, 20, 8, 20, 8, 24, 6,)
-                            )
-                        ),
-                    ),
-                ),
-                # module
-                b"",
+            _expected_lnotabs(
+                lambda_=b"",
+                qux=b"",
+                listcomp=b"",
+                baz=_full_baz_lnotab,
+                genexpr=b"",
+                zab=_full_zab_lnotab,
+                module=b"",
             ),
         ),
         (
             (20, lambda _: 20,),
-            (
-                (
-                    (
-                        (
-                            (
-                                (
-                                    # lambda
-                                    ((), b"",),
-                                ),
-                                # qux
-                                _l(0,),
-                            ),
-                            # listcomp
-                            ((), b"",),
-                        ),
-                        # baz
-                        (
-                            _l(0, 38, 88, 66, 77, 1,)
-                            if pv < (3, 6) else (
-                                _l(0, 28, 68, 48, 58, 2,)
-                                if pv < (3, 8) else
-                                _l(0, 26, 66, 46, 58,)
-                            )
-                        ),
-                    ),
-                    (
-                        (
-                            # genexpr
-                            ((), _l(48,) if pv < (3, 6) else _l(32,),),
-                        ),
-                        # zab
-                        (
-                            _l(80, 14, 57,)
-                            if pv < (3, 6) else (
-                                _l(56, 12,)
-                                if pv < (3, 8) else
-                                _l(62, 20,)
-                            )
-                        ),
-                    ),
+            _expected_lnotabs(
+                lambda_=b"",
+                qux=_for_pv(
+                    ((3, 5), _l(0,)),
+                    ((3, 11), _l(0, 236,)),
+                    ((3, 12), _l(0,)),
+                ),
+                listcomp=b"",
+                baz=_for_pv(
+                    ((3, 5), _l(0, 38, 88, 66, 77, 1,)),
+                    ((3, 6), _l(0, 28, 68, 48, 58, 2,)),
+                    ((3, 8), _l(0, 26, 66, 46, 58,)),
+                    ((3, 9), _l(0, 26, 66, 52, 34, 34,)),
+                    ((3, 10), _l(0, 28, 66, 44, 42, 34, 28,)),
+                    ((3, 11), _l(0, 60, 176, 80, 58, 18, 112, 4,)),
+                    ((3, 12), _l(0, 48, 164, 104, 68, 8, 30, 10, 52,)),
+                    ((3, 13), _l(0, 46, 190, 118, 88, 18, 34, 8, 64,)),
                 ),
-                # module
-                _l(0,),
+                genexpr=_for_pv(
+                    ((3, 5), _l(48,)),
+                    ((3, 6), _l(32,)),
+                    ((3, 10), _l(34,)),
+                    ((3, 11), _l(76,)),
+                    ((3, 12), _l(40,)),
+                    ((3, 13), _l(62,)),
+                ),
+                zab=_for_pv(
+                    ((3, 5), _l(80, 14, 57,)),
+                    ((3, 6), _l(56, 12,)),
+                    ((3, 8), _l(62, 20,)),
+                    ((3, 9), _l(66, 26, 92,)),
+                    ((3, 10), _l(66, 26,)),
+                    ((3, 11), _l(108, 36, 124,)),
+                    ((3, 12), _l(94, 30, 102,)),
+                    ((3, 13), _l(108, 30, 106,)),
+                ),
+                module=_l(0,),
             ),
         ),
     )
@@ -294,3 +277,294 @@ def test_rewrite(selector, expected_lnotabs):
     rewritten = rewriter.rewrite(sys.version_info, dis, mock_random_class, orig_code, selector)
 
     assert _extract_lnotabs(rewritten) == expected_lnotabs
+
+
+def _iter_firstlinenos(code_obj):
+    yield code_obj.co_firstlineno
+    for const in code_obj.co_consts:
+        if isinstance(const, CodeType):
+            yield from _iter_firstlinenos(const)
+
+
+@pytest.mark.parametrize("selector", (True, False, lambda code: code.co_name in ("baz", "zab"),))
+def test_rewrite_block_ids(selector):
+    orig_code = builtins.compile(test_source, "foo.py", "exec")
+
+    hashed = rewriter.rewrite(sys.version_info, dis, random.Random, orig_code, selector)
+    block_ids = rewriter.rewrite(sys.version_info, dis, random.Random, orig_code, selector, block_ids=True)
+
+    # the same blocks should be marked
+    assert _extract_lnotabs(block_ids) == _extract_lnotabs(hashed)
+
+    for hashed_firstlineno, block_ids_firstlineno in zip(
+        _iter_firstlinenos(hashed),
+        _iter_firstlinenos(block_ids),
+    ):
+        assert not hashed_firstlineno & rewriter.BLOCK_ID_LINENO_FLAG
+        assert block_ids_firstlineno & rewriter.BLOCK_ID_LINENO_FLAG
+        # the same hash of the code object should form the base of both
+        assert (block_ids_firstlineno ^ hashed_firstlineno) & 0xffff == 0
+
+
+def _iter_code_objs(code_obj):
+    yield code_obj
+    for const in code_obj.co_consts:
+        if isinstance(const, CodeType):
+            yield from _iter_code_objs(const)
+
+
+@pytest.mark.parametrize("never_select", (False, True,))
+def test_rewrite_cmplog(never_select):
+    orig_code = builtins.compile(test_source, "foo.py", "exec")
+
+    if never_select:
+        # a random instance which will decline to instrument every location
+        selector = 50
+        mock_random_class = mock.create_autospec(random.Random)
+        mock_random_class.return_value.getrandbits.side_effect = lambda bits: (1<<bits) - 1
+    else:
+        selector = True
+        mock_random_class = random.Random
+
+    plain = rewriter.rewrite(sys.version_info, dis, mock_random_class, orig_code, selector)
+    cmplog = rewriter.rewrite(sys.version_info, dis, mock_random_class, orig_code, selector, cmplog=True)
+
+    compare_opnames = ("COMPARE_OP", "CONTAINS_OP")
+    n_compares = 0
+    for orig_code_obj, plain_code_obj, cmplog_code_obj in zip(
+        _iter_code_objs(orig_code),
+        _iter_code_objs(plain),
+        _iter_code_objs(cmplog),
+    ):
+        compare_offsets = {
+            inst.offset for inst in dis.get_instructions(orig_code_obj)
+            if inst.opname in compare_opnames
+        }
+        n_compares += len(compare_offsets)
+        plain_starts = {offset for offset, _ in dis.findlinestarts(plain_code_obj)}
+        cmplog_starts = {offset for offset, _ in dis.findlinestarts(cmplog_code_obj)}
+
+        # comparisons should be instrumented regardless of instrumentation ratio
+        assert compare_offsets <= cmplog_starts
+        if not never_select:
+            assert cmplog_starts == plain_starts | compare_offsets
+
+    # make sure we're actually testing something
+    assert n_compares
+
+
+dictionary_test_source = """
+MAGIC = b"not used near a comparison"
+
+def foo(data, d):
+    x = "nor this"
+    if data[:4] == b"%PDF":
+        return 1
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return 2
+    if d.get("/Type") == "/Page":
+        return 3
+    if data.upper() == b"X":
+        return 4
+    return d["/Root"] if data in {"spam", "eggs"} else 0x1234 == len(data)
+
+def bar(data):
+    return data.split(b"--boundary") == [1000000]
+
+def baz(data):
+    return data == b"not instrumented"
+"""
+
+
+def test_collect_dictionary_tokens():
+    orig_code = builtins.compile(dictionary_test_source, "foo.py", "exec")
+    rewritten = rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        orig_code,
+        lambda code: code.co_name != "baz",
+    )
+
+    tokens = set()
+    rewriter.collect_dictionary_tokens(sys.version_info, dis, rewritten, tokens)
+
+    assert tokens == {
+        b"%PDF",
+        b"GIF87a",
+        b"GIF89a",
+        b"/Type",
+        b"/Page",
+        b"/Root",
+        b"spam",
+        b"eggs",
+        b"\x34\x12",
+        b"\x12\x34",
+        b"--boundary",
+        b"\x40\x42\x0f\x00",
+        b"\x00\x0f\x42\x40",
+    }
+
+
+@pytest.mark.skipif(pv < (3, 10), reason="co_linetable introduced in python 3.10")
+@pytest.mark.parametrize("block_offsets", (
+    (0,),
+    (0, 2, 4,),
+    # leaving code before the first block, and blocks too long for a single table entry
+    (6, 20, 540,),
+))
+def test_encode_linetable(block_offsets):
+    code = builtins.compile("x = 1\n" * 200, "foo.py", "exec")
+    code = code.replace(co_linetable=rewriter._encode_linetable(
+        sys.version_info,
+        block_offsets,
+        len(code.co_code),
+    ))
+
+    ranges = list(code.co_lines())
+    # every byte of code should be covered by the table
+    assert ranges[-1][1] == len(code.co_code)
+
+    line_starts = {}
+    for start, end, line in ranges:
+        if end > start:
+            line_starts.setdefault(line, start)
+    assert line_starts == dict(
+        # code before the first block retains co_firstlineno
+        ([(code.co_firstlineno, 0)] if block_offsets[0] else [])
+        + [(code.co_firstlineno + i + 1, offset) for i, offset in enumerate(block_offsets)]
+    )
+
+
+cache_test_source = """
+def baz(a, b):
+    for c in a:
+        if c > b:
+            return c
+"""
+
+
+@pytest.fixture
+def restore_rewriter_targets():
+    import _frozen_importlib_external
+    with mock.patch.object(builtins, "compile", builtins.compile), \
+            mock.patch.object(
+                _frozen_importlib_external,
+                "_compile_bytecode",
+                _frozen_importlib_external._compile_bytecode,
+            ), \
+            mock.patch.object(
+                _frozen_importlib_external.SourceLoader,
+                "get_code",
+                _frozen_importlib_external.SourceLoader.get_code,
+            ):
+        yield
+
+
+@pytest.mark.skipif(pv < (3, 7), reason="rewrite caching requires python 3.7")
+@pytest.mark.parametrize("selector,cache_tag,block_ids,hash_seed,expect_cache,expected_cache_tag", (
+    (True, None, False, "123", True, "True"),
+    (50, None, False, "0", True, "50"),
+    (lambda code: True, "mytag", False, "123", True, "mytag"),
+    (lambda code: True, None, False, "123", False, None),
+    (True, False, False, "123", False, None),
+    (True, None, False, None, False, None),
+    (True, None, False, "random", False, None),
+    (True, None, True, "123", True, "True-ids"),
+    (lambda code: True, "mytag", True, "123", True, "mytag-ids"),
+))
+def test_rewrite_cache(
+    tmp_path,
+    restore_rewriter_targets,
+    selector,
+    cache_tag,
+    block_ids,
+    hash_seed,
+    expect_cache,
+    expected_cache_tag,
+):
+    import importlib
+
+    module_path = tmp_path / "cachetestmod.py"
+    module_path.write_text(cache_test_source)
+
+    env = {"PYTHONHASHSEED": hash_seed} if hash_seed else {}
+    with mock.patch.dict("os.environ", env), \
+            mock.patch.object(sys, "path", [str(tmp_path)] + sys.path), \
+            mock.patch.object(sys, "dont_write_bytecode", False):
+        if hash_seed is None:
+            os.environ.pop("PYTHONHASHSEED", None)
+        rewriter.install_rewriter(selector=selector, cache_tag=cache_tag, block_ids=block_ids)
+
+        def _import_and_forget():
+            try:
+                return importlib.import_module("cachetestmod").baz.__code__
+            finally:
+                sys.modules.pop("cachetestmod", None)
+
+        first_code = _import_and_forget()
+        cache_files = list((tmp_path / "__pycache__").glob("cachetestmod.*.cpytraceafl-*.pyc"))
+
+        if not expect_cache:
+            assert not cache_files
+            return
+
+        assert [p.name.split(".", 2)[2] for p in cache_files] == [
+            "cpytraceafl-{}-{}.pyc".format(expected_cache_tag, hash_seed)
+        ]
+        # rewritten code shouldn't find its way into the regular bytecode cache
+        assert len(list((tmp_path / "__pycache__").iterdir())) == 1
+
+        with mock.patch.object(rewriter, "rewrite", side_effect=AssertionError):
+            second_code = _import_and_forget()
+
+        assert second_code.co_firstlineno == first_code.co_firstlineno
+        assert _extract_lnotabs(second_code) == _extract_lnotabs(first_code)
+        assert bool(first_code.co_firstlineno & rewriter.BLOCK_ID_LINENO_FLAG) == block_ids
+
+        # a change in source should be noticed
+        module_path.write_text(cache_test_source + "\nxyz = 1\n")
+        with mock.patch.object(rewriter, "rewrite", wraps=rewriter.rewrite) as rewrite_mock:
+            _import_and_forget()
+        assert rewrite_mock.called
+
+
+@pytest.mark.skipif(pv < (3, 7), reason="rewrite caching requires python 3.7")
+def test_rewrite_cache_index(tmp_path, restore_rewriter_targets):
+    import importlib
+    import marshal
+
+    module_path = tmp_path / "cacheindextestmod.py"
+    module_path.write_text(cache_test_source)
+    index_path = tmp_path / "index"
+
+    with mock.patch.dict("os.environ", {"PYTHONHASHSEED": "123"}), \
+            mock.patch.object(sys, "path", [str(tmp_path)] + sys.path), \
+            mock.patch.object(sys, "dont_write_bytecode", False):
+        rewriter.install_rewriter(index_path=str(index_path))
+
+        for _ in range(2):
+            try:
+                importlib.import_module("cacheindextestmod")
+            finally:
+                sys.modules.pop("cacheindextestmod", None)
+
+    assert [p.name.split(".", 2)[2] for p in (tmp_path / "__pycache__").glob("*cpytraceafl*")] == [
+        "cpytraceafl-True-index-123.pyc",
+    ]
+
+    chunks = []
+    with open(str(index_path), "rb") as f:
+        while True:
+            try:
+                chunks.append(marshal.load(f))
+            except EOFError:
+                break
+
+    # the second, cached import should have provided the same entries as the first
+    assert len(chunks) == 2
+    assert chunks[0] == chunks[1]
+    entries_by_name = {entry[1]: entry for entry in chunks[0]}
+    assert set(entries_by_name) == {"<module>", "baz"}
+    assert entries_by_name["baz"][0] == str(module_path)
+    assert entries_by_name["baz"][3] == 2
@@ -0,0 +1,120 @@
+import dis
+import random
+import sys
+
+import pytest
+
+from cpytraceafl import rewriter, saturation
+from cpytraceafl.driver import Driver, count_covered
+
+from tracing import run_traced
+
+
+saturation_test_source = """
+def hot(x):
+    total = 0
+    for i in range(x):
+        if i & 1:
+            total += i
+        else:
+            total -= 1
+    return total
+
+def cold(x):
+    if x == 12345:
+        return 1
+    return 0
+"""
+
+
+@pytest.mark.parametrize("backend", ("python", "native", "monitoring",))
+def test_deinstrument_saturated(backend):
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring requires python 3.12")
+
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(saturation_test_source, "saturation.py", "exec"),
+    ), namespace)
+    hot, cold = namespace["hot"], namespace["cold"]
+
+    def exercise():
+        for _ in range(4):
+            hot(6)
+            cold(0)
+
+    monitoring = backend == "monitoring"
+    codes = [hot.__code__, cold.__code__]
+    saturation.install_hit_counters(16)
+    try:
+        run_traced(backend, exercise)
+
+        for code in codes:
+            assert saturation.code_locations(code, 16, monitoring)
+
+        assert saturation.deinstrument_saturated(100, codes, monitoring) == []
+        assert saturation.deinstrument_saturated(4, codes, monitoring) == [hot.__code__]
+        # cold's untaken branch will never be counted
+        assert saturation.deinstrument_saturated(1, codes, monitoring) == []
+    finally:
+        saturation.uninstall_hit_counters()
+
+    assert not any(run_traced(backend, hot, 6))
+    assert any(run_traced(backend, cold, 0))
+
+
+def test_find_instrumented_code():
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(saturation_test_source, "saturation.py", "exec"),
+        lambda code: code.co_name == "hot",
+    ), namespace)
+
+    code_ids = set(id(code) for code in saturation.find_instrumented_code())
+    assert id(namespace["hot"].__code__) in code_ids
+    assert id(namespace["cold"].__code__) not in code_ids
+
+
+forkserver_target_source = """
+import cpytraceafl
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter()
+
+exec(compile({source!r}, "saturation.py", "exec"))
+exec(compile('''
+def target(data):
+    if data == b"hot":
+        hot(6)
+''', "target.py", "exec"))
+
+# check after every exec
+cpytraceafl.SATURATION_CHECK_INTERVAL = 0
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here(freeze={freeze!r}, saturation_threshold=3)
+target(read_input())
+"""
+
+
+@pytest.mark.parametrize("freeze", (False, True,))
+def test_forkserver_saturation(freeze):
+    with Driver((sys.executable, "-c", forkserver_target_source.format(
+        source=saturation_test_source,
+        freeze=freeze,
+    ))) as driver:
+        results = [driver.run(data) for data in (b"hot", b"none") * 6]
+
+    assert all(result.status == 0 for result in results)
+    covered = [count_covered(result.coverage) for result in results]
+    # everything else children run (including target) will saturate too, so hot's
+    # contribution is the difference from a neighbouring exec not calling it
+    assert covered[0] > covered[1]
+    assert covered[-2] == covered[-1]
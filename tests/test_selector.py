@@ -0,0 +1,237 @@
+import fnmatch
+import os
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+from cpytraceafl import rewriter
+from cpytraceafl.selector import Selector, _glob_match, parse_rules, selector_from_env
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for rel_path in (
+        "mypkg/__init__.py",
+        "mypkg/core.py",
+        "mypkg/vendor/__init__.py",
+        "mypkg/vendor/six.py",
+        "mypkg/tests/test_core.py",
+        "mypkgextra.py",
+        "other.py",
+        "plugins/a.py",
+    ):
+        path = tmp_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    with mock.patch.object(sys, "path", [str(tmp_path)] + sys.path):
+        yield tmp_path
+
+
+@pytest.mark.parametrize("rules,default,expected", (
+    ((), True, {"mypkg/core.py": True, "other.py": True}),
+    ((), 50, {"mypkg/core.py": 50, "other.py": 50}),
+    (
+        (("mypkg", True), ("mypkg.vendor", False)),
+        25,
+        {
+            "mypkg/__init__.py": True,
+            "mypkg/core.py": True,
+            "mypkg/vendor/__init__.py": False,
+            "mypkg/vendor/six.py": False,
+            "mypkgextra.py": 25,
+            "other.py": 25,
+        },
+    ),
+    (
+        # longest prefix wins regardless of order
+        (("mypkg.vendor", False), ("mypkg", 10)),
+        True,
+        {"mypkg/core.py": 10, "mypkg/vendor/six.py": False, "other.py": True},
+    ),
+    (
+        (("mypkg.*", False), ("other", 30)),
+        True,
+        {"mypkg/core.py": False, "mypkg/vendor/six.py": False, "other.py": 30},
+    ),
+    (
+        # globs are tried before anything else
+        (("mypkg", True), ("*.test_*", False), ("mypkg.vendor.s?x", 5)),
+        50,
+        {
+            "mypkg/core.py": True,
+            "mypkg/tests/test_core.py": False,
+            "mypkg/vendor/six.py": 5,
+            "mypkg/vendor/__init__.py": True,
+            "other.py": 50,
+        },
+    ),
+    (
+        (("{tree}/plugins/", 20), ("*/other.py", 0)),
+        True,
+        {"plugins/a.py": 20, "other.py": 0, "mypkg/core.py": True},
+    ),
+))
+def test_selector(tree, rules, default, expected):
+    selector = Selector(
+        [(pattern.format(tree=tree), selection) for pattern, selection in rules],
+        default,
+    )
+    for rel_path, selection in expected.items():
+        code = compile("", str(tree / rel_path), "exec")
+        assert selector(code) == selection, rel_path
+        # and once more, memoized
+        assert selector(code) == selection, rel_path
+
+
+def test_selector_stdlib(tree):
+    stdlib_dir = os.path.dirname(os.__file__)
+    selector = Selector(((":stdlib:", False), ("mypkg", 70)), default=40)
+    assert selector.select_filename(os.__file__) is False
+    assert selector.select_filename(os.path.join(stdlib_dir, "json", "decoder.py")) is False
+    assert selector.select_filename(
+        os.path.join(stdlib_dir, "site-packages", "foo", "__init__.py")
+    ) == 40
+    assert selector.select_filename(str(tree / "mypkg" / "core.py")) == 70
+    assert selector.select_filename("<string>") == 40
+
+
+def test_selector_cache_tag(tree):
+    tags = [
+        Selector(rules, default).cache_tag
+        for rules, default in (
+            ((("mypkg", True),), True),
+            ((("mypkg", True),), True),
+            ((("mypkg", False),), True),
+            ((("mypkg", True),), 50),
+            ((("mypkg*", True),), True),
+        )
+    ]
+    assert tags[0] == tags[1]
+    assert len(set(tags)) == 4
+    assert all(tag.isalnum() for tag in tags)
+
+
+@pytest.mark.parametrize("pattern", (
+    "",
+    "*",
+    "**",
+    "mypkg.*",
+    "*.test_*",
+    "mypkg.vendor.s?x",
+    "*/other.py",
+    "a*b*c",
+    "*a*a",
+    "[ab]*",
+    "[!ab]*",
+    "[a-c]?",
+    "[!a-c]*",
+    "[]]*",
+    "[!]]*",
+    "[a-]*",
+    "[*",
+    "a[",
+    "[[]*",
+))
+def test_glob_match(pattern):
+    for name in (
+        "",
+        "a",
+        "aa",
+        "abc",
+        "axbyc",
+        "ab",
+        "b",
+        "d",
+        "]",
+        "-x",
+        "[x",
+        "a[",
+        "mypkg",
+        "mypkg.core",
+        "mypkg.tests.test_core",
+        "mypkg.vendor.six",
+        "/tmp/x/other.py",
+    ):
+        assert _glob_match(name, pattern) == fnmatch.fnmatchcase(name, pattern), name
+
+
+def test_selector_imports_nothing():
+    # anything imported before the rewriter is installed goes uninstrumented
+    imported = []
+    for spec in ("", "json.*=0,*.test_*=0,json=50"):
+        output = subprocess.check_output((sys.executable, "-c", """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+before = set(sys.modules)
+install_rewriter()
+print(" ".join(sorted(set(sys.modules) - before)))
+"""), env=dict(os.environ, CPYTRACEAFL_SELECT=spec))
+        imported.append(set(output.decode().split()))
+
+    assert "cpytraceafl.selector" in imported[0]
+    assert imported[1] == imported[0]
+
+
+@pytest.mark.parametrize("spec,expected_rules,expected_default", (
+    ("", [], None),
+    ("mypkg=100", [("mypkg", True)], None),
+    (
+        " mypkg=100, mypkg.vendor=0,:stdlib:=0 ,*=50,",
+        [("mypkg", True), ("mypkg.vendor", 0), (":stdlib:", 0)],
+        50,
+    ),
+    ("/some/path=25,*=100", [("/some/path", 25)], True),
+))
+def test_parse_rules(spec, expected_rules, expected_default):
+    assert parse_rules(spec) == (expected_rules, expected_default)
+
+
+@pytest.mark.parametrize("spec", ("mypkg", "=50", "mypkg=lots"))
+def test_parse_rules_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_rules(spec)
+
+
+def test_selector_from_env(tree):
+    with mock.patch.dict("os.environ", {"CPYTRACEAFL_SELECT": ""}):
+        assert selector_from_env() is None
+
+    with mock.patch.dict("os.environ", {"CPYTRACEAFL_SELECT": "mypkg.vendor=0"}):
+        selector = selector_from_env(default=60)
+    assert selector.select_filename(str(tree / "mypkg" / "vendor" / "six.py")) == 0
+    assert selector.select_filename(str(tree / "other.py")) == 60
+
+    with mock.patch.dict("os.environ", {"CPYTRACEAFL_SELECT": "mypkg.vendor=0,*=10"}):
+        selector = selector_from_env(default=60)
+    assert selector.select_filename(str(tree / "other.py")) == 10
+
+
+def test_install_rewriter_selector_from_env(tree):
+    import builtins
+    import _frozen_importlib_external
+
+    with mock.patch.object(builtins, "compile", builtins.compile), \
+            mock.patch.object(
+                _frozen_importlib_external,
+                "_compile_bytecode",
+                _frozen_importlib_external._compile_bytecode,
+            ), \
+            mock.patch.object(
+                _frozen_importlib_external.SourceLoader,
+                "get_code",
+                _frozen_importlib_external.SourceLoader.get_code,
+            ), \
+            mock.patch.dict("os.environ", {"CPYTRACEAFL_SELECT": "mypkg.vendor=0"}), \
+            mock.patch.object(rewriter, "rewrite", wraps=rewriter.rewrite) as rewrite_mock:
+        rewriter.install_rewriter()
+        compile("x = 1", str(tree / "mypkg" / "vendor" / "six.py"), "exec")
+        compile("x = 1", str(tree / "other.py"), "exec")
+
+    selectors = [call[0][4] for call in rewrite_mock.call_args_list]
+    assert len(selectors) == 2 and selectors[0] is selectors[1]
+    assert isinstance(selectors[0], Selector)
+    assert [
+        selectors[0](call[0][3]) for call in rewrite_mock.call_args_list
+    ] == [0, True]
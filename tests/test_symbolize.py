@@ -0,0 +1,176 @@
+import ctypes
+import dis
+import mmap
+import random
+import sys
+from types import FrameType
+from unittest import mock
+
+import pytest
+
+from cpytraceafl import rewriter, symbolize, tracehook
+from cpytraceafl.driver import Driver
+
+
+pv = sys.version_info[:2]
+
+
+symbolize_test_source = """
+def foo(a, b):
+    if a:
+        for x in b:
+            if x == 3:
+                return 1
+    elif b:
+        return 2
+    return 3
+
+def bar(a):
+    try:
+        return a[0]
+    except IndexError:
+        return None
+"""
+
+
+def _record_line_events(code, func_name, calls):
+    namespace = {}
+    exec(code, namespace)
+    events = set()
+
+    def tracer(frame, event, arg):
+        if event == "line":
+            events.add((frame.f_code.co_name, frame.f_lineno, frame.f_lasti))
+        return tracer
+
+    sys.settrace(tracer)
+    try:
+        for args in calls:
+            namespace[func_name](*args)
+    finally:
+        sys.settrace(None)
+    return events
+
+
+@pytest.mark.parametrize("block_ids", (False, True,))
+def test_index_blocks(block_ids):
+    original_code = compile(symbolize_test_source, "symbolize_test.py", "exec")
+    rewritten_code = rewriter.rewrite(pv, dis, random.Random, original_code, block_ids=block_ids)
+    entries = []
+    rewriter.index_blocks(pv, dis, original_code, rewritten_code, entries)
+
+    entries_by_name = {entry[1]: entry for entry in entries}
+    assert set(entries_by_name) == {"<module>", "foo", "bar"}
+    foo_entry = entries_by_name["foo"]
+    assert foo_entry[0] == "symbolize_test.py"
+    assert foo_entry[3] == 2
+    original_linenos = set(original_lineno for _, _, original_lineno in foo_entry[4])
+    assert original_linenos <= set(range(2, 10))
+    assert len(original_linenos) >= 5
+
+    # every line event the tracer sees should be indexed
+    indexed = set((entry[1], lineno, offset) for entry in entries for lineno, offset, _ in entry[4])
+    events = _record_line_events(
+        rewritten_code,
+        "foo",
+        ((1, (1, 2, 3)), (1, ()), (0, (1,)), (0, ())),
+    )
+    assert events and events <= indexed
+
+
+@pytest.mark.parametrize("map_size_bits,lineno,offset", (
+    (16, 123, 234),
+    (16, 0, 0),
+    (12, 4567, 8),
+    (16, rewriter.BLOCK_ID_LINENO_FLAG | 0x12345, 10),
+    (12, rewriter.BLOCK_ID_LINENO_FLAG | 0x12345, 10),
+))
+def test_block_location(map_size_bits, lineno, offset):
+    with mmap.mmap(-1, 1<<map_size_bits, flags=mmap.MAP_PRIVATE) as mem:
+        first_byte = ctypes.c_byte.from_buffer(mem)
+        try:
+            tracehook.set_map_start(ctypes.addressof(first_byte))
+            tracehook.set_map_size_bits(map_size_bits)
+            tracehook.set_ngram_size(0)
+            tracehook.reset_prev_loc()
+
+            for lineno_, offset_ in ((lineno, offset), (lineno, offset)):
+                mock_frame = mock.create_autospec(
+                    FrameType,
+                    instance=True,
+                    f_lineno=lineno_,
+                    f_lasti=offset_,
+                )
+                tracehook.line_trace_hook(mock_frame, "line", mock.Mock())
+
+            mask = (1<<map_size_bits) - 1
+            loc = symbolize.block_location(lineno, offset, map_size_bits)
+            # entered from nowhere, then from itself
+            assert mem[loc & mask] == 1
+            assert mem[(loc ^ (loc >> 1)) & mask] == 1
+            assert mem.read().count(0) == (1<<map_size_bits) - 2
+        finally:
+            del first_byte
+
+
+harness_source = """
+import sys
+from cpytraceafl.rewriter import install_rewriter
+
+install_rewriter(index_path=sys.argv[1])
+
+exec(compile('''
+def target(data):
+    if data[:1] == b"a":
+        return 1
+    elif data[:1] == b"b":
+        for c in data:
+            if c == 0:
+                return 2
+    elif data[:1] == b"c":
+        return 3
+    return 4
+''', "target.py", "exec"))
+
+from cpytraceafl import fuzz_from_here, read_input
+
+fuzz_from_here()
+target(read_input(sys.argv[2]))
+"""
+
+
+def _get_target_report(output):
+    # returns number of blocks reached and the unreached lines of the target function
+    lines = output.splitlines()
+    i = next(i for i, line in enumerate(lines) if line.endswith("target.py:2 target"))
+    unreached = lines[i+1] if lines[i+1].startswith("\t") else None
+    return int(lines[i].split("/")[0]), unreached
+
+
+def test_main(tmp_path, capsys):
+    index_path = str(tmp_path / "index")
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    (corpus_dir / "1").write_bytes(b"a")
+    (corpus_dir / "2").write_bytes(b"z")
+    target_args = [sys.executable, "-c", harness_source, index_path, "@@"]
+
+    assert symbolize.main([index_path, str(corpus_dir), "--"] + target_args) == 0
+    n_reached, unreached = _get_target_report(capsys.readouterr().out)
+    # (whether line 7 starts its own block depends on the python version)
+    assert unreached in ("\tunreached lines: 6-8, 10", "\tunreached lines: 6, 8, 10")
+
+    # the same from a map of the same inputs
+    with Driver(target_args) as driver:
+        results = [driver.run(data) for data in (b"a", b"z")]
+    bitmap = bytes(max(values) for values in zip(*(result.coverage for result in results)))
+    (tmp_path / "bitmap").write_bytes(bitmap)
+
+    assert symbolize.main([index_path, "--bitmap", str(tmp_path / "bitmap")]) == 0
+    bitmap_n_reached, bitmap_unreached = _get_target_report(capsys.readouterr().out)
+    if hasattr(sys, "monitoring"):
+        # the monitoring backend only records blocks entered through jumps & branches
+        assert 0 < bitmap_n_reached <= n_reached
+    else:
+        assert bitmap_n_reached == n_reached
+        assert bitmap_unreached == unreached
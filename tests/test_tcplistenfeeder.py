@@ -0,0 +1,134 @@
+import ast
+import asyncio
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cpytraceafl import READ_NOTIFY_ENV_VAR
+from cpytraceafl.driver import Driver, describe_status
+
+
+FEEDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tcplistenfeeder.py")
+
+target_source = """
+import socket
+import sys
+import time
+
+from cpytraceafl import fuzz_from_here
+
+fuzz_from_here()
+
+port, output_path = int(sys.argv[1]), sys.argv[2]
+for _ in range(100):
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+        break
+    except ConnectionRefusedError:
+        time.sleep(0.05)
+
+# never saying anything, so only notifications will get us the next chunk
+chunks = []
+while True:
+    data = sock.recv(4096)
+    if not data:
+        break
+    chunks.append(data)
+
+with open(output_path, "w") as f:
+    f.write(repr(chunks))
+"""
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.parametrize("notify", (False, True,))
+def test_feeder(tmp_path, notify):
+    port = _free_port()
+    payload_path = tmp_path / "payload"
+    payload_path.write_bytes(b"\xde\xad\xbe\xef".join((b"hello", b"one", b"two")))
+    notify_path = str(tmp_path / "notify.sock")
+    output_path = tmp_path / "output"
+
+    feeder = subprocess.Popen(
+        (sys.executable, FEEDER_PATH, str(port), str(payload_path)) + (
+            ("--notify", notify_path) if notify else ()
+        ),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        env = dict(os.environ)
+        if notify:
+            env[READ_NOTIFY_ENV_VAR] = notify_path
+        with Driver(
+            (sys.executable, "-c", target_source, str(port), str(output_path)),
+            env=env,
+            timeout=10,
+        ) as driver:
+            start = time.monotonic()
+            result = driver.run(b"")
+            assert describe_status(result.status) == "exit 0"
+            assert time.monotonic() - start < 5
+    finally:
+        feeder.terminate()
+        feeder.wait()
+
+    chunks = ast.literal_eval(output_path.read_text())
+    if notify:
+        assert chunks == [b"hello", b"one", b"two"]
+    else:
+        # target went quiet, so the feeder gave up
+        assert chunks == [b"hello"]
+
+
+def test_feeder_ignores_stale_notification(tmp_path):
+    spec = importlib.util.spec_from_file_location("tcplistenfeeder", FEEDER_PATH)
+    feeder = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(feeder)
+
+    port = _free_port()
+    payload_path = tmp_path / "payload"
+    payload_path.write_bytes(b"\xde\xad\xbe\xef".join((b"hello", b"one")))
+    notify_path = str(tmp_path / "notify.sock")
+
+    async def scenario():
+        servers = await feeder.serve([(port, str(payload_path))], notify_path=notify_path)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        host, local_port = writer.get_extra_info("sockname")[:2]
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+                assert await reader.read(100) == b"hello"
+
+                # as sent by a read which blocked before the first chunk arrived
+                notify_socket.sendto("{} {} 0".format(host, local_port).encode(), notify_path)
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(reader.read(100), 0.3)
+
+                notify_socket.sendto("{} {} 5".format(host, local_port).encode(), notify_path)
+                assert await asyncio.wait_for(reader.read(100), 5) == b"one"
+
+                # having read everything, the feeder should be done with us
+                notify_socket.sendto("{} {} 8".format(host, local_port).encode(), notify_path)
+                assert await asyncio.wait_for(reader.read(100), 5) == b""
+                # letting the handler clean up
+                await asyncio.sleep(0.1)
+        finally:
+            writer.close()
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        loop.close()
@@ -1,12 +1,18 @@
 import ctypes
+import dis
 from itertools import repeat
 import mmap
+import random
+import struct
+import sys
 from types import FrameType
 from unittest import mock
 
 import pytest
 
-from cpytraceafl import tracehook
+from cpytraceafl import rewriter, tracehook
+
+from tracing import run_traced
 
 
 def _get_populated_map_bytes(map_size_bits, loc_value_pairs):
@@ -41,6 +47,13 @@ def _get_populated_map_bytes(map_size_bits, loc_value_pairs):
     (12, 0, ((0xa88, 0xff),), ((321, 432), (543, 654)), ((0xa88, 1),),),
 
     (16, 0, ((0x123, 0x11),), ((322, 433), (544, 655)), ((0x123, 0x11), (0x1179, 1),),),
+
+    # block ids, used as locations verbatim, regardless of lasti
+    (16, 0, (), ((0x40001234, 0), (0x40005678, 999)), ((0x5f62, 1),),),
+    (16, 0, (), ((0x40001234, 0), (0x40005678, 0)), ((0x5f62, 1),),),
+    # mixed with hashed locations
+    (12, 0, (), ((123, 234), (0x4abcdef1, 5)), ((0x9f6, 1),),),
+    (16, 0, (), ((0x4abcdef1, 5), (123, 234)), ((0x8f8d, 1),),),
 ))
 def test_line_trace_hook(map_size_bits, ngram_size, map_prepop, lineno_lasti_pairs, expected_nonzeros):
     with mmap.mmap(-1, 1<<map_size_bits, flags=mmap.MAP_PRIVATE) as mem:
@@ -80,6 +93,46 @@ def test_line_trace_hook(map_size_bits, ngram_size, map_prepop, lineno_lasti_pai
             del first_byte
 
 
+def test_line_trace_hook_real_frame():
+    def gen():
+        yield 1
+        yield 2
+
+    g = gen()
+    next(g)
+    # a suspended generator's frame will have stable values for us to inspect
+    real_frame = g.gi_frame
+    mock_frame = mock.create_autospec(
+        FrameType,
+        instance=True,
+        f_lineno=real_frame.f_lineno,
+        f_lasti=real_frame.f_lasti,
+    )
+
+    with mmap.mmap(-1, 1<<16, flags=mmap.MAP_PRIVATE) as mem:
+        first_byte = ctypes.c_byte.from_buffer(mem)
+        try:
+            tracehook.set_map_start(ctypes.addressof(first_byte))
+            tracehook.set_map_size_bits(16)
+            tracehook.set_ngram_size(0)
+
+            maps = []
+            for frame in (mock_frame, real_frame):
+                # make sure both calls have the same prev_loc
+                tracehook.line_trace_hook(mock_frame, "line", None)
+                mem.write(bytes(1<<16))
+                mem.seek(0)
+
+                assert tracehook.line_trace_hook(frame, "line", None) is tracehook.line_trace_hook
+                maps.append(mem.read())
+                mem.seek(0)
+
+            assert any(maps[0])
+            assert maps[0] == maps[1]
+        finally:
+            del first_byte
+
+
 @pytest.mark.parametrize("value", (1, 128,))
 def test_invalid_ngram_size(value):
     with pytest.raises(ValueError):
@@ -89,3 +142,282 @@ def test_invalid_ngram_size(value):
 @pytest.mark.parametrize("value", (0, 2, 3,))
 def test_valid_ngram_size(value):
     tracehook.set_ngram_size(value)
+
+
+trace_test_source = """
+def foo(x):
+    total = 0
+    for i in range(x):
+        if i % 3:
+            total += i
+        else:
+            try:
+                raise ValueError(i)
+            except ValueError:
+                total -= 1
+    return total + sum(bar(x))
+
+def bar(y):
+    while y:
+        y -= 1
+        if y & 1:
+            yield y
+"""
+
+
+@pytest.mark.parametrize("selector", (True, False,))
+def test_global_trace_hook(selector):
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(trace_test_source, "foo.py", "exec"),
+        selector,
+    ), namespace)
+
+    g = namespace["bar"](3)
+    next(g)
+
+    expected = tracehook.line_trace_hook if selector else None
+    # second call will be answered from the code object's cached decision
+    for _ in range(2):
+        assert tracehook.global_trace_hook(g.gi_frame, "call", None) is expected
+    assert tracehook.global_trace_hook(g.gi_frame, "line", None) is None
+
+    tracehook.set_instrumented(g.gi_frame.f_code, not selector)
+    expected = None if selector else tracehook.line_trace_hook
+    assert tracehook.global_trace_hook(g.gi_frame, "call", None) is expected
+
+
+exclude_test_source = """
+class Foo:
+    def method(self):
+        def inner():
+            yield 1
+        return inner()
+
+def bar():
+    yield 2
+"""
+
+
+def test_exclude_from_tracing():
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(exclude_test_source, "foo.py", "exec"),
+        True,
+    ), namespace)
+    inner_frame = namespace["Foo"]().method().gi_frame
+    bar_frame = namespace["bar"]().gi_frame
+
+    assert tracehook.exclude_from_tracing(namespace["Foo"]) is namespace["Foo"]
+    # nested code included
+    assert tracehook.global_trace_hook(inner_frame, "call", None) is None
+    assert tracehook.global_trace_hook(bar_frame, "call", None) is tracehook.line_trace_hook
+
+
+exclude_methods_test_source = """
+class Baz:
+    @exclude_from_tracing
+    @staticmethod
+    def static():
+        yield 3
+
+    @exclude_from_tracing
+    @classmethod
+    def klass(cls):
+        yield 4
+
+    @exclude_from_tracing
+    @property
+    def prop(self):
+        def inner():
+            yield 5
+        return inner()
+
+    def traced(self):
+        yield 6
+"""
+
+
+def test_exclude_from_tracing_methods():
+    namespace = {"exclude_from_tracing": tracehook.exclude_from_tracing}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(exclude_methods_test_source, "foo.py", "exec"),
+        True,
+    ), namespace)
+    baz = namespace["Baz"]
+
+    for gen in (baz.static(), baz.klass(), baz().prop):
+        assert tracehook.global_trace_hook(gen.gi_frame, "call", None) is None
+    assert tracehook.global_trace_hook(
+        baz().traced().gi_frame, "call", None
+    ) is tracehook.line_trace_hook
+
+    with pytest.raises(TypeError):
+        tracehook.exclude_from_tracing(baz(), baz.traced)
+
+
+@pytest.mark.parametrize("map_size_bits,ngram_size,arg,block_ids", (
+    (16, 0, 10, False),
+    (16, 0, 0, False),
+    (12, 0, 25, False),
+    (16, 3, 10, False),
+    (16, 0, 10, True),
+    (12, 3, 25, True),
+))
+def test_native_trace_hook_equivalence(map_size_bits, ngram_size, arg, block_ids):
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(trace_test_source, "foo.py", "exec"),
+        block_ids=block_ids,
+    ), namespace)
+
+    python_map = run_traced(
+        "python", namespace["foo"], arg, map_size_bits=map_size_bits, ngram_size=ngram_size,
+    )
+    native_map = run_traced(
+        "native", namespace["foo"], arg, map_size_bits=map_size_bits, ngram_size=ngram_size,
+    )
+
+    assert any(python_map)
+    assert python_map == native_map
+
+
+generator_test_source = """
+def gen(n):
+    yield
+    for i in range(n):
+        if i % 3:
+            n += 1
+    yield n
+"""
+
+
+def test_native_trace_hook_resumed_generator():
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(generator_test_source, "foo.py", "exec"),
+    ), namespace)
+
+    maps = []
+    for backend in ("python", "native"):
+        # started before tracing, so only seen when resumed
+        gen = namespace["gen"](10)
+        next(gen)
+        maps.append(run_traced(backend, next, gen))
+
+    assert any(maps[0])
+    assert maps[0] == maps[1]
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="sys.monitoring requires python 3.12")
+@pytest.mark.parametrize("selector,block_ids", (
+    (True, False),
+    (False, False),
+    (True, True),
+))
+def test_monitoring_hook(selector, block_ids):
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(trace_test_source, "foo.py", "exec"),
+        selector,
+        block_ids,
+    ), namespace)
+
+    maps = [run_traced("monitoring", namespace["foo"], arg) for arg in (10, 10, 3)]
+
+    if selector:
+        assert any(maps[0])
+        assert maps[0] == maps[1]
+        assert maps[0] != maps[2]
+    else:
+        assert not any(b"".join(maps))
+
+
+cmplog_test_source = """
+def foo(data, n):
+    if data[:4] == b"%PDF":
+        return 1
+    if n > 0x1234:
+        return 2
+    if data.decode() in ("spam", "eggs"):
+        return 3
+    return 0
+"""
+
+CMP_MAP_W = 1<<16
+CMP_MAP_H = 32
+CMP_OPERANDS_SIZE = 72
+
+
+def _read_cmplog_map(mem):
+    instructions = set()
+    routines = set()
+    for k, header in enumerate(struct.unpack_from("{}H".format(CMP_MAP_W), mem)):
+        hits, shape, type_, attribute = (
+            header & 0x3f, (header >> 6) & 0x1f, (header >> 11) & 1, header >> 12
+        )
+        row_offset = 2*CMP_MAP_W + k*CMP_MAP_H*CMP_OPERANDS_SIZE
+        if type_ == 0:
+            for i in range(min(hits, CMP_MAP_H)):
+                v0, _, _, _, v1 = struct.unpack_from("5Q", mem, row_offset + i*CMP_OPERANDS_SIZE)
+                instructions.add((v0, v1, shape, attribute))
+        else:
+            for i in range(min(hits, CMP_MAP_H//2)):
+                v0, v1, v0_len, v1_len = struct.unpack_from(
+                    "32s32sBB",
+                    mem,
+                    row_offset + i*CMP_OPERANDS_SIZE,
+                )
+                routines.add((v0[:v0_len], v1[:v1_len], shape))
+    return instructions, routines
+
+
+@pytest.mark.skipif(
+    not hasattr(tracehook, "set_cmplog_map_start"),
+    reason="cmplog requires python < 3.11",
+)
+@pytest.mark.parametrize("backend", ("python", "native",))
+def test_cmplog(backend):
+    namespace = {}
+    exec(rewriter.rewrite(
+        sys.version_info,
+        dis,
+        random.Random,
+        compile(cmplog_test_source, "foo.py", "exec"),
+        cmplog=True,
+    ), namespace)
+
+    cmplog_map_size = 2*CMP_MAP_W + CMP_MAP_W*CMP_MAP_H*CMP_OPERANDS_SIZE
+    with mmap.mmap(-1, cmplog_map_size, flags=mmap.MAP_PRIVATE) as mem:
+        first_byte = ctypes.c_byte.from_buffer(mem)
+        try:
+            tracehook.set_cmplog_map_start(ctypes.addressof(first_byte))
+            try:
+                run_traced(backend, namespace["foo"], b"spun", 0x123)
+            finally:
+                tracehook.set_cmplog_map_start(0)
+
+            instructions, routines = _read_cmplog_map(mem)
+        finally:
+            del first_byte
+
+    assert instructions == {(0x123, 0x1234, 1, 2)}
+    assert routines == {(b"spun", b"%PDF", 3), (b"spun", b"spam", 3), (b"spun", b"eggs", 3)}
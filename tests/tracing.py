@@ -0,0 +1,41 @@
+import ctypes
+import mmap
+import sys
+
+from cpytraceafl import MONITORING_TOOL_ID, install_trace_hook, tracehook
+
+
+def run_traced(backend, func, *args, map_size_bits=16, ngram_size=0):
+    """
+        Call `func(*args)` with `backend` ("python", "native" or "monitoring") tracing to a
+        fresh map of `map_size_bits`, returning the map's contents
+    """
+    with mmap.mmap(-1, 1<<map_size_bits, flags=mmap.MAP_PRIVATE) as mem:
+        first_byte = ctypes.c_byte.from_buffer(mem)
+        try:
+            tracehook.set_map_start(ctypes.addressof(first_byte))
+            tracehook.set_map_size_bits(map_size_bits)
+            tracehook.set_ngram_size(ngram_size)
+            ctypes.memset(ctypes.addressof(
+                ctypes.c_byte.in_dll(ctypes.pythonapi, "__afl_prev_loc")
+            ), 0, 64)
+
+            if backend == "monitoring":
+                install_trace_hook(ctypes.addressof(first_byte), map_size_bits, ngram_size)
+            elif backend == "native":
+                tracehook.set_native_trace_hook()
+            else:
+                sys.settrace(tracehook.global_trace_hook)
+            try:
+                func(*args)
+            finally:
+                if backend == "monitoring":
+                    sys.monitoring.set_events(MONITORING_TOOL_ID, 0)
+                else:
+                    sys.settrace(None)
+
+            return mem.read()
+        finally:
+            tracehook.set_map_start(0)
+            del first_byte
+